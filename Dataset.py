@@ -1,14 +1,58 @@
 import netCDF4 as nc
 import datetime
+import numpy as np
+import os
+import Profiler
+import Swath
+from OutputOptions import OutputOptions, WriteBuffer
+from OutputStore import NetcdfStore, createStore
+from mergeShards import writeShardAttributes
+
+
+# Per time step inputs of a rain slice, stored in the track variable
+TRACK_VALUES = ["latitude", "longitude", "wind"]
+# Physical range of the rain rate in mm h-1 covered by packed output
+RAIN_RANGE = (-20.0, 200.0)
+COLDSTART_DATE = datetime.datetime(1990, 1, 1, 0, 0, 0)
+COLDSTART_DATE_UNIX = datetime.datetime(1970, 1, 1, 0, 0, 0)
 
 
 # Rework this
+# Each time step also stores the interpolated track center and wind the rain was computed from, and the
+# file records the rain settings, so a later advisory can tell which slices changed (see generateParametricRain).
+# mode "a" opens an existing file to overwrite or extend its slices in place.
+# The slices go through the OutputStore picked by outputOptions.store, with a directory store worker processes
+# write blocks themselves through Dataset.blockValues and store.write.
+# shard (start, end, total) writes only slices start to end - 1 of a run of total slices, see mergeShards. Indices
+# passed in stay those of the full run.
+# The storm total, maximum rain rate and its time (precipitation_total, precipitation_max, precipitation_max_time)
+# are accumulated from the slices as they are written, see Swath, using the values as stored so packed output
+# gives the swath of the packed rain. Slices stored by workers are folded in with mergeSwath. An in place update
+# reads the file back at close to rebuild them.
 class Dataset:
-    def __init__(self, filename, latitudes, longitudes):
+    def __init__(self, filename, latitudes, longitudes, outputOptions=None, settings="", mode="w", shard=None):
         self.filename = filename
+        self.indexOffset = 0 if shard is None else shard[0]
         self.longitudes = longitudes
         self.latitudes = latitudes
-        self.dataset = nc.Dataset(self.filename, "w")
+        self.outputOptions = outputOptions or OutputOptions()
+        self.buffer = WriteBuffer(self.outputOptions.bufferSize, self.writeBlock)
+        self.coldstartDate = COLDSTART_DATE
+        self.coldstartDateUnix = COLDSTART_DATE_UNIX
+        if(mode == "a"):
+            if(self.outputOptions.store != "netcdf"):
+                raise RuntimeError("Only NetCDF output can be updated in place")
+            self.store = NetcdfStore(self.filename, "a")
+            self.dataset = self.store.dataset
+            self.variableTime = self.dataset["time"]
+            self.variableUnix = self.dataset["time_unix"]
+            self.variableTrack = self.dataset["track"]
+            self.variableRain = self.dataset["precipitation"]
+            self.swath = None
+            return
+        coordinateArguments = self.outputOptions.coordinateArguments()
+        self.store = createStore(self.filename, self.outputOptions)
+        self.dataset = self.store.dataset
         self.dataset.source = "python"
         self.dataset.author = "Pranav Sai"
         self.dataset.contact = "pranav_sai@uri.edu"
@@ -20,28 +64,33 @@ class Dataset:
         self.dimensionLatitude = self.dataset.createDimension("latitude", len(self.latitudes))
 
         # Create variables (with compression)
-        self.variableTime = self.dataset.createVariable("time", "f4", "time", zlib=True, complevel=2,
+        self.variableTime = self.dataset.createVariable("time", "f4", "time", **coordinateArguments,
                                                                       fill_value=nc.default_fillvals["f4"])
-        self.variableUnix = self.dataset.createVariable("time_unix", "i8", "time", zlib=True, complevel=2,
-                                                                           fill_value=nc.default_fillvals["i8"])  # int64 isn't supported in DAP2; still using unless RICHAMP needs DAP2
-        self.variableLongitude = self.dataset.createVariable("lon", "f8", "longitude", zlib=True, complevel=2,
-                                                                     fill_value=nc.default_fillvals["f8"])
-        self.variableLatitude = self.dataset.createVariable("lat", "f8", "latitude", zlib=True, complevel=2,
-                                                                     fill_value=nc.default_fillvals["f8"])
+        self.variableUnix = self.dataset.createVariable("time_unix", "i8", "time", **coordinateArguments,
+                                                                      fill_value=nc.default_fillvals["i8"])  # int64 isn't supported in DAP2; still using unless RICHAMP needs DAP2
+        self.variableLongitude = self.dataset.createVariable("lon", "f8", "longitude", **coordinateArguments,
+                                                                      fill_value=nc.default_fillvals["f8"])
+        self.variableLatitude = self.dataset.createVariable("lat", "f8", "latitude", **coordinateArguments,
+                                                                      fill_value=nc.default_fillvals["f8"])
         # self.dataset_var_u10       = self.dataset.createVariable("U10", "f4", ("time", "latitude", "longitude"), zlib=True,
         #                                                                     complevel=2,fill_value=nc.default_fillvals["f4"])
         # self.dataset_var_v10       = self.dataset.createVariable("V10", "f4", ("time", "latitude", "longitude"), zlib=True,
         #                                                                     complevel=2,fill_value=nc.default_fillvals["f4"])
-        self.variableRain = self.dataset.createVariable("precipitation", "f4", ("time", "latitude", "longitude"), zlib=True,
-                                                                     complevel=2, fill_value=nc.default_fillvals["f4"])
+        self.variableRain = self.outputOptions.createGridVariable(self.dataset, "precipitation", len(self.latitudes), len(self.longitudes), RAIN_RANGE)
+        self.dimensionTrack = self.dataset.createDimension("track_value", len(TRACK_VALUES))
+        self.variableTrack = self.dataset.createVariable("track", "f8", ("time", "track_value"), **coordinateArguments,
+                                                                     fill_value=nc.default_fillvals["f8"])
+        self.dataset.rain_settings = settings
+        Swath.createVariables(self.dataset, "precipitation", "mm h-1", total=True, totalUnits="mm", coordinateArguments=coordinateArguments)
+        self.swath = Swath.Swath((len(self.latitudes), len(self.longitudes)), total=True)
+        if(shard is not None):
+            writeShardAttributes(self.dataset, shard)
 
         # Add attributes to variables
-        self.coldstartDate = datetime.datetime(1990, 1, 1, 0, 0, 0)
         self.variableTime.units = "minutes since 1990-01-01 00:00:00 Z"
         self.variableTime.axis = "T"
         self.variableTime.coordinates = "time"
 
-        self.coldstartDateUnix = datetime.datetime(1970, 1, 1, 0, 0, 0)
         self.variableUnix.units = "seconds since 1970-01-01 00:00:00 Z"
         self.variableUnix.axis = "T"
         self.variableUnix.coordinates = "time"
@@ -59,22 +108,188 @@ class Dataset:
         self.variableRain.units = "mm h-1"
         self.variableRain.coordinates = "time lat lon"
 
+        self.variableTrack.long_name = "interpolated track " + ", ".join(TRACK_VALUES)
+        self.variableTrack.coordinates = "time"
+
         self.variableLatitude[:] = self.latitudes
         self.variableLongitude[:] = self.longitudes
+        self.store.commit()
 
-    def append(self, index, date, rain):
-        delta = (date - self.coldstartDate)
+    @staticmethod
+    def timeValues(date):
+        delta = (date - COLDSTART_DATE)
         minutes = round((delta.days * 86400 + delta.seconds) / 60)
-        deltaUnix = (date - self.coldstartDateUnix)
+        deltaUnix = (date - COLDSTART_DATE_UNIX)
         seconds = round(deltaUnix.days * 86400 + deltaUnix.seconds)
+        return minutes, seconds
+
+    # Variable values of a block of consecutive slices, as handed to the store
+    @staticmethod
+    def blockValues(dates, rain, track):
+        times = [Dataset.timeValues(date) for date in dates]
+        return {"time": [minutes for minutes, seconds in times], "time_unix": [seconds for minutes, seconds in times],
+                "track": track, "precipitation": rain}
+
+    # track holds the TRACK_VALUES the slice was computed from
+    def append(self, index, date, rain, track):
+        minutes, seconds = self.timeValues(date)
+        self.buffer.append(index - self.indexOffset, (minutes, seconds, rain, track))
+
+    # Write a (time, latitude, longitude) block of consecutive slices starting at index in one hyperslab
+    def appendBlock(self, index, dates, rain, track):
+        self.buffer.flush()
+        values = Dataset.blockValues(dates, rain, track)
+        self.updateSwath(index, values["time"], rain)
+        with Profiler.stage("netcdf write", index):
+            self.store.write(index - self.indexOffset, values)
+
+    def writeBlock(self, index, columns):
+        minutes, seconds, rain, track = columns
+        self.updateSwath(index + self.indexOffset, minutes, rain)
+
+        with Profiler.stage("netcdf write", index):
+            # self.dataset_var_u10[idx, :, :] = uvel
+            # self.dataset_var_v10[idx, :, :] = vvel
+            self.store.write(index, {"time": minutes, "time_unix": seconds, "track": track, "precipitation": rain})
+
+    def updateSwath(self, index, minutes, rain):
+        if(self.swath is not None):
+            with Profiler.stage("swath", index):
+                self.swath.update(minutes, self.outputOptions.storedValues(rain, RAIN_RANGE))
+
+    # Folds in the Swath of slices a worker wrote to the store itself
+    def mergeSwath(self, swath):
+        with Profiler.stage("swath"):
+            self.swath.merge(swath)
+
+    # Swath of every slice in the file, read back block by block
+    def readSwath(self):
+        return Swath.read(self.dataset, "precipitation", total=True, blockSize=max(1, self.outputOptions.bufferSize))
+
+    def close(self):
+        self.buffer.flush()
+        swath = self.swath
+        if(swath is None and "precipitation_max" in self.dataset.variables):
+            with Profiler.stage("swath"):
+                swath = self.readSwath()
+        if(swath is not None):
+            self.store.writeSummary(swath.values("precipitation"))
+        with Profiler.stage("netcdf write"):
+            self.store.close()
+        Profiler.addBytes("netcdf write", written=self.store.size())
+
+    # Latitudes, longitudes, time stamps (seconds since 1970), track values and rain settings of an existing file,
+    # None when there is no file or it was written before the track values were stored
+    @staticmethod
+    def readTrack(filename):
+        try:
+            dataset = nc.Dataset(filename, "r")
+        except OSError:
+            return None
+        with dataset:
+            if("track" not in dataset.variables):
+                return None
+            return {"latitudes": np.ma.filled(dataset["lat"][:], float("nan")), "longitudes": np.ma.filled(dataset["lon"][:], float("nan")),
+                    "timeUnix": np.ma.filled(dataset["time_unix"][:], 0), "track": np.ma.filled(dataset["track"][:], float("nan")),
+                    "settings": getattr(dataset, "rain_settings", None)}
+
+
+# Rain of a track ensemble, precipitation (member, time, latitude, longitude) with the track values of every member.
+# Probability of exceedance summaries are updated from each hour as it is appended:
+#     rate_exceedance (time, rate_threshold, latitude, longitude)   fraction of members whose rain rate reaches each threshold
+#     total_exceedance (total_threshold, latitude, longitude)       fraction of members whose storm total reaches each
+#                                                                   threshold, written at close from running member totals
+# Rain rates are hourly, so the storm total in mm is the sum of the rates. Culled points holding the fill value count as no rain.
+class EnsembleDataset:
+    def __init__(self, filename, latitudes, longitudes, numMembers, rateThresholds, totalThresholds, outputOptions=None, settings=""):
+        self.filename = filename
+        self.outputOptions = outputOptions or OutputOptions()
+        if(self.outputOptions.store != "netcdf"):
+            raise RuntimeError("Ensemble rain is only written to the netcdf store")
+        self.rateThresholds = np.asarray(rateThresholds, dtype=np.float32)
+        self.totalThresholds = np.asarray(totalThresholds, dtype=np.float32)
+        self.totals = np.zeros((numMembers, len(latitudes), len(longitudes)), dtype=np.float32)
+        coordinateArguments = self.outputOptions.coordinateArguments()
+        self.dataset = nc.Dataset(self.filename, "w")
+        self.dataset.source = "python"
+        self.dataset.author = "Pranav Sai"
+        self.dataset.contact = "pranav_sai@uri.edu"
+        self.dataset.rain_settings = settings
+
+        self.dataset.createDimension("time", None)
+        self.dataset.createDimension("member", numMembers)
+        self.dataset.createDimension("longitude", len(longitudes))
+        self.dataset.createDimension("latitude", len(latitudes))
+        self.dataset.createDimension("track_value", len(TRACK_VALUES))
+        self.dataset.createDimension("rate_threshold", len(self.rateThresholds))
+        self.dataset.createDimension("total_threshold", len(self.totalThresholds))
+
+        self.variableTime = self.dataset.createVariable("time", "f4", "time", **coordinateArguments, fill_value=nc.default_fillvals["f4"])
+        self.variableUnix = self.dataset.createVariable("time_unix", "i8", "time", **coordinateArguments, fill_value=nc.default_fillvals["i8"])
+        variableLongitude = self.dataset.createVariable("lon", "f8", "longitude", **coordinateArguments, fill_value=nc.default_fillvals["f8"])
+        variableLatitude = self.dataset.createVariable("lat", "f8", "latitude", **coordinateArguments, fill_value=nc.default_fillvals["f8"])
+        variableMember = self.dataset.createVariable("member", "i4", "member")
+        variableRateThreshold = self.dataset.createVariable("rate_threshold", "f4", "rate_threshold")
+        variableTotalThreshold = self.dataset.createVariable("total_threshold", "f4", "total_threshold")
+        self.variableTrack = self.dataset.createVariable("track", "f8", ("member", "time", "track_value"), **coordinateArguments,
+                                                         fill_value=nc.default_fillvals["f8"])
+        self.variableRain = self.outputOptions.createGridVariable(self.dataset, "precipitation", len(latitudes), len(longitudes), RAIN_RANGE,
+                                                                  ("member", "time", "latitude", "longitude"))
+        self.variableRateExceedance = self.outputOptions.createGridVariable(self.dataset, "rate_exceedance", len(latitudes), len(longitudes),
+                                                                            (0.0, 1.0), ("time", "rate_threshold", "latitude", "longitude"))
+        self.variableTotalExceedance = self.outputOptions.createGridVariable(self.dataset, "total_exceedance", len(latitudes), len(longitudes),
+                                                                             (0.0, 1.0), ("total_threshold", "latitude", "longitude"))
+
+        self.variableTime.units = "minutes since 1990-01-01 00:00:00 Z"
+        self.variableTime.axis = "T"
+        self.variableTime.coordinates = "time"
+        self.variableUnix.units = "seconds since 1970-01-01 00:00:00 Z"
+        self.variableUnix.axis = "T"
+        self.variableUnix.coordinates = "time"
+        variableLongitude.units = "degrees_east"
+        variableLongitude.standard_name = "longitude"
+        variableLongitude.axis = "x"
+        variableLatitude.units = "degrees_north"
+        variableLatitude.standard_name = "latitude"
+        variableLatitude.axis = "y"
+        variableMember.long_name = "ensemble member, 0 is the unperturbed track"
+        variableRateThreshold.units = "mm h-1"
+        variableTotalThreshold.units = "mm"
+        self.variableTrack.long_name = "interpolated track " + ", ".join(TRACK_VALUES) + " of each member"
+        self.variableRain.units = "mm h-1"
+        self.variableRain.coordinates = "time lat lon"
+        self.variableRateExceedance.units = "1"
+        self.variableRateExceedance.long_name = "probability the rain rate reaches rate_threshold"
+        self.variableRateExceedance.coordinates = "time lat lon"
+        self.variableTotalExceedance.units = "1"
+        self.variableTotalExceedance.long_name = "probability the storm total rain reaches total_threshold"
+        self.variableTotalExceedance.coordinates = "lat lon"
+
+        variableLatitude[:] = latitudes
+        variableLongitude[:] = longitudes
+        variableMember[:] = np.arange(numMembers)
+        variableRateThreshold[:] = self.rateThresholds
+        variableTotalThreshold[:] = self.totalThresholds
+
+    # rain (member, latitude, longitude) and track (member, TRACK_VALUES) of the hour at index
+    def append(self, index, date, rain, track):
+        minutes, seconds = Dataset.timeValues(date)
+        rain = np.asarray(rain, dtype=np.float32)
+        with Profiler.stage("ensemble summary", index):
+            rates = np.where(rain >= np.float32(nc.default_fillvals["f4"]), np.float32(0.0), rain)
+            self.totals += rates
+            exceedance = np.stack([np.mean(rates >= threshold, axis=0) for threshold in self.rateThresholds])
+        with Profiler.stage("netcdf write", index):
+            self.variableTime[index] = minutes
+            self.variableUnix[index] = seconds
+            self.variableTrack[:, index, :] = track
+            self.variableRain[:, index, :, :] = OutputOptions.packValues(self.variableRain, rain)
+            self.variableRateExceedance[index, :, :, :] = OutputOptions.packValues(self.variableRateExceedance, exceedance)
 
-        self.variableTime[index] = minutes
-        self.variableUnix[index] = seconds
-        # self.dataset_var_u10[idx, :, :] = uvel
-        # self.dataset_var_v10[idx, :, :] = vvel
-#         print(self.dataset_var_lat[::])
-#         print(self.dataset_var_lon[::])
-        self.variableRain[index, :, :] = rain
-        
     def close(self):
-        self.__nc.close()
+        with Profiler.stage("ensemble summary"):
+            exceedance = np.stack([np.mean(self.totals >= threshold, axis=0) for threshold in self.totalThresholds])
+        with Profiler.stage("netcdf write"):
+            self.variableTotalExceedance[:, :, :] = OutputOptions.packValues(self.variableTotalExceedance, exceedance)
+            self.dataset.close()
+        Profiler.addBytes("netcdf write", written=os.path.getsize(self.filename))
@@ -0,0 +1,150 @@
+import hashlib
+import os
+import shutil
+import tempfile
+
+import numpy as np
+
+
+# Coordinate and trigonometric tables of a rectilinear grid
+GEOMETRY_ARRAYS = ["latitudes", "longitudes", "latitudeRadians", "longitudeRadians", "cosLatitudes"]
+DEFAULT_CACHE_MB = 256
+
+# Geometries already memory mapped by this process, keyed by cache entry path
+OPENED_GEOMETRIES = {}
+
+
+# An axis is described by the numpy call that builds it, so cached values are bit for bit the values
+# the code computed before the cache existed:
+#   ("linspace", start, stop, count) for the rain grid and the OWI 306 and NWS12 grids
+#   ("arange", start, stop, step) for the owi2wind bounding box grid
+def linspaceAxis(start, step, count):
+    return ("linspace", float(start), float(start + (count - 1) * step), int(count))
+
+
+def arangeAxis(start, stop, step):
+    return ("arange", float(start), float(stop), float(step))
+
+
+def buildAxis(axis):
+    if(axis[0] == "linspace"):
+        return np.linspace(axis[1], axis[2], axis[3])
+    if(axis[0] == "arange"):
+        return np.arange(axis[1], axis[2], axis[3])
+    raise RuntimeError("Invalid grid axis " + str(axis))
+
+
+def buildArrays(latitudeAxis, longitudeAxis):
+    latitudes = buildAxis(latitudeAxis)
+    longitudes = buildAxis(longitudeAxis)
+    latitudeRadians = np.radians(latitudes)
+    return {"latitudes": latitudes, "longitudes": longitudes, "latitudeRadians": latitudeRadians,
+            "longitudeRadians": np.radians(longitudes), "cosLatitudes": np.cos(latitudeRadians)}
+
+
+# Grid coordinates in degrees with their radian and cos(latitude) tables.
+# Geometries from a GeometryCache hold read-only memory maps and pickle as their cache path,
+# so worker processes map the same files instead of receiving copies.
+class GridGeometry:
+    def __init__(self, latitudeAxis, longitudeAxis, arrays=None, path=None):
+        if(arrays is None):
+            arrays = buildArrays(latitudeAxis, longitudeAxis)
+        self.latitudeAxis = latitudeAxis
+        self.longitudeAxis = longitudeAxis
+        self.path = path
+        for name in GEOMETRY_ARRAYS:
+            setattr(self, name, arrays[name])
+
+    def arrays(self):
+        return {name: getattr(self, name) for name in GEOMETRY_ARRAYS}
+
+    def shape(self):
+        return (len(self.latitudes), len(self.longitudes))
+
+    # Sub grid of the given latitude and longitude index slices, sharing memory with this one
+    def window(self, latitudeSlice, longitudeSlice):
+        arrays = {}
+        for name in GEOMETRY_ARRAYS:
+            arrays[name] = getattr(self, name)[longitudeSlice if name.startswith("longitude") else latitudeSlice]
+        return GridGeometry(None, None, arrays)
+
+    def __reduce__(self):
+        if(self.path is not None):
+            return (GeometryCache.open, (self.path, self.latitudeAxis, self.longitudeAxis))
+        return (GridGeometry, (self.latitudeAxis, self.longitudeAxis, {name: np.asarray(array) for name, array in self.arrays().items()}))
+
+
+# Directory of grid geometries stored as .npy files, one subdirectory per (latitude axis, longitude axis).
+# Entries are written to a temporary directory and renamed into place, so concurrent runs never see a
+# partial entry. Least recently used entries are removed once the directory grows past maxMegabytes.
+class GeometryCache:
+    def __init__(self, directory, maxMegabytes=DEFAULT_CACHE_MB):
+        if(maxMegabytes <= 0):
+            raise RuntimeError("Geometry cache size must be positive")
+        self.directory = directory
+        self.maxBytes = int(maxMegabytes * 1024 * 1024)
+        os.makedirs(directory, exist_ok=True)
+
+    @staticmethod
+    def key(latitudeAxis, longitudeAxis):
+        return hashlib.sha1(repr((latitudeAxis, longitudeAxis)).encode()).hexdigest()
+
+    def get(self, latitudeAxis, longitudeAxis):
+        path = os.path.join(self.directory, "geometry_" + GeometryCache.key(latitudeAxis, longitudeAxis))
+        if(not os.path.isdir(path)):
+            self.write(path, buildArrays(latitudeAxis, longitudeAxis))
+            self.evict(path)
+        else:
+#             Mark the entry as recently used
+            os.utime(path)
+        return GeometryCache.open(path, latitudeAxis, longitudeAxis)
+
+    def write(self, path, arrays):
+        temporary = tempfile.mkdtemp(prefix=".geometry_", dir=self.directory)
+        for name, array in arrays.items():
+            np.save(os.path.join(temporary, name + ".npy"), array)
+        try:
+            os.rename(temporary, path)
+        except OSError:
+#             Another process wrote the same entry first
+            shutil.rmtree(temporary, ignore_errors=True)
+
+    @staticmethod
+    def open(path, latitudeAxis, longitudeAxis):
+        if(path in OPENED_GEOMETRIES):
+            return OPENED_GEOMETRIES[path]
+        try:
+            arrays = {name: np.load(os.path.join(path, name + ".npy"), mmap_mode="r") for name in GEOMETRY_ARRAYS}
+        except FileNotFoundError:
+#             Evicted by another process, fall back to an in memory geometry
+            return GridGeometry(latitudeAxis, longitudeAxis)
+        geometry = GridGeometry(latitudeAxis, longitudeAxis, arrays, path)
+        OPENED_GEOMETRIES[path] = geometry
+        return geometry
+
+    @staticmethod
+    def entrySize(path):
+        size = 0
+        for name in os.listdir(path):
+            size = size + os.path.getsize(os.path.join(path, name))
+        return size
+
+    # Removes least recently used entries until the cache fits in maxBytes, never removing keep
+    def evict(self, keep=None):
+        entries = []
+        for name in os.listdir(self.directory):
+            path = os.path.join(self.directory, name)
+            if(name.startswith("geometry_") and os.path.isdir(path)):
+                try:
+                    entries.append((os.path.getmtime(path), GeometryCache.entrySize(path), path))
+                except FileNotFoundError:
+                    continue
+        totalSize = sum(size for mtime, size, path in entries)
+        for mtime, size, path in sorted(entries):
+            if(totalSize <= self.maxBytes):
+                break
+            if(path == keep):
+                continue
+            shutil.rmtree(path, ignore_errors=True)
+            OPENED_GEOMETRIES.pop(path, None)
+            totalSize = totalSize - size
@@ -0,0 +1,201 @@
+import logging
+
+import netCDF4
+import numpy as np
+
+LOGGER = logging.getLogger(__name__)
+
+
+# Packed int16 values span -32766 to 32767, -32767 is the fill value
+PACKED_FILL = netCDF4.default_fillvals["i2"]
+PACKED_MIN = PACKED_FILL + 1
+PACKED_MAX = np.iinfo(np.int16).max
+FLOAT_FILL = np.float32(netCDF4.default_fillvals["f4"])
+
+# Shared NetCDF output settings for the rain (Dataset) and wind (owi2wind.OwiNetcdf) writers
+#
+# chunking picks the chunk shape of the (time, latitude, longitude) variables:
+#   "default"    netCDF library default, one time slice per chunk
+#   "slice"      one full time slice per chunk, fastest for map reads
+#   "timeseries" chunkTime steps of chunkTile x chunkTile spatial tiles, fastest for point time series reads
+#   "T,Y,X"      explicit chunk shape
+# bufferSize is the number of time steps held in memory before they are written in one hyperslab.
+# For timeseries chunking it should match chunkTime, otherwise every chunk is compressed chunkTime times.
+# packed stores the gridded variables as int16 with CF scale_factor and add_offset covering the physical range
+# each writer declares for the variable. Values outside the range are clipped with a warning.
+# psfc sets how owi2wind.OwiNetcdf stores the PSFC variable:
+#   "full"  written like the wind
+#   "fill"  kept for the OWI-NWS13 format but never written, so it reads as the fill value and stores no chunks
+#   "skip"  left out of the file
+# store picks the output backend (see OutputStore):
+#   "netcdf"     the NetCDF file is written directly
+#   "directory"  time steps go to chunk files in <filename>.chunks that parallel writers fill without locking,
+#                OutputStore.consolidate writes the NetCDF file from them
+class OutputOptions:
+    CHUNKINGS = ["default", "slice", "timeseries"]
+    PSFC_MODES = ["full", "fill", "skip"]
+    STORES = ["netcdf", "directory"]
+
+    def __init__(self, chunking="default", chunkTime=24, chunkTile=32, complevel=2, shuffle=True, leastSignificantDigit=None, bufferSize=1, packed=False, psfc="full", store="netcdf"):
+        if(chunking not in OutputOptions.CHUNKINGS and len(OutputOptions.parseChunkShape(chunking)) != 3):
+            raise RuntimeError("Invalid chunking " + str(chunking) + ", must be one of " + ", ".join(OutputOptions.CHUNKINGS) + " or T,Y,X")
+        if(complevel < 0 or complevel > 9):
+            raise RuntimeError("Compression level must be between 0 and 9")
+        if(bufferSize < 1):
+            raise RuntimeError("Write buffer size must be at least 1")
+        if(psfc not in OutputOptions.PSFC_MODES):
+            raise RuntimeError("Invalid PSFC mode " + str(psfc) + ", must be one of " + ", ".join(OutputOptions.PSFC_MODES))
+        if(store not in OutputOptions.STORES):
+            raise RuntimeError("Invalid output store " + str(store) + ", must be one of " + ", ".join(OutputOptions.STORES))
+        self.chunking = chunking
+        self.chunkTime = chunkTime
+        self.chunkTile = chunkTile
+        self.complevel = complevel
+        self.shuffle = shuffle
+        self.leastSignificantDigit = leastSignificantDigit
+        self.bufferSize = bufferSize
+        self.packed = packed
+        self.psfc = psfc
+        self.store = store
+
+    @staticmethod
+    def parseChunkShape(chunking):
+        try:
+            return tuple(int(size) for size in chunking.split(","))
+        except ValueError:
+            return ()
+
+    def chunkShape(self, numLats, numLons):
+        if(self.chunking == "default"):
+            return None
+        if(self.chunking == "slice"):
+            return (1, numLats, numLons)
+        if(self.chunking == "timeseries"):
+            return (self.chunkTime, min(self.chunkTile, numLats), min(self.chunkTile, numLons))
+        chunkTime, chunkLats, chunkLons = OutputOptions.parseChunkShape(self.chunking)
+        return (chunkTime, min(chunkLats, numLats), min(chunkLons, numLons))
+
+    # Keyword arguments for createVariable of 1-D coordinate variables
+    def coordinateArguments(self):
+        return {"zlib": self.complevel > 0, "complevel": self.complevel, "shuffle": self.shuffle}
+
+    # Keyword arguments for createVariable of (time, latitude, longitude) variables
+    def gridArguments(self, numLats, numLons, quantize=True):
+        arguments = self.coordinateArguments()
+        arguments["chunksizes"] = self.chunkShape(numLats, numLons)
+        if(quantize and self.leastSignificantDigit is not None):
+            arguments["least_significant_digit"] = self.leastSignificantDigit
+        return arguments
+
+    # Creates a (time, latitude, longitude) variable whose values lie in validRange (minimum, maximum),
+    # as f4 or, when packed, as int16 with the scale_factor and add_offset mapping validRange onto the int16 range.
+    # Other dimensions ending in latitude, longitude get chunks of one full spatial tile per leading index.
+    def createGridVariable(self, dataset, name, numLats, numLons, validRange, dimensions=("time", "latitude", "longitude")):
+        arguments = self.gridArguments(numLats, numLons, quantize=not self.packed)
+        if(tuple(dimensions) != ("time", "latitude", "longitude") and arguments["chunksizes"] is not None):
+            arguments["chunksizes"] = (1,) * (len(dimensions) - 2) + arguments["chunksizes"][1:]
+        if(not self.packed):
+            return dataset.createVariable(name, "f4", dimensions, **arguments, fill_value=netCDF4.default_fillvals["f4"])
+        variable = dataset.createVariable(name, "i2", dimensions, **arguments, fill_value=PACKED_FILL)
+        variable.scale_factor, variable.add_offset = OutputOptions.packing(validRange)
+        return variable
+
+    # (scale_factor, add_offset) mapping validRange onto the packed int16 range
+    @staticmethod
+    def packing(validRange):
+        scaleFactor = (validRange[1] - validRange[0]) / float(PACKED_MAX - PACKED_MIN)
+        return np.float32(scaleFactor), np.float32(validRange[0] - PACKED_MIN * scaleFactor)
+
+    # values as they read back from the variable createGridVariable creates for validRange: when packed, rounded
+    # to the int16 steps the way netCDF4 packs them, with NaN where nothing is stored
+    def storedValues(self, values, validRange):
+        if(not self.packed):
+            return values
+        scaleFactor, addOffset = OutputOptions.packing(validRange)
+        values = np.ma.masked_invalid(values)
+        values = np.ma.masked_where(values >= FLOAT_FILL, values)
+        values = np.ma.clip(values, addOffset + PACKED_MIN * float(scaleFactor), addOffset + PACKED_MAX * float(scaleFactor))
+        packed = np.ma.filled(np.around((values - addOffset) / scaleFactor), PACKED_FILL).astype(np.int16)
+        return np.where(packed == PACKED_FILL, np.float32(np.nan), packed * scaleFactor + addOffset)
+
+    # Values ready to be assigned to variable. For a packed variable, NaN and float fill values become masked
+    # and the rest are clipped to the packed range, which netCDF4 would otherwise wrap around. Clipped values
+    # are reported, as they usually mean the input is not in the units the variable was packed for.
+    @staticmethod
+    def packValues(variable, values):
+        if(variable.dtype != np.int16 or not hasattr(variable, "scale_factor")):
+            return values
+        values = np.ma.masked_invalid(values)
+        values = np.ma.masked_where(values >= FLOAT_FILL, values)
+        minimum, maximum = OutputOptions.packedRange(variable)
+        outside = np.ma.filled((values < minimum) | (values > maximum), False)
+        if(outside.any()):
+            LOGGER.warning("%d values of %s outside its packed range %g to %g were clipped, values span %g to %g",
+                           np.count_nonzero(outside), variable.name, minimum, maximum, float(values.min()), float(values.max()))
+        return np.ma.clip(values, minimum, maximum)
+
+    # (minimum, maximum) physical values a packed variable can hold
+    @staticmethod
+    def packedRange(variable):
+        scaleFactor = float(variable.scale_factor)
+        addOffset = float(variable.add_offset)
+        return (addOffset + PACKED_MIN * scaleFactor, addOffset + PACKED_MAX * scaleFactor)
+
+    @staticmethod
+    def addArguments(parser):
+        parser.add_argument("--chunking", type=str, default="default",
+                            help="NetCDF chunk shape: default, slice, timeseries or T,Y,X. Default: default")
+        parser.add_argument("--chunk-time", type=int, default=24,
+                            help="Time steps per chunk for timeseries chunking. Default: 24")
+        parser.add_argument("--chunk-tile", type=int, default=32,
+                            help="Spatial tile size for timeseries chunking. Default: 32")
+        parser.add_argument("--complevel", type=int, default=2, help="zlib compression level, 0 disables compression. Default: 2")
+        parser.add_argument("--no-shuffle", action="store_true", help="Disable the HDF5 shuffle filter")
+        parser.add_argument("--least-significant-digit", type=int, default=None,
+                            help="Quantize gridded variables to this many decimal digits before compression. Default: None")
+        parser.add_argument("--write-buffer", type=int, default=None,
+                            help="Time steps buffered before each write. Default: chunk time for timeseries chunking, otherwise 1")
+        parser.add_argument("--packed", action="store_true",
+                            help="Store gridded variables as int16 with scale_factor and add_offset instead of f4")
+        parser.add_argument("--psfc", type=str, choices=OutputOptions.PSFC_MODES, default="full",
+                            help="Wind PSFC variable: full, fill (present but never written) or skip (left out). Default: full")
+        parser.add_argument("--store", type=str, choices=OutputOptions.STORES, default="netcdf",
+                            help="Output backend: netcdf writes the file directly, directory writes time chunks to <file>.chunks "
+                                 "for python OutputStore.py <file>.chunks to consolidate. Default: netcdf")
+
+    @staticmethod
+    def fromArguments(args):
+        bufferSize = args.write_buffer
+        if(bufferSize is None):
+            bufferSize = args.chunk_time if args.chunking == "timeseries" else 1
+        return OutputOptions(chunking=args.chunking, chunkTime=args.chunk_time, chunkTile=args.chunk_tile, complevel=args.complevel,
+                             shuffle=not args.no_shuffle, leastSignificantDigit=args.least_significant_digit, bufferSize=bufferSize,
+                             packed=args.packed, psfc=args.psfc, store=args.store)
+
+
+# Collects consecutive time steps and hands them to write(startIndex, columns) as stacked arrays,
+# one per value of the appended rows, once size steps are held or flush() is called.
+class WriteBuffer:
+    def __init__(self, size, write):
+        self.size = size
+        self.write = write
+        self.startIndex = None
+        self.rows = []
+
+    def append(self, index, row):
+        if(self.rows and index != self.startIndex + len(self.rows)):
+            self.flush()
+        if(not self.rows):
+            self.startIndex = index
+        self.rows.append(row)
+        if(len(self.rows) >= self.size):
+            self.flush()
+
+    def flush(self):
+        if(not self.rows):
+            return
+        columns = [np.stack(column) for column in zip(*self.rows)]
+        startIndex = self.startIndex
+        self.rows = []
+        self.startIndex = None
+        self.write(startIndex, columns)
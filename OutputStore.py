@@ -0,0 +1,201 @@
+import argparse
+import json
+import os
+import re
+import shutil
+import sys
+
+import netCDF4
+import numpy as np
+
+from OutputOptions import OutputOptions
+
+
+# Output backends of the rain (Dataset) and wind (owi2wind.OwiNetcdf) writers, picked by OutputOptions.store.
+# A writer defines its dimensions, variables, attributes and coordinates on store.dataset, calls commit(),
+# then hands blocks of consecutive time steps to write(index, values) as {variable name: values}. Variables
+# without a time dimension, such as swath summaries, are written once with writeSummary(values) before close().
+#
+#   "netcdf"     NetcdfStore writes into the final NetCDF file through a single handle
+#   "directory"  DirectoryStore keeps the NetCDF file without any time steps as a template and writes every
+#                block to its own chunk file in <filename>.chunks:
+#                    template.nc                   dimensions, variables, attributes and coordinates
+#                    index.json                    name of the consolidated file and its time step variables
+#                    chunk_<start>_<end>.npz       time steps start to end - 1 of every time step variable
+#                    summary.npz                   variables without a time dimension written by writeSummary
+#                Chunk files are written under a temporary name and renamed into place, and no two blocks share
+#                a file, so any number of processes can write to the store at once without locking.
+#                consolidate() copies the template and writes the chunks into it in time order, giving the same
+#                file the netcdf store writes.
+
+CHUNK_PATTERN = re.compile(r"^chunk_(\d+)_(\d+)\.npz$")
+TEMPLATE_FILENAME = "template.nc"
+INDEX_FILENAME = "index.json"
+SUMMARY_FILENAME = "summary.npz"
+STORE_VERSION = 1
+
+
+def createStore(filename, outputOptions):
+    if(outputOptions.store == "directory"):
+        return DirectoryStore.create(filename)
+    return NetcdfStore(filename)
+
+
+class NetcdfStore:
+    # Workers other than the process holding the handle cannot write
+    concurrent = False
+
+    def __init__(self, filename, mode="w"):
+        self.filename = filename
+        self.dataset = netCDF4.Dataset(filename, mode)
+
+    def commit(self):
+        pass
+
+    def write(self, index, values):
+        for name, value in values.items():
+            variable = self.dataset[name]
+            variable[index:index + len(value)] = OutputOptions.packValues(variable, value)
+
+    def writeSummary(self, values):
+        for name, value in values.items():
+            self.dataset[name][:] = value
+
+    def close(self):
+        self.dataset.close()
+
+    def size(self):
+        return os.path.getsize(self.filename)
+
+
+class DirectoryStore:
+    concurrent = True
+
+    def __init__(self, directory):
+        self.directory = directory
+        self.filename = None
+        self.dataset = None
+
+    # <filename>.chunks for the output file filename
+    @staticmethod
+    def directoryFor(filename):
+        return filename + ".chunks"
+
+    # New store for filename, replacing the chunks of an earlier run. store.dataset is the open template.
+    @staticmethod
+    def create(filename):
+        directory = DirectoryStore.directoryFor(filename)
+        if(os.path.isdir(directory)):
+            shutil.rmtree(directory)
+        os.makedirs(directory)
+        store = DirectoryStore(directory)
+        store.filename = os.path.basename(filename)
+        store.dataset = netCDF4.Dataset(os.path.join(directory, TEMPLATE_FILENAME), "w")
+        return store
+
+    # Closes the template and records the variables along the unlimited time dimension
+    def commit(self):
+        timeVariables = [name for name, variable in self.dataset.variables.items() if "time" in variable.dimensions]
+        self.dataset.close()
+        self.dataset = None
+        index = {"version": STORE_VERSION, "filename": self.filename, "variables": timeVariables}
+        writeAtomically(os.path.join(self.directory, INDEX_FILENAME), lambda f: f.write(json.dumps(index, indent=2).encode()))
+
+    def write(self, index, values):
+        numTimes = len(next(iter(values.values())))
+        arrays = {name: np.asarray(value) for name, value in values.items()}
+        chunk = os.path.join(self.directory, "chunk_{:08d}_{:08d}.npz".format(index, index + numTimes))
+        writeAtomically(chunk, lambda f: np.savez(f, **arrays))
+
+    def writeSummary(self, values):
+        arrays = {name: np.asarray(value) for name, value in values.items()}
+        writeAtomically(os.path.join(self.directory, SUMMARY_FILENAME), lambda f: np.savez(f, **arrays))
+
+    def close(self):
+        if(self.dataset is not None):
+            self.commit()
+
+    def size(self):
+        return sum(os.path.getsize(os.path.join(self.directory, name)) for name in os.listdir(self.directory))
+
+    def index(self):
+        try:
+            with open(os.path.join(self.directory, INDEX_FILENAME)) as f:
+                index = json.load(f)
+        except (OSError, ValueError):
+            raise RuntimeError(self.directory + " is not a chunk store")
+        if(index.get("version") != STORE_VERSION):
+            raise RuntimeError("Chunk store " + self.directory + " was written by an incompatible version")
+        return index
+
+    # (start, end, path) of every chunk in time order, raises RuntimeError on overlapping chunks or missing time steps
+    def chunks(self):
+        chunks = []
+        for name in os.listdir(self.directory):
+            match = CHUNK_PATTERN.match(name)
+            if(match):
+                chunks.append((int(match.group(1)), int(match.group(2)), os.path.join(self.directory, name)))
+        chunks.sort()
+        end = 0
+        for chunkStart, chunkEnd, path in chunks:
+            if(chunkStart < end):
+                raise RuntimeError("Chunk " + os.path.basename(path) + " overlaps time steps written by another chunk")
+            if(chunkStart > end):
+                raise RuntimeError("Chunk store " + self.directory + " is missing time steps " + str(end) + " to " + str(chunkStart - 1))
+            end = chunkEnd
+        return chunks
+
+
+# Writes through a temporary file renamed into place, so readers never see a partial file
+def writeAtomically(filename, write):
+    temporary = filename + ".{:d}.tmp".format(os.getpid())
+    with open(temporary, "wb") as f:
+        write(f)
+    os.replace(temporary, filename)
+
+
+# Writes the NetCDF file of a directory store, by default next to the store under the name the writer was given.
+# Returns the filename and the number of time steps.
+def consolidate(directory, filename=None):
+    store = DirectoryStore(directory)
+    index = store.index()
+    chunks = store.chunks()
+    if(filename is None):
+        filename = os.path.join(os.path.dirname(os.path.abspath(directory)), index["filename"])
+    temporary = filename + ".{:d}.tmp".format(os.getpid())
+    shutil.copyfile(os.path.join(directory, TEMPLATE_FILENAME), temporary)
+    try:
+        with netCDF4.Dataset(temporary, "a") as dataset:
+            for chunkStart, chunkEnd, path in chunks:
+                with np.load(path) as values:
+                    for name in values.files:
+                        variable = dataset[name]
+                        variable[chunkStart:chunkEnd] = OutputOptions.packValues(variable, values[name])
+            summary = os.path.join(directory, SUMMARY_FILENAME)
+            if(os.path.exists(summary)):
+                with np.load(summary) as values:
+                    for name in values.files:
+                        dataset[name][:] = values[name]
+    except BaseException:
+        os.remove(temporary)
+        raise
+    os.replace(temporary, filename)
+    return filename, chunks[-1][1] if chunks else 0
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Consolidate a chunked directory store into its NetCDF file")
+    parser.add_argument("directory", type=str, help="Chunk store directory, <output filename>.chunks")
+    parser.add_argument("-o", "--output", type=str, default=None,
+                        help="NetCDF file to write. Default: the output filename the store was written for, next to the store")
+    args = parser.parse_args()
+    try:
+        filename, numTimes = consolidate(args.directory, args.output)
+    except Exception as e:
+        print(f"An error occurred: {e}", file=sys.stderr)
+        sys.exit(1)
+    print("Wrote", numTimes, "time steps to", filename)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,108 @@
+import contextlib
+import datetime
+import json
+import resource
+import time
+
+
+# Stage level profiling shared by generator.py and owi2wind.py. Code marks its work with
+#     with Profiler.stage("rain compute", index):
+# and adds the bytes it reads and writes with Profiler.addBytes. Nothing is recorded until enable() is
+# called, so the hooks cost a function call when profiling is off.
+#
+# For each stage the report holds the wall and CPU time summed over its calls, the number of calls, the
+# bytes read and written, and the peak RSS of the process at the end of the stage (the high water mark
+# reached so far, which includes earlier stages). Calls made with an index also record their wall time per
+# index, the per timestep latency. Work done in worker processes is timed as the wait for its results.
+# Processes that profile themselves, such as the pipeline stages, write their own report and the parent adds
+# it to its own with merge.
+
+STAGES = {}
+TIMESTEPS = {}
+ACTIVE = False
+STARTED = None
+
+
+def enable():
+    global ACTIVE, STARTED
+    ACTIVE = True
+    STARTED = (time.perf_counter(), time.process_time(), datetime.datetime.now().isoformat(timespec="seconds"))
+    STAGES.clear()
+    TIMESTEPS.clear()
+
+
+def enabled():
+    return ACTIVE
+
+
+def stageRecord(name):
+    if(name not in STAGES):
+        STAGES[name] = {"wallSeconds": 0.0, "cpuSeconds": 0.0, "calls": 0, "bytesRead": 0, "bytesWritten": 0, "peakRssMegabytes": 0.0}
+    return STAGES[name]
+
+
+def peakRssMegabytes():
+#     ru_maxrss is in kB on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0
+
+
+@contextlib.contextmanager
+def timedStage(name, index):
+    wallStart = time.perf_counter()
+    cpuStart = time.process_time()
+    try:
+        yield
+    finally:
+        wall = time.perf_counter() - wallStart
+        record = stageRecord(name)
+        record["wallSeconds"] += wall
+        record["cpuSeconds"] += time.process_time() - cpuStart
+        record["calls"] += 1
+        record["peakRssMegabytes"] = max(record["peakRssMegabytes"], peakRssMegabytes())
+        if(index is not None):
+            TIMESTEPS.setdefault(name, []).append({"index": int(index), "wallSeconds": wall})
+
+
+def stage(name, index=None):
+    if(not ACTIVE):
+        return contextlib.nullcontext()
+    return timedStage(name, index)
+
+
+def addBytes(name, read=0, written=0):
+    if(not ACTIVE):
+        return
+    record = stageRecord(name)
+    record["bytesRead"] += int(read)
+    record["bytesWritten"] += int(written)
+
+
+def report(command=None):
+    wallStart, cpuStart, date = STARTED
+    return {
+        "command": command,
+        "date": date,
+        "wallSeconds": time.perf_counter() - wallStart,
+        "cpuSeconds": time.process_time() - cpuStart,
+        "peakRssMegabytes": peakRssMegabytes(),
+        "stages": STAGES,
+        "timesteps": TIMESTEPS,
+    }
+
+
+def write(filename, command=None):
+    with open(filename, "w") as f:
+        json.dump(report(command), f, indent=2)
+    print("Profile written to", filename)
+
+
+# Adds the stages and timesteps of a report written by another process, their names prefixed with prefix
+def merge(filename, prefix):
+    with open(filename) as f:
+        other = json.load(f)
+    for name, values in other["stages"].items():
+        record = stageRecord(prefix + name)
+        for key, value in values.items():
+            record[key] = max(record[key], value) if key == "peakRssMegabytes" else record[key] + value
+    for name, timesteps in other["timesteps"].items():
+        TIMESTEPS.setdefault(prefix + name, []).extend(timesteps)
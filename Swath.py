@@ -0,0 +1,96 @@
+import netCDF4
+import numpy as np
+
+# Running storm swaths of a gridded variable, updated from each block of time steps as it is written so the
+# summaries need no second pass over the file:
+#     maximum       largest value reached at each point
+#     maximumTime   time of that maximum, the first time it was reached, in minutes since 1990-01-01
+#     total         sum of the values times stepHours, the storm total of a rate (only when total=True)
+# NaN and fill values are skipped. Points that never held a value stay masked.
+# The total is summed slice by slice in float64 with the rounding error of every addition kept in totalError
+# (Neumaier summation). The float32 slices then add up exactly, so the total does not depend on how the slices
+# were split into blocks, workers or shards. It is rounded to float32 only by values().
+
+FLOAT_FILL = np.float32(netCDF4.default_fillvals["f4"])
+TIME_FILL = netCDF4.default_fillvals["i4"]
+TIME_UNITS = "minutes since 1990-01-01 00:00:00 Z"
+
+
+class Swath:
+    def __init__(self, shape, total=False, stepHours=1.0):
+        self.maximum = np.full(shape, -np.inf, dtype=np.float32)
+        self.maximumTime = np.full(shape, TIME_FILL, dtype=np.int32)
+        self.total = np.zeros(shape, dtype=np.float64) if total else None
+        self.totalError = np.zeros(shape, dtype=np.float64) if total else None
+        self.stepHours = stepHours
+
+    # minutes (time) and values (time, lat, lon) of a block of time steps
+    def update(self, minutes, values):
+        values = np.asarray(values, dtype=np.float32)
+        valid = np.isfinite(values) & (values < FLOAT_FILL)
+        values = np.where(valid, values, np.float32(-np.inf))
+        latest = np.argmax(values, axis=0)
+        blockMaximum = np.take_along_axis(values, latest[np.newaxis], axis=0)[0]
+        self.combine(blockMaximum, np.asarray(minutes, dtype=np.int32)[latest])
+        if(self.total is not None):
+            for values in np.where(valid, values, np.float32(0.0)):
+                self.addTotal(values.astype(np.float64) * self.stepHours)
+
+    # Folds in the maximum, its time and the total of other time steps, such as a worker's block or another shard
+    def combine(self, maximum, maximumTime, total=None, totalError=None):
+        greater = (maximum > self.maximum) | ((maximum == self.maximum) & (maximumTime < self.maximumTime) & np.isfinite(maximum))
+        self.maximum = np.where(greater, maximum, self.maximum)
+        self.maximumTime = np.where(greater, maximumTime, self.maximumTime)
+        if(self.total is not None and total is not None):
+            self.addTotal(np.asarray(total, dtype=np.float64))
+            if(totalError is not None):
+                self.addTotal(totalError)
+
+    def addTotal(self, values):
+        total = self.total + values
+        self.totalError = self.totalError + np.where(np.abs(self.total) >= np.abs(values), (self.total - total) + values, (values - total) + self.total)
+        self.total = total
+
+    def merge(self, other):
+        self.combine(other.maximum, other.maximumTime, other.total, other.totalError)
+
+    # {name: values} of the swath variables created by createVariables for name
+    def values(self, name):
+        reached = np.isfinite(self.maximum)
+        values = {name + "_max": np.where(reached, self.maximum, FLOAT_FILL), name + "_max_time": np.where(reached, self.maximumTime, TIME_FILL)}
+        if(self.total is not None):
+            values[name + "_total"] = np.where(reached, (self.total + self.totalError).astype(np.float32), FLOAT_FILL)
+        return values
+
+
+# Swath of the (time, latitude, longitude) variable name of an open dataset, read back blockSize time steps at a time
+def read(dataset, name, total=False, blockSize=24):
+    variable = dataset[name]
+    swath = Swath(variable.shape[1:], total=total)
+    for index in range(0, variable.shape[0], blockSize):
+        values = np.ma.filled(variable[index:index + blockSize], np.nan)
+        swath.update(np.ma.filled(dataset["time"][index:index + blockSize], 0).astype(np.int64), values)
+    return swath
+
+
+# Creates the (latitude, longitude) swath variables of name. The CF cell_methods attribute and time_of_maximum_of
+# tell mergeShards how to combine them across shards.
+def createVariables(dataset, name, units, total=False, totalUnits=None, coordinateArguments=None):
+    coordinateArguments = coordinateArguments or {}
+    dimensions = ("latitude", "longitude")
+    maximum = dataset.createVariable(name + "_max", "f4", dimensions, **coordinateArguments, fill_value=FLOAT_FILL)
+    maximum.units = units
+    maximum.long_name = "maximum " + name + " over the storm"
+    maximum.cell_methods = "time: maximum"
+    maximum.coordinates = "lat lon"
+    maximumTime = dataset.createVariable(name + "_max_time", "i4", dimensions, **coordinateArguments, fill_value=TIME_FILL)
+    maximumTime.units = TIME_UNITS
+    maximumTime.long_name = "time of the maximum " + name
+    maximumTime.time_of_maximum_of = name + "_max"
+    maximumTime.coordinates = "lat lon"
+    if(total):
+        stormTotal = dataset.createVariable(name + "_total", "f4", dimensions, **coordinateArguments, fill_value=FLOAT_FILL)
+        stormTotal.units = totalUnits
+        stormTotal.long_name = "storm total " + name
+        stormTotal.cell_methods = "time: sum"
+        stormTotal.coordinates = "lat lon"
@@ -0,0 +1,194 @@
+import csv
+import math
+from datetime import datetime, timedelta
+
+import numpy as np
+
+
+STORM_CLASS_VALUES = ["", "LO", "TD", "TS", "HU"]
+DEFAULT_BACKGROUND_PRESSURE = 1010
+MISSING_SPAN = -999
+
+# Column positions in the ATCF style track file
+FIELD_NUMBER = 1
+FIELD_DATE = 2
+FIELD_HOURS = 5
+FIELD_LATITUDE = 6
+FIELD_LONGITUDE = 7
+FIELD_WIND = 8
+FIELD_PRESSURE = 9
+FIELD_CLASS = 10
+FIELD_SPANS = slice(13, 17)
+FIELD_RADIUS = 19
+FIELD_NAME = 27
+
+# One record per unique forecast time
+# Radii are km, winds are knots (maxWindSpeedKnots) and m/s (maxWindSpeed), pressures are mbar
+# span34 and span50 are the NE, SE, NW, SW radii of 34 and 50 knot winds, MISSING_SPAN when not given
+TRACK_DTYPE = np.dtype([
+    ("time", "datetime64[s]"),
+    ("deltaHours", "i8"),
+    ("latitude", "f8"),
+    ("longitude", "f8"),
+    ("latitudeString", "U8"),
+    ("longitudeString", "U8"),
+    ("centralPressure", "i4"),
+    ("backgroundPressure", "i4"),
+    ("radiusMaxWind", "f8"),
+    ("radiusClosure", "f8"),
+    ("maxWindSpeedKnots", "f8"),
+    ("maxWindSpeed", "f8"),
+    ("heading", "f8"),
+    ("span34", "f8", (4,)),
+    ("span50", "f8", (4,)),
+])
+
+
+class Track:
+    def __init__(self, records, stormName, stormClass, stormNumber):
+        self.records = records
+        self.stormName = stormName
+        self.stormClass = stormClass
+        self.stormNumber = stormNumber
+
+    def __len__(self):
+        return len(self.records)
+
+    def __getitem__(self, field):
+        return self.records[field]
+
+    def times(self):
+        return self.records["time"].tolist()
+
+    def startTime(self):
+        return self.records["time"][0].tolist()
+
+
+def vectorDirection(x,y):
+    degrees = math.degrees(math.atan2(x,y))
+    if(degrees < 0):
+        return degrees + 360
+    return degrees
+
+def findHeading(previousLatitude, latitude, deltaLongitude):
+    latitude = math.radians(latitude)
+    previousLatitude = math.radians(previousLatitude)
+    deltaLongitude = math.radians(deltaLongitude)
+    x = math.cos(latitude) * math.sin(deltaLongitude)
+    y = math.cos(previousLatitude) * math.sin(latitude)
+    y = y - (math.sin(previousLatitude) * math.cos(latitude) * math.cos(deltaLongitude))
+    return vectorDirection(x, y)
+
+def convertLongitude(longitudeString):
+    longitude = float(longitudeString[0:-1])/10
+    if (longitudeString[-1] == "W"):
+        longitude = longitude * -1.0
+    return longitude
+
+def convertLatitude(latitudeString):
+    latitude = float(latitudeString[0:-1])/10
+    if (latitudeString[-1] == "S"):
+        latitude = latitude * -1.0
+    return latitude
+
+def calculateRadiusOfMaxWind(latitudeString, pressure, background):
+    pressure = float(pressure)
+    background = float(background)
+    background = 1014
+    latitude = convertLatitude(latitudeString)
+    deltaPressure = background - pressure
+#         % if not specified - calculated %Rmax = exp(2.636 - ((0.00005086 * (dP ^ 2)) + 0.0394899 * latitude))
+    radiusOfMaxWind = (0.00005086 * (deltaPressure**2))
+    radiusOfMaxWind = 2.636 - radiusOfMaxWind + 0.0394899 * latitude
+    radiusOfMaxWind = math.exp(radiusOfMaxWind)
+    return radiusOfMaxWind
+
+
+#     Convert nautical mile wind radii to km, zero meaning not given
+def convertSpans(row):
+    spans = []
+    for span in row[FIELD_SPANS]:
+        span = float(span.strip()) * 1.852
+        if(span == 0):
+            span = MISSING_SPAN
+        spans.append(span)
+    return spans
+
+
+def field(row, index):
+    if(index < len(row)):
+        return row[index]
+    return None
+
+
+# Headings are the bearing from the first fix to the next fix, the last heading repeats the one before it
+def calculateHeadings(latitudes, longitudes):
+    if(len(latitudes) < 2):
+        return [0.0] * len(latitudes)
+    headings = [findHeading(latitudes[0], latitude, longitude - longitudes[0]) for latitude, longitude in zip(latitudes[1:], longitudes[1:])]
+    headings.append(headings[-1])
+    return headings
+
+
+# Reads an ATCF style track file in one pass. Rows repeating a forecast time (the 50 and 64 knot
+# radii rows) are dropped with a hashed lookup, except that the 50 knot radii are taken from the
+# row right after the first row of a time.
+def readTrack(filename):
+    stormName = ""
+    stormClass = ""
+    stormNumber = ""
+    seenTimes = set()
+    rows = []
+    spans50 = []
+    catchLargeStormSpan = False
+    with open(filename, newline="") as trackFile:
+        for row in csv.reader(trackFile):
+            if(not row):
+                continue
+            dateStr = row[FIELD_DATE].strip()
+            hours = int(row[FIELD_HOURS].strip())
+            time = datetime(year=int(dateStr[0:4]), month=int(dateStr[4:6]), day=int(dateStr[6:8]), hour=int(dateStr[8:10])) + timedelta(hours=hours)
+            if(catchLargeStormSpan):
+                if(time == rows[-1][0]):
+                    spans50.append(convertSpans(row))
+                else:
+                    spans50.append([MISSING_SPAN] * 4)
+                catchLargeStormSpan = False
+            if(time in seenTimes):
+                continue
+            seenTimes.add(time)
+
+            name = field(row, FIELD_NAME)
+#             Remove "0" and "NA" names
+            if(name is not None and len(name.strip()) > 2):
+                stormName = name.strip()
+            currentStormClass = field(row, FIELD_CLASS)
+            if(currentStormClass is not None):
+                currentStormClass = currentStormClass.strip()
+                if(len(currentStormClass) > 0 and currentStormClass in STORM_CLASS_VALUES):
+                    if(STORM_CLASS_VALUES.index(currentStormClass) > STORM_CLASS_VALUES.index(stormClass)):
+                        stormClass = currentStormClass
+            stormNumber = row[FIELD_NUMBER].strip()
+
+            radiusOfMaxWind = float(row[FIELD_RADIUS].strip()) * 1.852
+#             Calculate both radius of max wind and closure radius, instead of relying on track values
+            if(radiusOfMaxWind == 0):
+                radiusOfMaxWind = calculateRadiusOfMaxWind(row[FIELD_LATITUDE], row[FIELD_PRESSURE], DEFAULT_BACKGROUND_PRESSURE)
+#             closure radius is max wind times 20
+            closureRadius = radiusOfMaxWind * 20
+#             Comes in as knots
+            maxWindSpeedKnots = float(row[FIELD_WIND].strip())
+            rows.append((time, hours, convertLatitude(row[FIELD_LATITUDE]), convertLongitude(row[FIELD_LONGITUDE]),
+                         row[FIELD_LATITUDE].strip(), row[FIELD_LONGITUDE].strip(), int(row[FIELD_PRESSURE].strip()),
+                         DEFAULT_BACKGROUND_PRESSURE, round(radiusOfMaxWind, 4), closureRadius, maxWindSpeedKnots,
+                         maxWindSpeedKnots * 0.514444, 0.0, convertSpans(row), None))
+            catchLargeStormSpan = True
+    if(catchLargeStormSpan):
+        spans50.append([MISSING_SPAN] * 4)
+
+    records = np.zeros(len(rows), dtype=TRACK_DTYPE)
+    for index, name in enumerate(TRACK_DTYPE.names[:-1]):
+        records[name] = [row[index] for row in rows]
+    records["span50"] = spans50
+    records["heading"] = calculateHeadings(records["latitude"].tolist(), records["longitude"].tolist())
+    return Track(records, stormName, stormClass, stormNumber)
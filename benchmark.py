@@ -0,0 +1,295 @@
+import argparse
+import contextlib
+import datetime
+import json
+import math
+import multiprocessing
+import os
+import platform
+import resource
+import subprocess
+import tempfile
+import time
+
+import numpy as np
+
+import generateParametricInput
+import generateParametricRain
+import generateParametricWind
+import owi2wind
+import Track
+
+
+# Benchmarks each stage of the pipeline on synthetic inputs:
+#   trackParse    Track.readTrack on a synthetic ATCF .trk file
+#   rain          generateParametricRain.main writing RICHAMP_rain.nc
+#   trackWriters  TrackRMW.txt, Wind_Inp.txt and track.richamp writers
+#   parametricWind  generateParametricWind.main writing RICHAMP_wind.nc in process
+#   owi306        owi2wind conversion of a synthetic richamp.wnd
+#   owiNws12      owi2wind conversion of a synthetic OWI pre/win pair
+# Every stage runs in a freshly spawned process so wall time, CPU time and peak RSS are its own.
+# Results are saved as JSON so runs can be compared across commits with --compare.
+
+STAGES = ["trackParse", "rain", "trackWriters", "parametricWind", "owi306", "owiNws12"]
+START_DATE = datetime.datetime(2023, 9, 14, 0, 0, 0)
+
+
+def writeSyntheticTrack(filename, hours, interval=6):
+    with open(filename, "w") as f:
+        for tau in range(0, hours + 1, interval):
+            fraction = tau / max(hours, 1)
+            latitude = round(150 + 350 * fraction)
+            longitude = round(450 + 300 * fraction)
+            wind = round(35 + 90 * math.sin(math.pi * fraction))
+            pressure = round(1008 - 0.9 * (wind - 30))
+            stormClass = "HU" if wind >= 64 else "TS"
+            for threshold, radii in ((34, (180, 170, 120, 130)), (50, (90, 80, 60, 70))):
+                f.write("AL, 13, {:s},   , OFCL, {:3d}, {:3d}N, {:4d}W, {:3d}, {:4d}, {:s}, {:3d}, NEQ, {:4d}, {:4d}, {:4d}, {:4d}, 1013,     , {:3d},     ,    ,    ,    ,    ,  0,   8,     SYNTHETIC,   1,    3\n".format(
+                    START_DATE.strftime("%Y%m%d%H"), tau, latitude, longitude, wind, pressure, stormClass, threshold,
+                    radii[0], radii[1], radii[2], radii[3], 20 + round(20 * fraction)))
+
+
+def syntheticWind(latitudes, longitudes, index):
+    latitudeGrid, longitudeGrid = np.meshgrid(latitudes, longitudes, indexing="ij")
+    centerLatitude = latitudes[0] + (latitudes[-1] - latitudes[0]) * (0.3 + 0.01 * index)
+    centerLongitude = longitudes[0] + (longitudes[-1] - longitudes[0]) * (0.3 + 0.01 * index)
+    dx = longitudeGrid - centerLongitude
+    dy = latitudeGrid - centerLatitude
+    r = np.hypot(dx, dy) + 0.05
+    speed = 40.0 * r * np.exp(1.0 - r)
+    return -speed * dy / r, speed * dx / r, 101000.0 - 5000.0 * np.exp(-r)
+
+
+def writeSynthetic306(windFilename, inputFilename, hours, gridSize, resolution):
+    minLatitude, minLongitude = 20.0, -80.0
+    with open(inputFilename, "w") as f:
+        f.write("richamp\n3\n")
+        f.write(START_DATE.strftime("%Y %m %d %H %M %S") + "\n")
+        f.write("1.0\n")
+        f.write(str(hours) + "\n")
+        f.write(str(minLongitude) + " " + str(minLongitude + gridSize) + "\n")
+        f.write(str(minLatitude) + " " + str(minLatitude + gridSize) + "\n")
+        f.write(str(float(resolution)) + "\n")
+    numPoints = int(gridSize * resolution + 1)
+    latitudes = np.linspace(minLatitude, minLatitude + gridSize, numPoints)
+    longitudes = np.linspace(minLongitude, minLongitude + gridSize, numPoints)
+    recordFormat = "%10.3f%10.3f%10.2f\n" * (numPoints * numPoints)
+    with open(windFilename, "w") as f:
+        for index in range(hours):
+            u, v, p = syntheticWind(latitudes, longitudes, index)
+#             Rows run north to south in 306 files
+            records = np.stack([u, v, p], axis=-1)[::-1]
+            f.write(recordFormat % tuple(records.ravel()))
+
+
+def owiBlock(values):
+    lines = []
+    for start in range(0, len(values), 8):
+        lines.append(("%10.4f" * len(values[start:start + 8])) % tuple(values[start:start + 8]) + "\n")
+    return "".join(lines)
+
+
+def writeSyntheticNws12(preFilename, winFilename, hours, gridSize, resolution):
+    minLatitude, minLongitude = 20.0, -80.0
+    numPoints = int(gridSize * resolution + 1)
+    step = 1.0 / resolution
+    latitudes = np.linspace(minLatitude, minLatitude + gridSize, numPoints)
+    longitudes = np.linspace(minLongitude, minLongitude + gridSize, numPoints)
+    endDate = START_DATE + datetime.timedelta(hours=hours)
+    fileHeader = "Oceanweather WIN/PRE Format                            {:s}     {:s}\n".format(
+        START_DATE.strftime("%Y%m%d%H"), endDate.strftime("%Y%m%d%H"))
+    with open(preFilename, "w") as pre, open(winFilename, "w") as win:
+        pre.write(fileHeader)
+        win.write(fileHeader)
+        for index in range(hours):
+            date = START_DATE + datetime.timedelta(hours=index)
+            header = "iLat={:4d}iLong={:4d}DX={:6.4f}DY={:6.4f}SWLat={:8.5f}SWLon={:8.4f}DT={:s}\n".format(
+                numPoints, numPoints, step, step, minLatitude, minLongitude, date.strftime("%Y%m%d%H%M"))
+            u, v, p = syntheticWind(latitudes, longitudes, index)
+            pre.write(header)
+            pre.write(owiBlock(p.ravel() / 100.0))
+            win.write(header)
+            win.write(owiBlock(u.ravel()))
+            win.write(owiBlock(v.ravel()))
+
+
+def fileSize(*filenames):
+    return sum(os.path.getsize(filename) for filename in filenames if os.path.exists(filename))
+
+
+# Untimed setup of a stage, the stages after parsing get an already parsed track
+def stageSetup(stage, directory):
+    if(stage in ["rain", "trackWriters", "parametricWind"]):
+        return Track.readTrack(os.path.join(directory, "synthetic.trk"))
+    return None
+
+
+# Runs inside the spawned process. Returns the work counters of the stage, timing is done by runStage.
+def stageWork(stage, directory, options, track):
+    trackFilename = os.path.join(directory, "synthetic.trk")
+    if(stage == "trackParse"):
+        Track.readTrack(trackFilename)
+        with open(trackFilename) as f:
+            numRows = sum(1 for line in f)
+        return {"points": numRows, "bytesRead": fileSize(trackFilename), "bytesWritten": 0}
+    if(stage == "rain"):
+        generateParametricRain.main(generateParametricInput.MIN_LATITUDE, generateParametricInput.MIN_LONGITUDE,
+                                    generateParametricInput.MAX_LATITUDE, generateParametricInput.MAX_LONGITUDE,
+                                    generateParametricInput.SPATIAL_RESOLUTION, track.startTime(), track["deltaHours"],
+                                    track["maxWindSpeedKnots"], track["latitude"], track["longitude"],
+                                    batchMemory=options["batchMemory"], workers=options["rainWorkers"])
+        numLats = math.ceil((generateParametricInput.MAX_LATITUDE - generateParametricInput.MIN_LATITUDE) / generateParametricInput.SPATIAL_RESOLUTION) + 1
+        numLons = math.ceil((generateParametricInput.MAX_LONGITUDE - generateParametricInput.MIN_LONGITUDE) / generateParametricInput.SPATIAL_RESOLUTION) + 1
+        numTimes = int(track["deltaHours"].max() - track["deltaHours"].min()) + 1
+        return {"points": numTimes * numLats * numLons, "bytesRead": 0, "bytesWritten": fileSize("RICHAMP_rain.nc")}
+    if(stage == "trackWriters"):
+        generateParametricInput.writeTrackRMW(track)
+        generateParametricInput.writeWindInp(track)
+        generateParametricInput.writeTrackRichamp(track)
+        return {"points": 3 * len(track), "bytesRead": 0,
+                "bytesWritten": fileSize("TrackRMW.txt", "Wind_Inp.txt", "track.richamp")}
+    if(stage == "parametricWind"):
+        generateParametricWind.main(track, generateParametricInput.MIN_LATITUDE, generateParametricInput.MIN_LONGITUDE,
+                                    generateParametricInput.MAX_LATITUDE, generateParametricInput.MAX_LONGITUDE,
+                                    generateParametricInput.WIND_RESOLUTION)
+        grid = generateParametricWind.windGrid(generateParametricInput.MIN_LATITUDE, generateParametricInput.MIN_LONGITUDE,
+                                               generateParametricInput.MAX_LATITUDE, generateParametricInput.MAX_LONGITUDE,
+                                               generateParametricInput.WIND_RESOLUTION)
+        numTimes = int((track["time"][-1] - track["time"][0]) // np.timedelta64(1, "h")) + 1
+        return {"points": numTimes * grid.latitudes.size * grid.longitudes.size, "bytesRead": 0,
+                "bytesWritten": fileSize(generateParametricWind.WIND_FILENAME + ".nc")}
+    if(stage == "owi306"):
+        windFilename = os.path.join(directory, "synthetic.wnd")
+        inputFilename = os.path.join(directory, "synthetic_Wind_Inp.txt")
+        owi2wind.convert([windFilename, inputFilename], "wind306")
+        numPoints = int(options["windGrid"] * options["windResolution"] + 1)
+        return {"points": options["hours"] * numPoints * numPoints, "bytesRead": fileSize(windFilename),
+                "bytesWritten": fileSize("wind306.nc")}
+    if(stage == "owiNws12"):
+        preFilename = os.path.join(directory, "synthetic.221")
+        winFilename = os.path.join(directory, "synthetic.222")
+        owi2wind.convert([preFilename, winFilename], "windNws12")
+        numPoints = int(options["windGrid"] * options["windResolution"] + 1)
+        return {"points": options["hours"] * numPoints * numPoints, "bytesRead": fileSize(preFilename, winFilename),
+                "bytesWritten": fileSize("windNws12.nc")}
+    raise RuntimeError("Unknown benchmark stage " + stage)
+
+
+def runStage(stage, directory, options, results):
+    workDirectory = os.path.join(directory, stage)
+    os.makedirs(workDirectory, exist_ok=True)
+    os.chdir(workDirectory)
+    with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+        track = stageSetup(stage, directory)
+        wallStart = time.perf_counter()
+        cpuStart = time.process_time()
+        work = stageWork(stage, directory, options, track)
+        wall = time.perf_counter() - wallStart
+        cpu = time.process_time() - cpuStart
+#     ru_maxrss is in kB on Linux, rain worker processes are counted through RUSAGE_CHILDREN
+    peakKilobytes = max(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss, resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss)
+    megabytes = (work["bytesRead"] + work["bytesWritten"]) / 1e6
+    results.put({
+        "wallSeconds": wall,
+        "cpuSeconds": cpu,
+        "pointsPerSecond": work["points"] / wall if wall > 0 else None,
+        "megabytesPerSecond": megabytes / wall if wall > 0 else None,
+        "peakRssMegabytes": peakKilobytes / 1024.0,
+        "points": work["points"],
+        "bytesRead": work["bytesRead"],
+        "outputBytes": work["bytesWritten"],
+    })
+
+
+def gitCommit():
+    try:
+        return subprocess.run(["git", "rev-parse", "HEAD"], cwd=os.path.dirname(os.path.abspath(__file__)),
+                              capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run(options):
+    context = multiprocessing.get_context("spawn")
+    report = {
+        "commit": gitCommit(),
+        "date": datetime.datetime.now().isoformat(timespec="seconds"),
+        "python": platform.python_version(),
+        "numpy": np.__version__,
+        "parameters": options,
+        "stages": {},
+    }
+    with tempfile.TemporaryDirectory(dir=options["workDirectory"]) as directory:
+        print("Writing synthetic inputs to", directory)
+        writeSyntheticTrack(os.path.join(directory, "synthetic.trk"), options["hours"], options["trackInterval"])
+        if("owi306" in options["stages"]):
+            writeSynthetic306(os.path.join(directory, "synthetic.wnd"), os.path.join(directory, "synthetic_Wind_Inp.txt"),
+                              options["hours"], options["windGrid"], options["windResolution"])
+        if("owiNws12" in options["stages"]):
+            writeSyntheticNws12(os.path.join(directory, "synthetic.221"), os.path.join(directory, "synthetic.222"),
+                                options["hours"], options["windGrid"], options["windResolution"])
+        for stage in options["stages"]:
+            results = context.Queue()
+            process = context.Process(target=runStage, args=(stage, directory, options, results))
+            process.start()
+            result = results.get()
+            process.join()
+            if(process.exitcode != 0):
+                raise RuntimeError("Benchmark stage " + stage + " failed")
+            report["stages"][stage] = result
+            print("{:<14s} {:9.3f} s wall {:9.3f} s cpu {:14.0f} points/s {:9.2f} MB/s {:9.1f} MB peak {:12d} bytes out".format(
+                stage, result["wallSeconds"], result["cpuSeconds"], result["pointsPerSecond"] or 0.0,
+                result["megabytesPerSecond"] or 0.0, result["peakRssMegabytes"], result["outputBytes"]))
+    return report
+
+
+def compare(report, previousFilename):
+    with open(previousFilename) as f:
+        previous = json.load(f)
+    print("Compared with", previousFilename, "commit", previous.get("commit"))
+    for stage, result in report["stages"].items():
+        if(stage not in previous["stages"]):
+            continue
+        before = previous["stages"][stage]
+        print("{:<14s} wall {:9.3f} s -> {:9.3f} s ({:6.2f}x)  peak {:9.1f} MB -> {:9.1f} MB".format(
+            stage, before["wallSeconds"], result["wallSeconds"], before["wallSeconds"] / result["wallSeconds"],
+            before["peakRssMegabytes"], result["peakRssMegabytes"]))
+
+
+def parseArguments():
+    parser = argparse.ArgumentParser(description="Benchmark the parametric wind and rain pipeline on synthetic inputs")
+    parser.add_argument("--hours", type=int, default=48, help="Length of the synthetic track and wind files in hours. Default: 48")
+    parser.add_argument("--track-interval", type=int, default=6, help="Hours between synthetic track fixes. Default: 6")
+    parser.add_argument("--wind-grid", type=float, default=10.0, help="Size in degrees of the square synthetic wind grid. Default: 10")
+    parser.add_argument("--wind-resolution", type=int, default=12, help="Synthetic wind grid points per degree. Default: 12")
+    parser.add_argument("--rain-workers", type=int, default=1, help="Rain worker processes. Default: 1")
+    parser.add_argument("--batch-memory", type=float, default=None, help="Rain batch memory budget in MB. Default: None")
+    parser.add_argument("--stages", type=str, nargs="+", choices=STAGES, default=STAGES, help="Stages to run. Default: all")
+    parser.add_argument("--work-directory", type=str, default=None, help="Directory for the temporary inputs and outputs. Default: system temp")
+    parser.add_argument("-o", "--output", type=str, default="benchmark.json", help="JSON report. Default: benchmark.json")
+    parser.add_argument("--compare", type=str, default=None, help="Earlier JSON report to compare with")
+    return parser.parse_args()
+
+
+def main():
+    args = parseArguments()
+    options = {
+        "hours": args.hours,
+        "trackInterval": args.track_interval,
+        "windGrid": args.wind_grid,
+        "windResolution": args.wind_resolution,
+        "rainWorkers": args.rain_workers,
+        "batchMemory": args.batch_memory,
+        "stages": args.stages,
+        "workDirectory": os.path.abspath(args.work_directory) if args.work_directory else None,
+    }
+    report = run(options)
+    with open(args.output, "w") as f:
+        json.dump(report, f, indent=2)
+    print("Benchmark report written to", args.output)
+    if(args.compare):
+        compare(report, args.compare)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,8 +1,9 @@
-from datetime import datetime, timedelta
-import csv
-import math
+import os
 
 import generateParametricRain
+import Profiler
+import generateParametricWind
+import Track
 
 # Yr, Mo, Day, Hr, Min, Sec, Central P(mbar), Background P(mbar), Radius of Max Winds (km)
 # 2023 9 1 12 0 0 982 1014 96.1887
@@ -59,252 +60,91 @@ import generateParametricRain
 # Original line, low pressure printed twice
 # NHC A13 URIPWMIN   20230901 1200 95N 0135W 270 1011 1011 1014 0406 10 020 -999 -999 -999 -999 D -999 -999 -999 -999
 
-def vectorDirection(x,y):
-    degrees = math.degrees(math.atan2(x,y))
-    if(degrees < 0):
-        return degrees + 360
-    return degrees
-    
-def findHeading(previousLatitude, latitude, deltaLongitude):
-    latitude = math.radians(latitude)
-    previousLatitude = math.radians(previousLatitude)
-    deltaLongitude = math.radians(deltaLongitude)
-    x = math.cos(latitude) * math.sin(deltaLongitude)
-    y = math.cos(previousLatitude) * math.sin(latitude)
-    y = y - (math.sin(previousLatitude) * math.cos(latitude) * math.cos(deltaLongitude))
-    return vectorDirection(x, y)
-    
-def convertLongitude(longitudeString):
-    longitude = float(longitudeString[0:-1])/10
-    if (longitudeString[-1] == "W"):
-        longitude = longitude * -1.0
-    return longitude
+RAIN_FILENAME = "RICHAMP_rain.nc"
+ENSEMBLE_RAIN_FILENAME = "RICHAMP_rain_ensemble.nc"
+MIN_LATITUDE = 4.0
+MAX_LATITUDE = 51.0
+MIN_LONGITUDE = -101.0
+MAX_LONGITUDE = -49.0
+SPATIAL_RESOLUTION = 1.0/12.0
+# Grid points per degree of the wind grid, the last line of Wind_Inp.txt
+WIND_RESOLUTION = 12.0
+WIND_ENGINES = ["windgfdl", "parametric"]
+
+
+# outputDirectory receives RICHAMP_rain.nc, TrackRMW.txt, Wind_Inp.txt and track.richamp, created if missing
+# windEngine "parametric" also writes RICHAMP_wind.nc with generateParametricWind using the diagParm scale factors,
+# "windgfdl" leaves the wind to the external windgfdl program reading track.richamp and Wind_Inp.txt
+# incremental updates an existing RICHAMP_rain.nc for a new advisory, recomputing only the hours that changed
+# rainCache (generateParametricRain.RainCache) reuses rain slices computed in earlier runs
+# ensemble (generateParametricRain.EnsembleSpec) writes the rain of perturbed member tracks to RICHAMP_rain_ensemble.nc
+# instead of RICHAMP_rain.nc, the windgfdl inputs and parametric wind stay those of the unperturbed track
+# timeRange (mergeShards.TimeRange) only generates those hours of the rain and parametric wind, into shard files
+def main(track, rainMode="vectorized", batchMemory=None, rainWorkers=1, rainCulling=None, outputOptions=None, outputDirectory=".", geometryCache=None, windEngine="windgfdl", diagParm=None, incremental=False, rainCache=None, ensemble=None, timeRange=None):
+    if(windEngine not in WIND_ENGINES):
+        raise RuntimeError("Invalid wind engine " + str(windEngine) + ", must be one of " + ", ".join(WIND_ENGINES))
+    if(ensemble is not None and (incremental or rainCache is not None or timeRange is not None)):
+        raise RuntimeError("Ensemble rain cannot be updated incrementally, cached or split into time ranges")
+    parsedTrack = parseTrack(track)
+    os.makedirs(outputDirectory, exist_ok=True)
+    writeTrackFiles(parsedTrack, outputDirectory)
+    if(ensemble is not None):
+        generateEnsembleRain(parsedTrack, ensemble, outputDirectory, rainMode=rainMode, batchMemory=batchMemory, rainWorkers=rainWorkers, rainCulling=rainCulling, outputOptions=outputOptions, geometryCache=geometryCache)
+    else:
+        generateRain(parsedTrack, outputDirectory, rainMode=rainMode, batchMemory=batchMemory, rainWorkers=rainWorkers, rainCulling=rainCulling, outputOptions=outputOptions, geometryCache=geometryCache, incremental=incremental, rainCache=rainCache, timeRange=timeRange)
+    if(windEngine == "parametric"):
+        generateParametricWind.main(parsedTrack, MIN_LATITUDE, MIN_LONGITUDE, MAX_LATITUDE, MAX_LONGITUDE, WIND_RESOLUTION, diagParm=diagParm, outputOptions=outputOptions, filename=os.path.join(outputDirectory, generateParametricWind.WIND_FILENAME), geometryCache=geometryCache, timeRange=timeRange)
+    return parsedTrack.stormName, parsedTrack.stormClass
+
+
+def parseTrack(track):
+    print("Generating Parametric Wind From track file:", track)
+    with Profiler.stage("track parse"):
+        parsedTrack = Track.readTrack(track)
+    Profiler.addBytes("track parse", read=os.path.getsize(track))
+    print("Storm Name, Storm Class:", parsedTrack.stormName, parsedTrack.stormClass)
+    return parsedTrack
 
-def convertLatitude(latitudeString):
-    latitude = float(latitudeString[0:-1])/10
-    if (latitudeString[-1] == "S"):
-        latitude = latitude * -1.0
-    return latitude
 
-def calculateRadiusOfMaxWind(latitudeString, pressure, background):
-    pressure = float(pressure)
-    background = float(background)
-    background = 1014
-    latitude = convertLatitude(latitudeString)
-    deltaPressure = background - pressure
-#         % if not specified - calculated %Rmax = exp(2.636 - ((0.00005086 * (dP ^ 2)) + 0.0394899 * latitude)) 
-    radiusOfMaxWind = (0.00005086 * (deltaPressure**2))
-    radiusOfMaxWind = 2.636 - radiusOfMaxWind + 0.0394899 * latitude
-    radiusOfMaxWind = math.exp(radiusOfMaxWind)
-    return radiusOfMaxWind
-    
+# TrackRMW.txt, Wind_Inp.txt and track.richamp, the windgfdl inputs, written before the rain so windgfdl can start early
+def writeTrackFiles(parsedTrack, outputDirectory="."):
+    with Profiler.stage("track writers"):
+        writeTrackRMW(parsedTrack, os.path.join(outputDirectory, "TrackRMW.txt"))
+        writeWindInp(parsedTrack, os.path.join(outputDirectory, "Wind_Inp.txt"))
+        writeTrackRichamp(parsedTrack, os.path.join(outputDirectory, "track.richamp"))
+    Profiler.addBytes("track writers", written=sum(os.path.getsize(os.path.join(outputDirectory, name)) for name in ["TrackRMW.txt", "Wind_Inp.txt", "track.richamp"]))
 
-def main(track):
-    STORM_CLASS_VALUES = ["", "LO", "TD", "TS", "HU"]
-    
-    RAIN_FILENAME = "RICHAMP_rain.nc"
-    MIN_LATITUDE = 4.0
-    MAX_LATITUDE = 51.0
-    MIN_LONGITUDE = -101.0
-    MAX_LONGITUDE = -49.0
-    SPATIAL_RESOLUTION = 1.0/12.0
-    
-    DEFAULT_BACKGROUND_PRESSURE = 1010
-    
-    trackDict = {}
-    stormName = ""
-    stormClass = ""
-    stormNumber = ""
-    trackDict["date"] = []
-    trackDict["pressure"] = []
-    trackDict["background"] = []
-    trackDict["latitude"] = []
-    trackDict["longitude"] = []
-    trackDict["radius"] = []
-    trackDict["wind"] = []
-#     data[3]
-    trackTimes = []
-    trackDeltaHours = []
-    trackHeadings = []
-#     data[5]
-    latitudeStrings = []
-    longitudeStrings = []
-    latitudes = []
-    longitudes = []
-    centralPressures = []
-    backgroundPressures = []
-    radiusMaxWinds = []
-    radiusClosures = []
-    maxWindSpeeds = []
-    maxWindSpeedsKnots = []
-    stormSpans = []
-    largeStormSpans = []
-    
-    
-    print("Generating Parametric Wind From track file:", track)
-    dataDict = None
-    lineCount = sum(1 for line in open(track))
-    with open(track) as trackFile:
-        dataDict = csv.DictReader(trackFile, fieldnames=["basin","number","date","unknown1", "type", "hours", "latitude", "longitude", "wind", "pressure", "class", "unknown2", "unknown3", "34ktNE", "34ktSE", "34ktNW", "34ktSW", "background", "closure", "radius", "unknown8", "unknown11", "unknown12", "unknown13", "unknown14", "unknown15", "unknown16", "name", "tag"])
-#         print(dataDict)
-        previousLatitude = None
-        previousLongitude = None
-        catchLargeStormSpan = False
-        for index, row in enumerate(dataDict):
-            dateStr = row["date"].strip()
-            hoursStr = row["hours"].strip()
-            year = int(dateStr[0:4])
-            month = int(dateStr[4:6])
-            day = int(dateStr[6:8])
-            hour = int(dateStr[8:10])
-            hours = int(hoursStr)
-#             print("date hours", row["date"], row["hours"])
-            
-            #time = datetime(year=year, month=month, day=day, hour=hour)
-            time = datetime(year=year, month=month, day=day, hour=hour) + timedelta(hours=hours)
-            if(catchLargeStormSpan):
-                if(time == stormSpanDate):
-                    windNE = float(row["34ktNE"].strip()) * 1.852
-                    if(windNE == 0):
-                        windNE = -999
-#                     print("50ktNE", windNE)
-                    windSE = float(row["34ktSE"].strip()) * 1.852
-                    if(windSE == 0):
-                        windSE = -999
-#                     print("50ktSE", windSE)
-                    windNW = float(row["34ktNW"].strip()) * 1.852
-                    if(windNW == 0):
-                        windNW = -999
-#                     print("50ktNW", windNW)
-                    windSW = float(row["34ktSW"].strip()) * 1.852
-                    if(windSW == 0):
-                        windSW = -999
-#                     print("50ktSW", windSW)
-                    largeStormSpans.append((windNE, windSE, windNW, windSW))
-                else:
-                    largeStormSpans.append((-999, -999, -999, -999))
-                catchLargeStormSpan = False
-            if(time not in trackTimes):
-#                 print(row["name"])
-                if(row["name"] != None):
-#                     Remove "0" and "NA" names
-                    if(len(row["name"].strip()) > 2):
-                        stormName = row["name"].strip()
-                if(row["class"] != None):
-                    if(len(row["class"].strip()) > 0):
-                        currentStormClass = row["class"].strip()
-                        if currentStormClass in STORM_CLASS_VALUES:
-                            if(STORM_CLASS_VALUES.index(currentStormClass) > STORM_CLASS_VALUES.index(stormClass)):
-                                stormClass = currentStormClass
-                            
-#                 stormSpanTag = row["tag"]:
-#                 print(stormName, stormSpanTag)
-                stormNumber = row["number"].strip()
-                trackTimes.append(time)
-                trackDeltaHours.append(hours)
-                centralPressures.append(int(row["pressure"].strip()))
-                backgroundPressure = int(row["background"].strip())
-                if(backgroundPressure == 0 or True):
-                    backgroundPressure = DEFAULT_BACKGROUND_PRESSURE
-                backgroundPressures.append(backgroundPressure)
-                radiusOfMaxWind = float(row["radius"].strip()) * 1.852
-                #print("radiusOfMaWind", radiusOfMaxWind)
-#                 Calculate both radius of max wind and closure radius, instead of relying on track values
-                if(radiusOfMaxWind == 0):
-#                     print("CALCULATING RADIUS")
-                    radiusOfMaxWind = calculateRadiusOfMaxWind(row["latitude"], row["pressure"], row["background"])
-#                 print(radiusOfMaxWind)
-                #closureRadius = float(row["closure"].strip()) * 1.852
-                if(True):
-#                     print("setting Closure radius")
-#                   closure radius is max wind times 20
-                    closureRadius = radiusOfMaxWind * 20
-                radiusOfMaxWind = round(radiusOfMaxWind, 4)
-                radiusMaxWinds.append(radiusOfMaxWind)
-                radiusClosures.append(closureRadius)
-#                 Comes in as knots
-                maxWindSpeed = float(row["wind"].strip())
-#                 print("MaxWindSpeed", maxWindSpeed)
-                maxWindSpeedsKnots.append(maxWindSpeed)
-#                 Convert to m/2
-                maxWindSpeed = maxWindSpeed * 0.514444
-                maxWindSpeeds.append(maxWindSpeed)
-#                 Convert to KM, from nautical miles
-                windNE = float(row["34ktNE"].strip()) * 1.852
-                if(windNE == 0):
-                    windNE = -999
-#                 print("34ktNE", windNE)
-                windSE = float(row["34ktSE"].strip()) * 1.852
-                if(windSE == 0):
-                    windSE = -999
-#                 print("34ktSE", windSE)
-                windNW = float(row["34ktNW"].strip()) * 1.852
-                if(windNW == 0):
-                    windNW = -999
-#                 print("34ktNW", windNW)
-                windSW = float(row["34ktSW"].strip()) * 1.852
-                if(windSW == 0):
-                    windSW = -999
-#                 print("34ktSW", windSW)
-                stormSpans.append((windNE, windSE, windNW, windSW))
-                if(index < lineCount - 1):
-                    catchLargeStormSpan = True
-                    stormSpanDate = time
-                else:
-                    largeStormSpans.append((-999, -999, -999, -999))
-                latitudeStrings.append(row["latitude"].strip())
-                longitudeStrings.append(row["longitude"].strip())
-#                 print(row["latitude"])
-                latitude = convertLatitude(row["latitude"])
-                longitude = convertLongitude(row["longitude"])
-                
-                latitudes.append(latitude)
-                longitudes.append(longitude)
-                
-#                 heading =  int(row["heading?"].strip())
-#                 print("headingString", heading)
-                if(not previousLatitude and not previousLongitude):
-                    previousLatitude = latitude
-                    previousLongitude = longitude
-#                 Use only calculated heading
-                else:     
-                    deltaLatitude = latitude - previousLatitude
-                    deltaLongitude = longitude - previousLongitude
-                    heading = findHeading(previousLatitude, latitude, deltaLongitude)
-#                     print("calculated", heading)
-                    trackHeadings.append(heading)
-#                 if(heading == 0 and (previousLatitude != latitude or previousLongitude != longitude)):     
-#                     deltaLatitude = latitude - previousLatitude
-#                     deltaLongitude = longitude - previousLongitude
-#                     heading = findHeading(previousLatitude, latitude, deltaLongitude)
-#                     print("calculated", heading)
-#                 if(heading != 0):
-#                     print(heading)
-#                     trackHeadings.append(heading)
-                    
-#                 print(latitude, longitude)
-        trackHeadings.append(trackHeadings[-1])
-        largeStormSpans.append((-999, -999, -999, -999))
-#         print(len(largeStormSpans))
-#         print(len(stormSpans))
-#                 print("closureRadius", closureRadius)
-#                 print(float(row["wind"]) * 0.514444)
-#                 print("radiusOfMaxWind", round(radiusOfMaxWind, 4))
-             
-    print("Storm Name, Storm Class:", stormName, stormClass)       
-    
-    trackStartTime = trackTimes[0]
-    generateParametricRain.main(MIN_LATITUDE, MIN_LONGITUDE, MAX_LATITUDE, MAX_LONGITUDE, SPATIAL_RESOLUTION, trackStartTime, trackDeltaHours, maxWindSpeedsKnots, latitudes, longitudes)
-    
-    print("writing file TrackRMW.txt")
-    with open("TrackRMW.txt", "w") as f:
+
+# RICHAMP_rain.nc in outputDirectory, see generateParametricRain.main for the options
+def generateRain(parsedTrack, outputDirectory=".", rainMode="vectorized", batchMemory=None, rainWorkers=1, rainCulling=None, outputOptions=None, geometryCache=None, incremental=False, rainCache=None, timeRange=None):
+    trackStartTime = parsedTrack.startTime()
+    generateParametricRain.main(MIN_LATITUDE, MIN_LONGITUDE, MAX_LATITUDE, MAX_LONGITUDE, SPATIAL_RESOLUTION, trackStartTime, parsedTrack["deltaHours"], parsedTrack["maxWindSpeedKnots"], parsedTrack["latitude"], parsedTrack["longitude"], mode=rainMode, batchMemory=batchMemory, workers=rainWorkers, culling=rainCulling, outputOptions=outputOptions, filename=os.path.join(outputDirectory, RAIN_FILENAME), geometryCache=geometryCache, incremental=incremental, rainCache=rainCache, timeRange=timeRange)
+
+
+# RICHAMP_rain_ensemble.nc in outputDirectory, see generateParametricRain.mainEnsemble
+def generateEnsembleRain(parsedTrack, ensemble, outputDirectory=".", rainMode="vectorized", batchMemory=None, rainWorkers=1, rainCulling=None, outputOptions=None, geometryCache=None):
+    trackStartTime = parsedTrack.startTime()
+    generateParametricRain.mainEnsemble(MIN_LATITUDE, MIN_LONGITUDE, MAX_LATITUDE, MAX_LONGITUDE, SPATIAL_RESOLUTION, trackStartTime, parsedTrack["deltaHours"], parsedTrack["maxWindSpeedKnots"], parsedTrack["latitude"], parsedTrack["longitude"], ensemble, mode=rainMode, batchMemory=batchMemory, workers=rainWorkers, culling=rainCulling, outputOptions=outputOptions, filename=os.path.join(outputDirectory, ENSEMBLE_RAIN_FILENAME), geometryCache=geometryCache)
+
+
+def writeTrackRMW(track, filename="TrackRMW.txt"):
+    trackTimes = track.times()
+    centralPressures = track["centralPressure"].tolist()
+    backgroundPressures = track["backgroundPressure"].tolist()
+    radiusMaxWinds = track["radiusMaxWind"].tolist()
+    print("writing file", filename)
+    with open(filename, "w") as f:
         f.write("Yr, Mo, Day, Hr, Min, Sec, Central P(mbar), Background P(mbar), Radius of Max Winds (km)\n")
         for index, trackTime in enumerate(trackTimes):
             f.write(str(trackTime.year) + " " + str(trackTime.month) + " " + str(trackTime.day) + " " + str(trackTime.hour) + " " + str(trackTime.minute) + " " + str(trackTime.second) + " " + str(centralPressures[index]) + " " + str(backgroundPressures[index]) + " " + str(radiusMaxWinds[index]) + "\n")
         f.close()
 
-    print("writing file Wind_Inp.txt")
-    with open("Wind_Inp.txt", "w") as f:
+
+def writeWindInp(track, filename="Wind_Inp.txt"):
+    trackTimes = track.times()
+    trackDeltaHours = track["deltaHours"].tolist()
+    print("writing file", filename)
+    with open(filename, "w") as f:
         f.write("richamp\n")
         f.write("3\n")
         minTrackTime = min(trackTimes)
@@ -313,11 +153,25 @@ def main(track):
         f.write(str(max(trackDeltaHours)) + "\n")
         f.write(str(MIN_LONGITUDE) + " " + str(MAX_LONGITUDE) + "\n")
         f.write(str(MIN_LATITUDE) + " " + str(MAX_LATITUDE) + "\n")
-        f.write("12.\n")
+        f.write(str(int(WIND_RESOLUTION)) + ".\n")
         f.close()
 
-    print("writing file track.richamp")
-    with open("track.richamp", "w") as f:
+
+def writeTrackRichamp(track, filename="track.richamp"):
+    stormNumber = track.stormNumber
+    trackTimes = track.times()
+    latitudeStrings = track["latitudeString"].tolist()
+    longitudeStrings = track["longitudeString"].tolist()
+    trackHeadings = track["heading"].tolist()
+    centralPressures = track["centralPressure"].tolist()
+    backgroundPressures = track["backgroundPressure"].tolist()
+    radiusClosures = track["radiusClosure"].tolist()
+    maxWindSpeeds = track["maxWindSpeed"].tolist()
+    radiusMaxWinds = track["radiusMaxWind"].tolist()
+    stormSpans = track["span34"].tolist()
+    largeStormSpans = track["span50"].tolist()
+    print("writing file", filename)
+    with open(filename, "w") as f:
         for index, trackTime in enumerate(trackTimes):
             stormAndDateString = "NHC A" + stormNumber + " URIPWMIN   " + str(trackTime.year).zfill(4) + str(trackTime.month).zfill(2) + str(trackTime.day).zfill(2) + " " + str(trackTime.hour).zfill(2) + str(trackTime.minute).zfill(2)
             bearingString = latitudeStrings[index].zfill(3) + " " + longitudeStrings[index].zfill(5) + " " + str(round(trackHeadings[index])).zfill(3)
@@ -329,5 +183,4 @@ def main(track):
 
             f.write(stormAndDateString + " " + bearingString + " " + pressureAndRadiusString + " " + stormSpanString + " D " + largeStormSpanString + "\n")
         f.close()
-    return stormName, stormClass
 
@@ -1,61 +1,454 @@
+import collections
+import hashlib
+import logging
 import math
+import os
+import tempfile
 import numpy as np
 import haversine
 import datetime
-from Dataset import Dataset
+import netCDF4 as nc
+from concurrent.futures import ProcessPoolExecutor
+from Dataset import Dataset, EnsembleDataset, RAIN_RANGE
+import Profiler
+from Swath import Swath
+from GridGeometry import GridGeometry, linspaceAxis
+
+
+# Mean earth radius in km, the same value haversine.haversine uses
+EARTH_RADIUS = 6371.0088
+
+# Lonfat-style rain profile coefficients
+A1 = -1.10
+A2 = -1.60
+A3 = 64.5
+A4 = 150.0
+B1 = 3.96
+B2 = 4.80
+B3 = -13.0
+B4 = -16.0
+# in/day to mm/hr, with the added 1.4 factor
+RAIN_CONVERSION = (1.0/24.0) * 1.4 * 25.4
+
+LOGGER = logging.getLogger(__name__)
+
+RAIN_MODES = ["vectorized", "reference"]
+DEFAULT_RAIN_CACHE_MB = 1024
+# Bumped whenever the rain computation changes in a way the cache key does not capture
+RAIN_CACHE_VERSION = 1
+# Full grid float64 arrays alive at once while a batch is evaluated
+BATCH_TEMPORARIES = 6
+# Probability of exceedance thresholds of ensemble rain, hourly rate in mm/hr and storm total in mm
+DEFAULT_RATE_THRESHOLDS = [10.0, 25.0, 50.0]
+DEFAULT_TOTAL_THRESHOLDS = [50.0, 100.0, 250.0, 500.0]
 
 
 # Track radius comes in as km, track winds come in as knots
-def main(minLatitude, minLongitude, maxLatitude, maxLongitude, spatialResolution, trackStartTime, trackDeltaHours, trackWinds, trackLatitudes, trackLongitudes):
+# mode "vectorized" computes each hourly slice in one broadcast call, "reference" uses the per point calculateRain loop
+# batchMemory (MB) evaluates and writes blocks of hourly slices at once, sized to fit the budget
+# workers > 1 computes the slices on a process pool while this process writes them in index order. With a directory
+# store (outputOptions.store) and no rainCache the workers write their slices to the store themselves.
+# culling (RainCulling) only evaluates rain inside a radius of influence around each track center
+# outputOptions (OutputOptions) sets chunking, compression and write buffering of the NetCDF file
+# geometryCache (GridGeometry.GeometryCache) reuses the memory mapped grid coordinate and trigonometric tables
+# incremental updates an existing file in place, only recomputing the hours whose interpolated track center
+# or wind changed and appending new hours. It falls back to a full run when the file cannot be updated.
+# rainCache (RainCache) reads slices computed before for the same center, wind, grid and settings instead of recomputing them
+# timeRange (mergeShards.TimeRange) only generates those hours, into a shard file for mergeShards
+def main(minLatitude, minLongitude, maxLatitude, maxLongitude, spatialResolution, trackStartTime, trackDeltaHours, trackWinds, trackLatitudes, trackLongitudes, mode="vectorized", batchMemory=None, workers=1, culling=None, outputOptions=None, filename="RICHAMP_rain.nc", geometryCache=None, incremental=False, rainCache=None, timeRange=None):
+    if(mode not in RAIN_MODES):
+        raise RuntimeError("Invalid rain mode " + str(mode) + ", must be one of " + ", ".join(RAIN_MODES))
+    if(workers < 1):
+        raise RuntimeError("Number of rain workers must be at least 1")
+    if(batchMemory is not None and mode != "vectorized"):
+        raise RuntimeError("Batched rain generation requires the vectorized rain mode")
     print("Generating Parametric Rain!")
+    rainTimes, interpolatedTrackLatitudes, interpolatedTrackLongitudes, interpolatedTrackWinds = interpolateTrack(trackStartTime, trackDeltaHours, trackWinds, trackLatitudes, trackLongitudes)
+    numTimesRain = len(rainTimes)
+    grid = rainGrid(minLatitude, minLongitude, maxLatitude, maxLongitude, spatialResolution, geometryCache)
+    numLats, numLons = grid.shape()
+    latitudes = grid.latitudes
+    longitudes = grid.longitudes
+    
+    trackValues = np.stack([interpolatedTrackLatitudes, interpolatedTrackLongitudes, interpolatedTrackWinds], axis=1)
+    settings = rainSettings(mode, culling)
+    indices = range(numTimesRain)
+    shard = None
+    if(timeRange is not None):
+        if(incremental):
+            raise RuntimeError("A time range shard cannot be updated incrementally")
+        shard = timeRange.shard(numTimesRain)
+        indices = range(shard[0], shard[1])
+        print("Generating rain hours", shard[0], "to", shard[1] - 1, "of", numTimesRain)
+    rainDataset = None
+    if(incremental):
+        if(outputOptions is not None and outputOptions.store != "netcdf"):
+            raise RuntimeError("Incremental rain updates need the netcdf output store")
+        indices = changedIndices(filename, latitudes, longitudes, rainTimes, trackValues, settings)
+        if(indices is None):
+            indices = range(numTimesRain)
+        else:
+            print("Incremental update recomputes", len(indices), "of", numTimesRain, "hours")
+            rainDataset = Dataset(filename, latitudes, longitudes, outputOptions, mode="a")
+    if(rainDataset is None):
+    #         Initialize a net cdf file
+        rainDataset = Dataset(filename, latitudes, longitudes, outputOptions, settings, shard=shard)
+    
+    if(rainCache is not None):
+        missedIndices = []
+        for index in indices:
+            with Profiler.stage("rain cache", index):
+                rain = rainCache.get(rainCache.key(trackValues[index], grid, settings))
+            if(rain is None):
+                missedIndices.append(index)
+            else:
+                rainDataset.append(index, rainTimes[index], rain, trackValues[index])
+        indices = missedIndices
+
+    batchSize = 1
+    if(batchMemory is not None):
+        batchSize = calculateBatchSize(batchMemory, numLats, numLons)
+        print("Generating rain in batches of", batchSize, "hours")
+    indexRanges = consecutiveRanges(indices, batchSize)
+    tasks = ((mode, interpolatedTrackLatitudes[startIndex:endIndex], interpolatedTrackLongitudes[startIndex:endIndex],
+              interpolatedTrackWinds[startIndex:endIndex], grid, culling) for startIndex, endIndex in indexRanges)
+    if(workers > 1 and rainCache is None and rainDataset.store.concurrent):
+        print("Generating and storing rain on", workers, "worker processes")
+        storeTasks = ((rainDataset.store, rainDataset.outputOptions, startIndex - rainDataset.indexOffset, rainTimes[startIndex:endIndex], trackValues[startIndex:endIndex]) + task
+                      for (startIndex, endIndex), task in zip(indexRanges, tasks))
+        rains = computeRainParallel(storeTasks, workers, computeAndStoreRain)
+    elif(workers > 1):
+        print("Generating rain on", workers, "worker processes")
+        rains = computeRainParallel(tasks, workers)
+    else:
+        rains = (computeRain(*task) for task in tasks)
+
+#     Results arrive in index order, so the file is written exactly as in a serial run
+    evaluatedPoints = 0
+    for startIndex, endIndex in indexRanges:
+        with Profiler.stage("rain compute", startIndex):
+            rain, rainPoints = next(rains)
+        if(isinstance(rain, Swath)):
+#             Already stored by the worker, which sends back the swath of its slices
+            LOGGER.info("Generated rain, indices %d to %d", startIndex, endIndex - 1)
+            rainDataset.mergeSwath(rain)
+        elif(endIndex - startIndex == 1):
+            LOGGER.info("Generating rain, index %d", startIndex)
+            rainDataset.append(startIndex, rainTimes[startIndex], rain[0], trackValues[startIndex])
+        else:
+            LOGGER.info("Generating rain, indices %d to %d", startIndex, endIndex - 1)
+            rainDataset.appendBlock(startIndex, rainTimes[startIndex:endIndex], rain, trackValues[startIndex:endIndex])
+        if(rainCache is not None):
+            for index in range(startIndex, endIndex):
+                with Profiler.stage("rain cache"):
+                    rainCache.put(rainCache.key(trackValues[index], grid, settings), rain[index - startIndex])
+        evaluatedPoints = evaluatedPoints + rainPoints
+    rainDataset.close()
+    if(rainCache is not None):
+        print("Rain cache", rainCache.hits, "hits,", rainCache.misses, "misses,", rainCache.evictions, "evictions")
+    if(culling is not None and len(indices) > 0):
+        totalPoints = len(indices) * numLats * numLons
+        print("Culling skipped", totalPoints - evaluatedPoints, "of", totalPoints, "rain grid points ({:.1f}%)".format(100.0 * (totalPoints - evaluatedPoints) / totalPoints))
+    
+    
+# Rain of every member of ensemble (EnsembleSpec) in one (member, time, lat, lon) file with probability of
+# exceedance summaries, see Dataset.EnsembleDataset. Each hour of all members is evaluated in one computeRain call
+# sharing the grid, split into blocks of members when batchMemory is set. workers > 1 computes the hours on a process pool.
+def mainEnsemble(minLatitude, minLongitude, maxLatitude, maxLongitude, spatialResolution, trackStartTime, trackDeltaHours, trackWinds, trackLatitudes, trackLongitudes, ensemble, mode="vectorized", batchMemory=None, workers=1, culling=None, outputOptions=None, filename="RICHAMP_rain_ensemble.nc", geometryCache=None):
+    if(mode not in RAIN_MODES):
+        raise RuntimeError("Invalid rain mode " + str(mode) + ", must be one of " + ", ".join(RAIN_MODES))
+    if(workers < 1):
+        raise RuntimeError("Number of rain workers must be at least 1")
+    print("Generating Parametric Rain for", ensemble.members, "ensemble members!")
+    rainTimes, interpolatedTrackLatitudes, interpolatedTrackLongitudes, interpolatedTrackWinds = interpolateTrack(trackStartTime, trackDeltaHours, trackWinds, trackLatitudes, trackLongitudes)
+    grid = rainGrid(minLatitude, minLongitude, maxLatitude, maxLongitude, spatialResolution, geometryCache)
+    numLats, numLons = grid.shape()
+    with Profiler.stage("ensemble members"):
+        memberLatitudes, memberLongitudes, memberWinds = ensemble.perturb(interpolatedTrackLatitudes, interpolatedTrackLongitudes, interpolatedTrackWinds)
+    trackValues = np.stack([memberLatitudes, memberLongitudes, memberWinds], axis=2)
+
+    batchSize = ensemble.members
+    if(batchMemory is not None):
+        batchSize = calculateBatchSize(batchMemory, numLats, numLons)
+        print("Generating rain in batches of", batchSize, "members")
+    tasks = ((mode, memberLatitudes[:, index], memberLongitudes[:, index], memberWinds[:, index], grid, culling, batchSize)
+             for index in range(len(rainTimes)))
+    if(workers > 1):
+        print("Generating rain on", workers, "worker processes")
+        rains = computeRainParallel(tasks, workers, computeEnsembleRain)
+    else:
+        rains = (computeEnsembleRain(*task) for task in tasks)
+
+    rainDataset = EnsembleDataset(filename, grid.latitudes, grid.longitudes, ensemble.members, ensemble.rateThresholds, ensemble.totalThresholds,
+                                  outputOptions, rainSettings(mode, culling) + " " + ensemble.settings())
+    for index in range(len(rainTimes)):
+        with Profiler.stage("rain compute", index):
+            rain, rainPoints = next(rains)
+        LOGGER.info("Generating ensemble rain, index %d", index)
+        rainDataset.append(index, rainTimes[index], rain, trackValues[:, index])
+    rainDataset.close()
+
+
+#     computeRain of one hour of every member, in blocks of at most batchSize members
+def computeEnsembleRain(mode, centerLatitudes, centerLongitudes, winds, grid, culling, batchSize):
+    rains = []
+    evaluatedPoints = 0
+    for start in range(0, len(winds), batchSize):
+        end = start + batchSize
+        rain, rainPoints = computeRain(mode, centerLatitudes[start:end], centerLongitudes[start:end], winds[start:end], grid, culling)
+        rains.append(rain)
+        evaluatedPoints = evaluatedPoints + rainPoints
+    return np.concatenate(rains), evaluatedPoints
+
+
+# Perturbed members of a track for ensemble rain, member 0 being the track itself. cross (km, positive to the
+# right of the motion), along (km, positive ahead of the storm) and intensity (knots) are standard deviations per
+# day of lead time. Each member draws one normal deviate per kind from seed, so its offsets grow linearly from
+# zero at the first track time. Parsed from a spec such as "members=50,cross=40,along=60,intensity=8,seed=1".
+class EnsembleSpec:
+    KEYS = {"members": int, "cross": float, "along": float, "intensity": float, "seed": int}
+
+    def __init__(self, members, cross=0.0, along=0.0, intensity=0.0, seed=0, rateThresholds=None, totalThresholds=None):
+        if(members < 1):
+            raise RuntimeError("An ensemble needs at least one member")
+        if(min(cross, along, intensity) < 0):
+            raise RuntimeError("Ensemble perturbations must not be negative")
+        self.members = members
+        self.cross = cross
+        self.along = along
+        self.intensity = intensity
+        self.seed = seed
+        self.rateThresholds = list(DEFAULT_RATE_THRESHOLDS if rateThresholds is None else rateThresholds)
+        self.totalThresholds = list(DEFAULT_TOTAL_THRESHOLDS if totalThresholds is None else totalThresholds)
+
+    @staticmethod
+    def parse(text, rateThresholds=None, totalThresholds=None):
+        values = {}
+        for item in text.split(","):
+            key, separator, value = item.partition("=")
+            key = key.strip()
+            if(not separator or key not in EnsembleSpec.KEYS):
+                raise RuntimeError("Invalid ensemble setting " + repr(item) + ", expected key=value with keys " + ", ".join(EnsembleSpec.KEYS))
+            try:
+                values[key] = EnsembleSpec.KEYS[key](value)
+            except ValueError:
+                raise RuntimeError("Invalid value " + repr(value) + " for ensemble setting " + key)
+        if("members" not in values):
+            raise RuntimeError("The ensemble spec needs members=N")
+        return EnsembleSpec(rateThresholds=rateThresholds, totalThresholds=totalThresholds, **values)
+
+    def settings(self):
+        return "members=" + str(self.members) + " cross=" + repr(self.cross) + " along=" + repr(self.along) + " intensity=" + repr(self.intensity) + " seed=" + str(self.seed)
+
+    #     (member, time) center latitudes, longitudes and winds of the members around the hourly track
+    def perturb(self, latitudes, longitudes, winds):
+        deviates = np.random.default_rng(self.seed).standard_normal((self.members, 3))
+        deviates[0] = 0.0
+        leadDays = np.arange(len(latitudes)) / 24.0
+        crossOffsets = (deviates[:, 0] * self.cross)[:, np.newaxis] * leadDays
+        alongOffsets = (deviates[:, 1] * self.along)[:, np.newaxis] * leadDays
+        windOffsets = (deviates[:, 2] * self.intensity)[:, np.newaxis] * leadDays
+#         Unit vector of the motion in km east and north, from the neighbouring hourly centers
+        north = np.zeros(len(latitudes))
+        east = np.zeros(len(latitudes))
+        if(len(latitudes) > 1):
+            north = np.gradient(latitudes)
+            east = np.gradient(longitudes) * np.cos(np.radians(latitudes))
+        speed = np.hypot(north, east)
+        stationary = speed == 0
+        north = np.where(stationary, 1.0, north / np.where(stationary, 1.0, speed))
+        east = np.where(stationary, 0.0, east / np.where(stationary, 1.0, speed))
+        eastOffsets = alongOffsets * east + crossOffsets * north
+        northOffsets = alongOffsets * north - crossOffsets * east
+        kilometersPerDegree = math.radians(EARTH_RADIUS)
+        memberLatitudes = latitudes + northOffsets / kilometersPerDegree
+        memberLongitudes = longitudes + eastOffsets / (kilometersPerDegree * np.cos(np.radians(memberLatitudes)))
+        memberWinds = np.maximum(winds + windOffsets, 0.0)
+        return memberLatitudes, memberLongitudes, memberWinds
+
+
+#     Hourly times, center latitudes, longitudes and winds of the track from its first to its last fix
+def interpolateTrack(trackStartTime, trackDeltaHours, trackWinds, trackLatitudes, trackLongitudes):
     minTrackDeltaHours = min(trackDeltaHours)
     maxTrackDeltaHours = max(trackDeltaHours)
     numTimesRain = (maxTrackDeltaHours - minTrackDeltaHours) + 1
-    
     print("Interpolating track to hourly intervals")
-    rainDeltaHours = np.linspace(minTrackDeltaHours, maxTrackDeltaHours, num=numTimesRain)
-    rainTimes = []
-    for deltaHour in rainDeltaHours:
-        rainTimes.append(trackStartTime + datetime.timedelta(hours=deltaHour))
-#     rainTimes = np.linspace(min(trackTimes), max(trackTimes), num=numTimesRain)
-    interpolatedTrackLatitudes = np.interp(rainDeltaHours, trackDeltaHours, trackLatitudes)
-    interpolatedTrackLongitudes = np.interp(rainDeltaHours, trackDeltaHours, trackLongitudes)
-    interpolatedTrackWinds = np.interp(rainDeltaHours, trackDeltaHours, trackWinds)
-    
+    with Profiler.stage("interpolation"):
+        rainDeltaHours = np.linspace(minTrackDeltaHours, maxTrackDeltaHours, num=numTimesRain)
+        rainTimes = []
+        for deltaHour in rainDeltaHours:
+            rainTimes.append(trackStartTime + datetime.timedelta(hours=deltaHour))
+#         rainTimes = np.linspace(min(trackTimes), max(trackTimes), num=numTimesRain)
+        interpolatedTrackLatitudes = np.interp(rainDeltaHours, trackDeltaHours, trackLatitudes)
+        interpolatedTrackLongitudes = np.interp(rainDeltaHours, trackDeltaHours, trackLongitudes)
+        interpolatedTrackWinds = np.interp(rainDeltaHours, trackDeltaHours, trackWinds)
+    return rainTimes, interpolatedTrackLatitudes, interpolatedTrackLongitudes, interpolatedTrackWinds
+
+
+#     GridGeometry of the rain grid, shared through geometryCache when given
+def rainGrid(minLatitude, minLongitude, maxLatitude, maxLongitude, spatialResolution, geometryCache=None):
     numLats = math.ceil((maxLatitude - minLatitude) / spatialResolution) + 1
     numLons = math.ceil((maxLongitude - minLongitude) / spatialResolution) + 1
 #         print(numLats)
-    latitudes = np.linspace(minLatitude, minLatitude + (numLats - 1) * spatialResolution, numLats)
-    longitudes = np.linspace(minLongitude, minLongitude + (numLons - 1) * spatialResolution, numLons)
-#         print(min(latitudes), minLatitude)
-#         print(max(latitudes), maxLatitude)
-#         print(min(longitudes), minLongitude)
-#         print(max(longitudes), maxLongitude)
-    
-    #         Initialize a net cdf file
-    filename = "RICHAMP_rain.nc"
-    rainDataset = Dataset(filename, latitudes, longitudes)
-    
-    for index, time in enumerate(rainTimes):
-        print("Generating rain, index", index)
-        trackLatitude = interpolatedTrackLatitudes[index]
-        trackLongitude = interpolatedTrackLongitudes[index]
-        center = (trackLatitude, trackLongitude)
-        trackWind = interpolatedTrackWinds[index]
-        
-        lineRains = []
-#         print("time", time, "lat lon", trackLatitude, trackLongitude, "wind speed", trackWind)
-        for latitude in latitudes:
-            lineRain = []
-            for longitude in longitudes:
-                coordinate = (latitude, longitude)
-                pointRain = calculateRain(center, coordinate, trackWind)
-                lineRain.append(pointRain)
-                distanceToCenter = haversine.haversine(center, coordinate)
-#                     print(distanceToCenter)
-            lineRains.append(lineRain)
-        rainDataset.append(index, time, lineRains)
-    
+    latitudeAxis = linspaceAxis(minLatitude, spatialResolution, numLats)
+    longitudeAxis = linspaceAxis(minLongitude, spatialResolution, numLons)
+    if(geometryCache is not None):
+        return geometryCache.get(latitudeAxis, longitudeAxis)
+    return GridGeometry(latitudeAxis, longitudeAxis)
+
+
+# Content addressed on disk cache of rain slices. A slice depends only on the interpolated center and wind,
+# the grid axes, the rain profile coefficients and the rain settings, so their hash names the file holding it.
+# Slices are stored as compressed float32 .npz files written under a temporary name and renamed into place.
+# Reads mark an entry as recently used and the least recently used entries are removed whenever the directory
+# is found past maxMegabytes, when the cache is opened or listed again and after each write. hits, misses and evictions count the lookups and removals of this instance.
+# The entries are listed once into an in memory index in least recently used order, kept up to date by get,
+# put and evict. The directory is listed again only when its modification time shows another process added
+# or removed entries since this instance last changed it.
+class RainCache:
+    def __init__(self, directory, maxMegabytes=DEFAULT_RAIN_CACHE_MB):
+        if(maxMegabytes <= 0):
+            raise RuntimeError("Rain cache size must be positive")
+        self.directory = directory
+        self.maxBytes = int(maxMegabytes * 1024 * 1024)
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        os.makedirs(directory, exist_ok=True)
+        self.scan()
+        self.evict()
+
+    @staticmethod
+    def key(trackValues, grid, settings):
+        digest = hashlib.sha1()
+        digest.update(np.asarray(trackValues, dtype=np.float64).tobytes())
+        digest.update(repr((grid.latitudeAxis, grid.longitudeAxis, A1, A2, A3, A4, B1, B2, B3, B4, RAIN_CONVERSION,
+                            settings, RAIN_CACHE_VERSION)).encode())
+        return digest.hexdigest()
+
+    def path(self, key):
+        return os.path.join(self.directory, "rain_" + key + ".npz")
+
+    def get(self, key):
+        path = self.path(key)
+        try:
+            with np.load(path) as entry:
+                rain = entry["rain"]
+            os.utime(path)
+        except (OSError, KeyError, ValueError):
+            self.misses = self.misses + 1
+            self.forget(path)
+            return None
+        self.hits = self.hits + 1
+        if(path in self.index):
+            self.index.move_to_end(path)
+        else:
+#             Written by another process
+            self.add(path, os.path.getsize(path))
+        return rain
+
+    def put(self, key, rain):
+        path = self.path(key)
+        if(path in self.index or os.path.exists(path)):
+            return
+        if(self.directoryTime != self.modificationTime()):
+            self.scan()
+            self.evict()
+        handle, temporary = tempfile.mkstemp(prefix=".rain_", suffix=".npz", dir=self.directory)
+        with os.fdopen(handle, "wb") as f:
+            np.savez_compressed(f, rain=np.asarray(rain, dtype=np.float32))
+            size = f.tell()
+        os.replace(temporary, path)
+        self.add(path, size)
+        if(self.totalBytes > self.maxBytes):
+            self.evict(path)
+        self.directoryTime = self.modificationTime()
+
+    def modificationTime(self):
+        return os.stat(self.directory).st_mtime_ns
+
+    # Lists the directory into the index of path -> size, least recently used first
+    def scan(self):
+        self.directoryTime = self.modificationTime()
+        self.index = collections.OrderedDict((path, size) for mtime, size, path in sorted(self.entries()))
+        self.totalBytes = sum(self.index.values())
+
+    def add(self, path, size):
+        self.index[path] = size
+        self.totalBytes = self.totalBytes + size
+
+    def forget(self, path):
+        size = self.index.pop(path, None)
+        if(size is not None):
+            self.totalBytes = self.totalBytes - size
+
+    def entries(self):
+        entries = []
+        for name in os.listdir(self.directory):
+            if(name.startswith("rain_") and name.endswith(".npz")):
+                path = os.path.join(self.directory, name)
+                try:
+                    entries.append((os.path.getmtime(path), os.path.getsize(path), path))
+                except FileNotFoundError:
+                    continue
+        return entries
+
+    # Removes least recently used entries until the cache fits in maxBytes, never removing keep
+    def evict(self, keep=None):
+        while(self.totalBytes > self.maxBytes and self.index):
+            path = next(iter(self.index))
+            if(path == keep):
+#                 keep is the most recent entry, nothing older is left
+                break
+            self.forget(path)
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                continue
+            self.evictions = self.evictions + 1
+        self.directoryTime = self.modificationTime()
+
+
+#     Settings besides the track that change the rain values, recorded in the file so an incremental
+#     update never mixes slices computed differently
+def rainSettings(mode, culling):
+    settings = "mode=" + mode
+    if(culling is not None):
+        settings = settings + " cutoffDistance=" + repr(culling.cutoffDistance) + " cutoffRain=" + repr(culling.cutoffRain) + " fill=" + repr(culling.fillValue)
+    return settings
+
+
+#     Indices of the hours whose time or track values differ from the existing file, and the hours past its end.
+#     None when the file cannot be updated in place: it is missing or predates stored track values, its grid,
+#     settings or first time differ, or it holds more hours than the new track (the time dimension cannot shrink).
+def changedIndices(filename, latitudes, longitudes, rainTimes, trackValues, settings):
+    existing = Dataset.readTrack(filename)
+    if(existing is None):
+        print("No earlier rain with track values in", filename + ", generating every hour")
+        return None
+    numExisting = len(existing["timeUnix"])
+    timeUnix = np.array([round((rainTime - datetime.datetime(1970, 1, 1)).total_seconds()) for rainTime in rainTimes])
+    if(existing["settings"] != settings or not np.array_equal(existing["latitudes"], latitudes)
+       or not np.array_equal(existing["longitudes"], longitudes)):
+        print("Rain settings or grid changed, generating every hour")
+        return None
+    if(numExisting > len(timeUnix) or (numExisting > 0 and existing["timeUnix"][0] != timeUnix[0])):
+        print("Rain hours no longer line up with", filename + ", generating every hour")
+        return None
+    unchanged = (existing["timeUnix"] == timeUnix[:numExisting]) & np.all(existing["track"] == trackValues[:numExisting], axis=1)
+    return [index for index in range(len(timeUnix)) if index >= numExisting or not unchanged[index]]
+
+
+#     (start, end) index ranges of at most batchSize consecutive indices covering the sorted indices
+def consecutiveRanges(indices, batchSize):
+    ranges = []
+    for index in indices:
+        if(ranges and ranges[-1][1] == index and index - ranges[-1][0] < batchSize):
+            ranges[-1] = (ranges[-1][0], index + 1)
+        else:
+            ranges.append((index, index + 1))
+    return ranges
+
     
     # For each time, 
 #     For each lat in the rain grid, stored in the netCDF file
@@ -63,24 +456,169 @@ def main(minLatitude, minLongitude, maxLatitude, maxLongitude, spatialResolution
 #           compute distance from storm.
   
   
+#     Rain for a run of consecutive hourly track positions, shape (time, lat, lon), and the number of grid points evaluated
+#     Cast to the f4 storage type here so worker results are half the size to send back
+#     grid is a GridGeometry
+def computeRain(mode, centerLatitudes, centerLongitudes, winds, grid, culling=None):
+    if(culling is None):
+        if(mode == "reference"):
+            rain = np.array([calculateRainReference((centerLatitude, centerLongitude), grid.latitudes, grid.longitudes, wind)
+                             for centerLatitude, centerLongitude, wind in zip(centerLatitudes, centerLongitudes, winds)])
+        else:
+            rain = calculateRainBlock(centerLatitudes, centerLongitudes, winds, grid)
+        return rain.astype(np.float32), rain.size
+
+    rain = np.full((len(winds),) + grid.shape(), culling.fillValue, dtype=np.float32)
+    evaluatedPoints = 0
+    for index, (centerLatitude, centerLongitude, wind) in enumerate(zip(centerLatitudes, centerLongitudes, winds)):
+        center = (centerLatitude, centerLongitude)
+        cutoff = culling.cutoff(wind)
+        latitudeSlice, longitudeSlice = culling.window(center, cutoff, grid.latitudes, grid.longitudes)
+        window = grid.window(latitudeSlice, longitudeSlice)
+        if(len(window.latitudes) == 0 or len(window.longitudes) == 0):
+            continue
+        if(mode == "reference"):
+            windowRain = calculateRainReference(center, window.latitudes, window.longitudes, wind)
+        else:
+            windowRain = calculateRainGrid(center, window, wind)
+#         Corners of the window lie beyond the cutoff too, cull them so the result does not depend on the window shape
+        distanceToCenter = calculateDistanceGrid(center, window)
+        rain[index, latitudeSlice, longitudeSlice] = np.where(distanceToCenter > cutoff, culling.fillValue, windowRain)
+        evaluatedPoints = evaluatedPoints + windowRain.size
+    return rain, evaluatedPoints
+
+
+#     computeRain in a worker writing the slices to store (a concurrent OutputStore) instead of sending them back,
+#     only the Swath of the values as stored with outputOptions is returned
+def computeAndStoreRain(store, outputOptions, startIndex, dates, trackValues, *task):
+    rain, rainPoints = computeRain(*task)
+    values = Dataset.blockValues(dates, rain, trackValues)
+    store.write(startIndex, values)
+    swath = Swath(rain.shape[1:], total=True)
+    swath.update(values["time"], outputOptions.storedValues(rain, RAIN_RANGE))
+    return swath, rainPoints
+
+
+#     Yields function results in task order, keeping at most two tasks per worker in flight to bound memory
+def computeRainParallel(tasks, workers, function=computeRain):
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        pending = collections.deque()
+        for task in tasks:
+            pending.append(executor.submit(function, *task))
+            if(len(pending) >= 2 * workers):
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
+
+
+# Radius of influence culling. Rain is only evaluated inside the lat/lon window around each track center
+# that holds every point within the cutoff distance, and points beyond the cutoff get fillValue.
+# cutoffDistance is in km, cutoffRain in mm/hr is turned into the distance where the exponential tail drops below it.
+class RainCulling:
+    FILLS = ["zero", "fill"]
+
+    def __init__(self, cutoffDistance=None, cutoffRain=None, fill="zero"):
+        if((cutoffDistance is None) == (cutoffRain is None)):
+            raise RuntimeError("Rain culling needs exactly one of a cutoff distance or a cutoff rain rate")
+        if(fill not in RainCulling.FILLS):
+            raise RuntimeError("Invalid rain culling fill " + str(fill) + ", must be one of " + ", ".join(RainCulling.FILLS))
+        self.cutoffDistance = cutoffDistance
+        self.cutoffRain = cutoffRain
+        self.fillValue = 0.0 if fill == "zero" else nc.default_fillvals["f4"]
+
+    def cutoff(self, wind):
+        if(self.cutoffDistance is not None):
+            return self.cutoffDistance
+        t0, tm, rm, re = calculateRainProfile(wind)
+        peakRain = tm * RAIN_CONVERSION
+        if(re <= 0):
+            return math.inf
+        if(peakRain <= self.cutoffRain):
+            return rm
+        return rm + re * math.log(peakRain / self.cutoffRain)
+
+#     Index slices of the latitude and longitude window holding every point within cutoff km of center
+    def window(self, center, cutoff, latitudes, longitudes):
+        angle = cutoff / EARTH_RADIUS
+        centerLatitude = math.radians(center[0])
+        latitudeSpan = math.degrees(angle)
+        latitudeSlice = slice(np.searchsorted(latitudes, center[0] - latitudeSpan, "left"),
+                              np.searchsorted(latitudes, center[0] + latitudeSpan, "right"))
+#         The circle reaches a pole, so every longitude is within the cutoff somewhere in the latitude band
+        if(angle >= math.pi / 2.0 - abs(centerLatitude)):
+            return latitudeSlice, slice(0, len(longitudes))
+        longitudeSpan = math.degrees(math.asin(math.sin(angle) / math.cos(centerLatitude)))
+        longitudeSlice = slice(np.searchsorted(longitudes, center[1] - longitudeSpan, "left"),
+                               np.searchsorted(longitudes, center[1] + longitudeSpan, "right"))
+        return latitudeSlice, longitudeSlice
+
+
+#     Rain rate at r=0, maximum rain rate, radius of maximum rain and e-folding radius, in/day and km
+def calculateRainProfile(wind):
+    u = 1.0 + ((wind - 35.0)/33.0)
+    t0 = A1 + B1*u
+    tm = A2 + B2*u
+    rm = A3 + B3*u
+    re = A4 + B4*u
+    return t0, tm, rm, re
+
+
+#     Great circle distance in km from each center to every (latitude, longitude) point of the grid, shape (centers, lat, lon)
+#     The haversine terms are separable, so only 1-D tables are computed before the final broadcast
+def calculateDistanceBlock(centerLatitudes, centerLongitudes, grid):
+    centerLatitudes = np.radians(np.asarray(centerLatitudes, dtype=np.float64))[:, np.newaxis]
+    centerLongitudes = np.radians(np.asarray(centerLongitudes, dtype=np.float64))[:, np.newaxis]
+    latitudeRadians = grid.latitudeRadians[np.newaxis, :]
+    longitudeRadians = grid.longitudeRadians[np.newaxis, :]
+    latitudeTerm = np.sin((latitudeRadians - centerLatitudes) * 0.5)**2
+    cosineTerm = np.cos(centerLatitudes) * grid.cosLatitudes[np.newaxis, :]
+    longitudeTerm = np.sin((longitudeRadians - centerLongitudes) * 0.5)**2
+    d = latitudeTerm[:, :, np.newaxis] + cosineTerm[:, :, np.newaxis] * longitudeTerm[:, np.newaxis, :]
+    return 2.0 * EARTH_RADIUS * np.arcsin(np.sqrt(d))
+
+
+def calculateDistanceGrid(center, grid):
+    return calculateDistanceBlock([center[0]], [center[1]], grid)[0]
+
+
+#     Returns rain in millimeters per hour for a (time, latitude, longitude) block of track centers
+def calculateRainBlock(centerLatitudes, centerLongitudes, winds, grid):
+    winds = np.asarray(winds, dtype=np.float64)[:, np.newaxis, np.newaxis]
+    t0, tm, rm, re = calculateRainProfile(winds)
+    distanceToCenter = calculateDistanceBlock(centerLatitudes, centerLongitudes, grid)
+    rain = np.where(distanceToCenter < rm,
+                    t0 + ((tm - t0) * (distanceToCenter/rm)),
+                    tm * np.exp(-1.0 * (distanceToCenter - rm)/re))
+    return rain * RAIN_CONVERSION
+
+
+#     Returns rain in millimeters per hour for the whole (latitude, longitude) grid
+def calculateRainGrid(center, grid, wind):
+    return calculateRainBlock([center[0]], [center[1]], [wind], grid)[0]
+
+
+#     Number of hourly slices that fit in batchMemory megabytes, counting the float64 temporaries of calculateRainBlock
+def calculateBatchSize(batchMemory, numLats, numLons):
+    bytesPerSlice = numLats * numLons * 8 * BATCH_TEMPORARIES
+    return max(1, int(batchMemory * 1024 * 1024 // bytesPerSlice))
+
+
+#     Per point reference implementation of calculateRainGrid
+def calculateRainReference(center, latitudes, longitudes, wind):
+    lineRains = []
+    for latitude in latitudes:
+        lineRain = []
+        for longitude in longitudes:
+            coordinate = (latitude, longitude)
+            lineRain.append(calculateRain(center, coordinate, wind))
+        lineRains.append(lineRain)
+    return np.array(lineRains)
+
+
 #     Returns rain in millimeters per hour
 def calculateRain(center, coordinate, wind):
-    a1 = -1.10
-    a2 = -1.60
-    a3 = 64.5
-    a4 = 150.0
-    b1 = 3.96
-    b2 = 4.80
-    b3  = -13.0
-    b4 = -16.0
     distanceToCenter = haversine.haversine(center, coordinate)
-    u = 1.0 + ((wind - 35.0)/33.0)
-#       Rain rate at r=0
-    t0 = a1 + b1*u
-#         Maximum rain rate
-    tm = a2 + b2*u
-    rm = a3 + b3*u
-    re = a4 + b4*u
+    t0, tm, rm, re = calculateRainProfile(wind)
     rain = 0.0
     if(distanceToCenter < rm):
         rain = t0 + ((tm - t0) * (distanceToCenter/rm))
@@ -92,4 +630,4 @@ def calculateRain(center, coordinate, wind):
     rain = rain * 1.4
 #         Convert from in/day to mm/day
     rain  = rain * 25.4
-    return rain
\ No newline at end of file
+    return rain
@@ -0,0 +1,241 @@
+import datetime
+import logging
+import math
+import os
+import re
+
+import numpy as np
+
+import owi2wind
+import Profiler
+from GridGeometry import GridGeometry, linspaceAxis
+from generateParametricRain import EARTH_RADIUS, calculateDistanceBlock
+
+
+# Holland (1980) parametric wind and pressure fields computed in process, written straight to an
+# OWI-NWS13 NetCDF file through owi2wind.OwiNetcdf instead of running windgfdl and parsing richamp.wnd.
+#
+# For each hour the track is interpolated to (center, Pc, Pb, Rmax, Vmax, R34) and a whole
+# (latitude, longitude) slice is evaluated at once:
+#   pressure     P(r) = Pc + (Pb - Pc) exp(-(Rmax/r)^B)
+#   gradient     Vg(r) = Vgmax s(r)^x with s(r) = (Rmax/r)^B exp(1 - (Rmax/r)^B), x = 0.5 inside Rmax
+#                and fitted outside Rmax so the surface wind at the mean 34 knot radius is 34 knots
+#   surface      scale_mw Vg(r) turned inward by the inflow angle, plus co_tsp times the storm motion
+#                weighted by Vg(r)/Vgmax
+# gust_fac turns the 1 minute track winds into the averaging period of the output, as in windgfdl.
+
+LOGGER = logging.getLogger(__name__)
+
+WIND_FILENAME = "RICHAMP_wind"
+# diag_parm.nml shipped next to this file, whatever the working directory
+DIAG_PARM_FILENAME = os.path.join(os.path.dirname(os.path.abspath(__file__)), "diag_parm.nml")
+# Values shipped in diag_parm.nml, used for any parameter the namelist does not set
+DIAG_PARM_DEFAULTS = {"scale_rmw": 1.0, "scale_mw": 0.8, "co_tsp": 0.70, "gust_fac": 0.93}
+
+AIR_DENSITY = 1.15
+MIN_HOLLAND_B = 1.0
+MAX_HOLLAND_B = 2.5
+# Outer profile exponent when no 34 knot radius is given, the original Holland profile
+DEFAULT_PROFILE_EXPONENT = 0.5
+MIN_PROFILE_EXPONENT = 0.1
+MAX_PROFILE_EXPONENT = 2.0
+# Inflow angle in degrees inside Rmax and beyond 1.2 Rmax, linear in between
+INNER_INFLOW = 10.0
+OUTER_INFLOW = 20.0
+WIND_34_KNOTS = 34.0 * 0.514444
+# Smallest pressure deficit (mbar) and distance (km) used, keeping the profile finite
+MIN_PRESSURE_DEFICIT = 1.0
+MIN_DISTANCE = 1.0e-3
+
+COMPARED_VARIABLES = ["wind_u", "wind_v", "speed", "pressure"]
+
+
+# Scale factors of the &diag_nml namelist, as floats
+def readDiagParm(filename=DIAG_PARM_FILENAME):
+    parameters = dict(DIAG_PARM_DEFAULTS)
+    with open(filename) as f:
+        text = f.read()
+    for name, value in re.findall(r"(\w+)\s*=\s*([-+0-9.eEdD]+)", text):
+        parameters[name.lower()] = float(value.replace("d", "e").replace("D", "e"))
+    return parameters
+
+
+# Generates hourly wind and pressure for the parsed track (Track.Track) on the Wind_Inp.txt grid
+# and writes them to filename + ".nc" in OWI-NWS13 format
+# diagParm holds the diag_parm.nml scale factors, see readDiagParm
+# outputOptions (OutputOptions) sets chunking, compression and write buffering of the NetCDF file
+# geometryCache (GridGeometry.GeometryCache) reuses the memory mapped grid coordinate and trigonometric tables
+# timeRange (mergeShards.TimeRange) only generates those hours, into a shard file for mergeShards
+def main(track, minLatitude, minLongitude, maxLatitude, maxLongitude, resolution, diagParm=None, outputOptions=None, filename=WIND_FILENAME, geometryCache=None, timeRange=None):
+    print("Generating Parametric Wind!")
+    diagParm = diagParm or dict(DIAG_PARM_DEFAULTS)
+    grid = windGrid(minLatitude, minLongitude, maxLatitude, maxLongitude, resolution, geometryCache)
+    owiGrid = owi2wind.WindGrid(grid.longitudes, grid.latitudes)
+    shard = None
+    indices = None
+    if(timeRange is not None):
+        shard = timeRange.shard(len(windHours(track)[1]))
+        indices = range(shard[0], shard[1])
+    wind = owi2wind.OwiNetcdf(filename, owiGrid, None, output_options=outputOptions, geometry_cache=geometryCache, shard=shard)
+    for index, date, pressure, u, v in generateWind(track, grid, diagParm, indices):
+        LOGGER.info("Generating wind, index %d", index)
+        wind.append(index, owi2wind.WindData(date, owiGrid, pressure, u, v))
+    wind.close()
+
+
+# The grid windgfdl writes for Wind_Inp.txt, built the way owi2wind.Owi306Wind reads it back,
+# so the two outputs line up point for point
+def windGrid(minLatitude, minLongitude, maxLatitude, maxLongitude, resolution, geometryCache=None):
+    step = float(1 / float(resolution))
+    numLats = int((maxLatitude - minLatitude) / step + 1)
+    numLons = int((maxLongitude - minLongitude) / step + 1)
+    latitudeAxis = linspaceAxis(minLatitude, step, numLats)
+    longitudeAxis = linspaceAxis(minLongitude, step, numLons)
+    if(geometryCache is not None):
+        return geometryCache.get(latitudeAxis, longitudeAxis)
+    return GridGeometry(latitudeAxis, longitudeAxis)
+
+
+# Hours of the track fixes and of the wind time steps, from the first fix
+def windHours(track):
+    trackHours = (track["time"] - track["time"][0]).astype("timedelta64[s]").astype(np.float64) / 3600.0
+    return trackHours, np.arange(0, math.floor(trackHours[-1]) + 1, dtype=np.float64)
+
+
+# Yields (index, date, pressure mbar, u m/s, v m/s) for every hour from the first track fix to the last,
+# or for the hours at indices
+def generateWind(track, grid, diagParm, indices=None):
+    startTime = track.startTime()
+    trackHours, hours = windHours(track)
+    latitudes = np.interp(hours, trackHours, track["latitude"])
+    longitudes = np.interp(hours, trackHours, track["longitude"])
+    centralPressures = np.interp(hours, trackHours, track["centralPressure"])
+    backgroundPressures = np.interp(hours, trackHours, track["backgroundPressure"])
+    radiusMaxWinds = np.interp(hours, trackHours, track["radiusMaxWind"]) * diagParm["scale_rmw"]
+    maxWinds = np.interp(hours, trackHours, track["maxWindSpeed"]) * diagParm["gust_fac"]
+    radius34s = np.interp(hours, trackHours, meanRadius(track["span34"]))
+    translationU, translationV = calculateTranslation(latitudes, longitudes)
+    for index in (range(len(hours)) if indices is None else indices):
+        hour = hours[index]
+        with Profiler.stage("wind compute", index):
+            pressure, u, v = calculateWindGrid((latitudes[index], longitudes[index]), grid, centralPressures[index],
+                                               backgroundPressures[index], radiusMaxWinds[index], maxWinds[index],
+                                               radius34s[index], translationU[index], translationV[index], diagParm)
+        yield index, startTime + datetime.timedelta(hours=hour), pressure, u, v
+
+
+# Mean of the given quadrant radii of each fix, NaN when no quadrant is given
+def meanRadius(spans):
+    spans = np.where(spans > 0, spans, np.nan)
+    given = np.isfinite(spans).any(axis=1)
+    radii = np.full(len(spans), np.nan)
+    radii[given] = np.nanmean(spans[given], axis=1)
+    return radii
+
+
+# Storm motion in m/s (eastward, northward) from the hourly centers
+def calculateTranslation(latitudes, longitudes):
+    if(len(latitudes) < 2):
+        return np.zeros(len(latitudes)), np.zeros(len(latitudes))
+    kilometersPerDegree = math.radians(1.0) * EARTH_RADIUS
+    eastward = np.gradient(longitudes) * kilometersPerDegree * np.cos(np.radians(latitudes))
+    northward = np.gradient(latitudes) * kilometersPerDegree
+#     km per hour to m/s
+    return eastward / 3.6, northward / 3.6
+
+
+# Holland B from the gradient level maximum wind (m/s) and pressure deficit (mbar)
+def calculateHollandB(maxGradientWind, pressureDeficit):
+    b = AIR_DENSITY * math.e * maxGradientWind**2 / (pressureDeficit * 100.0)
+    return min(max(b, MIN_HOLLAND_B), MAX_HOLLAND_B)
+
+
+# Radial shape (Rmax/r)^B exp(1 - (Rmax/r)^B) of the Holland profile, 1 at Rmax
+def calculateProfileShape(distance, radiusMaxWind, b):
+    scaled = (radiusMaxWind / np.maximum(distance, MIN_DISTANCE))**b
+    return scaled * np.exp(1.0 - scaled)
+
+
+# Outer exponent x that makes the gradient wind at radius34 equal to the gradient level 34 knot wind
+def calculateProfileExponent(radius34, radiusMaxWind, maxGradientWind, gradientWind34, b):
+    if(not np.isfinite(radius34) or radius34 <= radiusMaxWind or gradientWind34 >= maxGradientWind):
+        return DEFAULT_PROFILE_EXPONENT
+    shape = calculateProfileShape(radius34, radiusMaxWind, b)
+    x = math.log(gradientWind34 / maxGradientWind) / math.log(shape)
+    return min(max(x, MIN_PROFILE_EXPONENT), MAX_PROFILE_EXPONENT)
+
+
+# Compass bearing in radians from center to every grid point, shape (lat, lon)
+def calculateBearingGrid(center, grid):
+    centerLatitude = math.radians(center[0])
+    deltaLongitude = grid.longitudeRadians[np.newaxis, :] - math.radians(center[1])
+    latitudes = grid.latitudeRadians[:, np.newaxis]
+    x = np.sin(deltaLongitude) * grid.cosLatitudes[:, np.newaxis]
+    y = math.cos(centerLatitude) * np.sin(latitudes) - math.sin(centerLatitude) * grid.cosLatitudes[:, np.newaxis] * np.cos(deltaLongitude)
+    return np.arctan2(x, y)
+
+
+#     Returns pressure (mbar) and u, v (m/s) for the whole (latitude, longitude) grid
+#     Distances are km, winds m/s, pressures mbar
+def calculateWindGrid(center, grid, centralPressure, backgroundPressure, radiusMaxWind, maxWind, radius34, translationU, translationV, diagParm):
+    pressureDeficit = max(backgroundPressure - centralPressure, MIN_PRESSURE_DEFICIT)
+    translationSpeed = math.hypot(translationU, translationV)
+    maxGradientWind = max(maxWind - diagParm["co_tsp"] * translationSpeed, 0.0) / diagParm["scale_mw"]
+    b = calculateHollandB(maxGradientWind, pressureDeficit)
+    x = calculateProfileExponent(radius34, radiusMaxWind, maxGradientWind, WIND_34_KNOTS / diagParm["scale_mw"], b)
+
+    distance = calculateDistanceBlock([center[0]], [center[1]], grid)[0]
+    scaled = (radiusMaxWind / np.maximum(distance, MIN_DISTANCE))**b
+    pressure = centralPressure + pressureDeficit * np.exp(-scaled)
+    shape = scaled * np.exp(1.0 - scaled)
+    gradientWind = maxGradientWind * shape**np.where(distance < radiusMaxWind, DEFAULT_PROFILE_EXPONENT, x)
+
+    inflow = np.radians(np.interp(distance / radiusMaxWind, [1.0, 1.2], [INNER_INFLOW, OUTER_INFLOW]))
+#     Cyclonic flow runs counterclockwise in the northern hemisphere, clockwise in the southern
+    bearing = calculateBearingGrid(center, grid)
+    if(center[0] >= 0):
+        direction = bearing - math.pi / 2.0 - inflow
+    else:
+        direction = bearing + math.pi / 2.0 + inflow
+    surfaceWind = diagParm["scale_mw"] * gradientWind
+    motionWeight = diagParm["co_tsp"] * gradientWind / maxGradientWind if maxGradientWind > 0 else 0.0
+    u = surfaceWind * np.sin(direction) + motionWeight * translationU
+    v = surfaceWind * np.cos(direction) + motionWeight * translationV
+    return pressure, u, v
+
+
+# Differences between the in process wind and a windgfdl richamp.wnd read through owi2wind.Owi306Wind,
+# compared over the hours both hold. Returns {variable: {"bias", "rmse", "maxAbs"}} and prints a table.
+def compareWithWindgfdl(track, windFilename, windInputFilename, diagParm=None, geometryCache=None):
+    diagParm = diagParm or dict(DIAG_PARM_DEFAULTS)
+    reference = owi2wind.Owi306Wind(windFilename, windInputFilename, geometryCache)
+    referenceGrid = reference.grid()
+    latitudeRadians = np.radians(referenceGrid.lat1d())
+    grid = GridGeometry(None, None, {"latitudes": referenceGrid.lat1d(), "longitudes": referenceGrid.lon1d(),
+                                     "latitudeRadians": latitudeRadians, "longitudeRadians": np.radians(referenceGrid.lon1d()),
+                                     "cosLatitudes": np.cos(latitudeRadians)})
+    sums = {name: {"count": 0, "sum": 0.0, "squares": 0.0, "maxAbs": 0.0} for name in COMPARED_VARIABLES}
+    numTimes = reference.num_times()
+    for index, date, pressure, u, v in generateWind(track, grid, diagParm):
+        if(index >= numTimes):
+            break
+        windgfdl = reference.get(index)
+        differences = {"wind_u": u - windgfdl.u_velocity(), "wind_v": v - windgfdl.v_velocity(),
+                       "speed": np.hypot(u, v) - np.hypot(windgfdl.u_velocity(), windgfdl.v_velocity()),
+                       "pressure": pressure - windgfdl.pressure()}
+        for name, difference in differences.items():
+            difference = difference[np.isfinite(difference)]
+            sums[name]["count"] += difference.size
+            sums[name]["sum"] += float(difference.sum())
+            sums[name]["squares"] += float((difference.astype(np.float64)**2).sum())
+            if(difference.size > 0):
+                sums[name]["maxAbs"] = max(sums[name]["maxAbs"], float(np.abs(difference).max()))
+    reference.close()
+
+    report = {}
+    print("Variable".ljust(10), "Bias".rjust(10), "RMSE".rjust(10), "Max |diff|".rjust(11))
+    for name in COMPARED_VARIABLES:
+        count = max(sums[name]["count"], 1)
+        report[name] = {"bias": sums[name]["sum"] / count, "rmse": math.sqrt(sums[name]["squares"] / count), "maxAbs": sums[name]["maxAbs"]}
+        print(name.ljust(10), format(report[name]["bias"], "10.3f"), format(report[name]["rmse"], "10.3f"), format(report[name]["maxAbs"], "11.3f"))
+    return report
@@ -1,7 +1,19 @@
 import argparse
+import glob
+import logging
 import sys
 import os
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
 import generateParametricInput
+import generateParametricRain
+import generateParametricWind
+import pipeline
+from mergeShards import TimeRange
+import Profiler
+import Track
+from OutputOptions import OutputOptions
+from GridGeometry import GeometryCache, DEFAULT_CACHE_MB
 
 
 def parseArguments():
@@ -15,6 +27,62 @@ def parseArguments():
     
     # Example argument
     parser.add_argument("-f", "--file", type=str, help="Track file")
+    parser.add_argument("--batch", type=str, default=None,
+                        help="Directory of .trk files or a glob of track files, each storm is written to its own output directory")
+    parser.add_argument("-o", "--output-directory", type=str, default=".",
+                        help="Output directory. In batch mode each storm gets a subdirectory named after its track file. Default: .")
+    parser.add_argument("--batch-workers", type=int, default=1,
+                        help="Number of storms run concurrently in batch mode. Default: 1")
+    parser.add_argument("--rain-mode", type=str, choices=generateParametricRain.RAIN_MODES, default="vectorized",
+                        help="Rain engine, vectorized whole grid or per point reference. Default: vectorized")
+    parser.add_argument("--batch-memory", type=float, default=None,
+                        help="Memory budget in MB for computing and writing blocks of hourly rain slices at once. Default: one slice at a time")
+    parser.add_argument("--workers", type=int, default=1,
+                        help="Number of processes computing rain slices in parallel. Default: 1")
+    cutoff = parser.add_mutually_exclusive_group()
+    cutoff.add_argument("--rain-cutoff-distance", type=float, default=None,
+                        help="Only evaluate rain within this distance (km) of the storm center. Default: whole grid")
+    cutoff.add_argument("--rain-cutoff-rate", type=float, default=None,
+                        help="Only evaluate rain where the profile exceeds this rate (mm/hr). Default: whole grid")
+    parser.add_argument("--rain-cutoff-fill", type=str, choices=generateParametricRain.RainCulling.FILLS, default="zero",
+                        help="Value written beyond the rain cutoff, zero or the NetCDF fill value. Default: zero")
+    parser.add_argument("--geometry-cache", type=str, default=None,
+                        help="Directory caching memory mapped grid coordinate tables across runs and workers. Default: None")
+    parser.add_argument("--geometry-cache-size", type=float, default=DEFAULT_CACHE_MB,
+                        help="Size in MB past which least recently used geometry cache entries are removed. Default: " + str(DEFAULT_CACHE_MB))
+    parser.add_argument("--rain-cache", type=str, default=None,
+                        help="Directory caching computed rain slices by track center, wind, grid and settings. Default: None")
+    parser.add_argument("--rain-cache-size", type=float, default=generateParametricRain.DEFAULT_RAIN_CACHE_MB,
+                        help="Size in MB past which least recently used rain cache entries are removed. Default: " + str(generateParametricRain.DEFAULT_RAIN_CACHE_MB))
+    parser.add_argument("--incremental", action="store_true",
+                        help="Update the existing rain output for a new advisory, recomputing only the hours whose track changed")
+    parser.add_argument("--ensemble", type=str, default=None, metavar="SPEC",
+                        help="Rain of a track ensemble written to " + generateParametricInput.ENSEMBLE_RAIN_FILENAME + ", e.g. members=50,cross=40,along=60,intensity=8,seed=1 "
+                             "with standard deviations per day of lead time in km (cross, along) and knots (intensity). Default: None")
+    parser.add_argument("--ensemble-rate-thresholds", type=str, default=",".join(str(threshold) for threshold in generateParametricRain.DEFAULT_RATE_THRESHOLDS),
+                        help="Rain rates (mm/hr) of the ensemble probability of exceedance. Default: %(default)s")
+    parser.add_argument("--ensemble-total-thresholds", type=str, default=",".join(str(threshold) for threshold in generateParametricRain.DEFAULT_TOTAL_THRESHOLDS),
+                        help="Storm total rain (mm) of the ensemble probability of exceedance. Default: %(default)s")
+    parser.add_argument("--time-range", type=str, default=None, metavar="start:end",
+                        help="Only generate hours start to end - 1 of the rain (and parametric wind) into shard files for mergeShards.py. Default: every hour")
+    parser.add_argument("--wind-engine", type=str, choices=generateParametricInput.WIND_ENGINES, default="windgfdl",
+                        help="windgfdl only writes its track.richamp and Wind_Inp.txt inputs, parametric also writes " + generateParametricWind.WIND_FILENAME + ".nc in process. Default: windgfdl")
+    parser.add_argument("--diag-parm", type=str, default=generateParametricWind.DIAG_PARM_FILENAME,
+                        help="Namelist with the parametric wind scale factors. Default: diag_parm.nml next to generator.py")
+    parser.add_argument("--compare-windgfdl", type=str, default=None, metavar="WND",
+                        help="Report differences between the parametric wind and this windgfdl richamp.wnd, read with Wind_Inp.txt of the output directory")
+    parser.add_argument("--run-windgfdl", type=str, default=None, metavar="PATH",
+                        help="Run this windgfdl program, the rain and the conversion of its richamp.wnd to " + pipeline.WIND_FILENAME + ".nc at the same time. Default: None")
+    for stage in pipeline.STAGE_NAMES:
+        parser.add_argument("--" + stage + "-timeout", type=float, default=None, metavar="seconds",
+                            help="With --run-windgfdl, stop the run when the " + stage + " stage takes longer than this. Default: no limit")
+    parser.add_argument("--profile", type=str, default=None,
+                        help="Write a JSON report of time, bytes and memory per stage and per timestep. In batch mode only storms run in this process (--batch-workers 1) are profiled. "
+                             "With --run-windgfdl the rain and conversion processes also write PROFILE.rain.json and PROFILE.conversion.json, "
+                             "merged into the report as rain: and conversion: stages. Default: None")
+    parser.add_argument("--log-level", type=str, default="WARNING", choices=["DEBUG", "INFO", "WARNING", "ERROR"],
+                        help="Level of the per timestep log messages. Default: WARNING")
+    OutputOptions.addArguments(parser)
     
     # You can add more arguments here as needed
     
@@ -32,7 +100,137 @@ def entryPoint():
         sys.exit(1)
     
 def main(args):
-    generateParametricInput.main(args.file)
+    logging.basicConfig(level=args.log_level, format="%(levelname)s: %(message)s")
+    if args.profile is not None:
+        Profiler.enable()
+    try:
+        run(args)
+    finally:
+        if args.profile is not None:
+            Profiler.write(args.profile, " ".join(sys.argv))
+
+
+def run(args):
+    rainCulling = None
+    if args.rain_cutoff_distance is not None or args.rain_cutoff_rate is not None:
+        rainCulling = generateParametricRain.RainCulling(cutoffDistance=args.rain_cutoff_distance, cutoffRain=args.rain_cutoff_rate,
+                                                         fill=args.rain_cutoff_fill)
+    geometryCache = None
+    if args.geometry_cache is not None:
+        geometryCache = GeometryCache(args.geometry_cache, args.geometry_cache_size)
+    rainCache = None
+    if args.rain_cache is not None:
+        rainCache = generateParametricRain.RainCache(args.rain_cache, args.rain_cache_size)
+    options = {"rainMode": args.rain_mode, "batchMemory": args.batch_memory, "rainWorkers": args.workers,
+               "rainCulling": rainCulling, "outputOptions": OutputOptions.fromArguments(args), "geometryCache": geometryCache,
+               "windEngine": args.wind_engine, "diagParm": None, "incremental": args.incremental, "rainCache": rainCache, "ensemble": None,
+               "timeRange": None if args.time_range is None else TimeRange.parse(args.time_range)}
+    if args.ensemble is not None:
+        options["ensemble"] = generateParametricRain.EnsembleSpec.parse(args.ensemble, parseThresholds(args.ensemble_rate_thresholds),
+                                                                        parseThresholds(args.ensemble_total_thresholds))
+    if args.wind_engine == "parametric" or args.compare_windgfdl is not None:
+        options["diagParm"] = generateParametricWind.readDiagParm(args.diag_parm)
+    if args.batch is not None:
+        if args.file is not None:
+            raise RuntimeError("Use either --file or --batch, not both")
+        if args.compare_windgfdl is not None:
+            raise RuntimeError("--compare-windgfdl compares a single storm, it cannot be used with --batch")
+        if args.run_windgfdl is not None:
+            raise RuntimeError("--run-windgfdl runs a single storm, it cannot be used with --batch")
+        results = runBatch(findTracks(args.batch), args.output_directory, args.batch_workers, options)
+        printSummary(results)
+        if any(result["error"] is not None for result in results):
+            sys.exit(1)
+        return
+    if args.file is None:
+        raise RuntimeError("A track file (--file) or --batch is required")
+    if args.run_windgfdl is not None:
+        if args.wind_engine != "windgfdl" or args.compare_windgfdl is not None or args.ensemble is not None or args.time_range is not None:
+            raise RuntimeError("--run-windgfdl runs the windgfdl engine and all hours of the deterministic rain, it cannot be used with --wind-engine parametric, --compare-windgfdl, --ensemble or --time-range")
+        rainOptions = {key: options[key] for key in ["rainMode", "batchMemory", "rainWorkers", "rainCulling", "incremental", "rainCache"]}
+        timeouts = {stage: getattr(args, stage + "_timeout") for stage in pipeline.STAGE_NAMES}
+        pipeline.main(args.file, args.run_windgfdl, args.output_directory, args.diag_parm, rainOptions, options["outputOptions"],
+                      geometryCache, timeouts, profile=args.profile)
+        return
+    generateParametricInput.main(args.file, outputDirectory=args.output_directory, **options)
+    if args.compare_windgfdl is not None:
+        print("Comparing parametric wind with", args.compare_windgfdl)
+        generateParametricWind.compareWithWindgfdl(Track.readTrack(args.file), args.compare_windgfdl,
+                                                   os.path.join(args.output_directory, "Wind_Inp.txt"), options["diagParm"],
+                                                   options["geometryCache"])
+
+
+def parseThresholds(text):
+    try:
+        return [float(threshold) for threshold in text.split(",")]
+    except ValueError:
+        raise RuntimeError("Invalid thresholds " + text + ", expected comma separated numbers")
+
+
+# Track files of a batch, a directory yields every .trk file inside it
+def findTracks(pattern):
+    if os.path.isdir(pattern):
+        pattern = os.path.join(pattern, "*.trk")
+    tracks = sorted(track for track in glob.glob(pattern) if os.path.isfile(track))
+    if not tracks:
+        raise RuntimeError("No track files found for " + pattern)
+    return tracks
+
+
+# One output directory per storm, named after the track file
+def stormDirectories(tracks, outputDirectory):
+    directories = {}
+    for track in tracks:
+        stem = os.path.splitext(os.path.basename(track))[0]
+        directory = os.path.join(outputDirectory, stem)
+        if directory in directories.values():
+            raise RuntimeError("Track files with the same name would share the output directory " + directory)
+        directories[track] = directory
+    return directories
+
+
+# Runs one storm, failures are returned rather than raised so one bad track does not stop the batch
+def runStorm(track, outputDirectory, options):
+    start = time.perf_counter()
+    result = {"track": track, "outputDirectory": outputDirectory, "stormName": None, "stormClass": None, "error": None}
+    try:
+        result["stormName"], result["stormClass"] = generateParametricInput.main(track, outputDirectory=outputDirectory, **options)
+    except Exception as e:
+        result["error"] = type(e).__name__ + ": " + str(e)
+    result["seconds"] = time.perf_counter() - start
+    return result
+
+
+# Runs the storms on a pool of batchWorkers processes, results are returned in track order
+def runBatch(tracks, outputDirectory, batchWorkers, options):
+    directories = stormDirectories(tracks, outputDirectory)
+    if batchWorkers <= 1:
+        return [runStorm(track, directories[track], options) for track in tracks]
+    results = {}
+    with ProcessPoolExecutor(max_workers=batchWorkers) as executor:
+        futures = {executor.submit(runStorm, track, directories[track], options): track for track in tracks}
+        for future in as_completed(futures):
+            track = futures[future]
+            try:
+                results[track] = future.result()
+            except Exception as e:
+#                 The worker process itself died
+                results[track] = {"track": track, "outputDirectory": directories[track], "stormName": None, "stormClass": None,
+                                  "error": type(e).__name__ + ": " + str(e), "seconds": float("nan")}
+            print("Finished", track, "in", round(results[track]["seconds"], 2), "s" if results[track]["error"] is None else "s (failed)")
+    return [results[track] for track in tracks]
+
+
+def printSummary(results):
+    width = max(len("Track"), max(len(result["track"]) for result in results))
+    print()
+    print("Track".ljust(width), "Storm".ljust(12), "Class".ljust(5), "Seconds".rjust(9), " Status")
+    for result in results:
+        status = "ok" if result["error"] is None else "FAILED " + result["error"]
+        print(result["track"].ljust(width), str(result["stormName"] or "-").ljust(12), str(result["stormClass"] or "-").ljust(5),
+              format(result["seconds"], "9.2f"), "", status)
+    failures = sum(1 for result in results if result["error"] is not None)
+    print(len(results), "storms,", failures, "failed,", format(sum(result["seconds"] for result in results), ".2f"), "storm seconds")
     
 if __name__ == "__main__":
     entryPoint()
\ No newline at end of file
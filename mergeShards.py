@@ -0,0 +1,198 @@
+import argparse
+import os
+import shutil
+import sys
+
+import netCDF4
+import numpy as np
+
+import Swath
+
+# Time range sharding. generator.py and owi2wind.py run with --time-range start:end only compute and write time
+# steps start to end - 1 of the full run, into a partial NetCDF file whose time and time_unix values are those of
+# the full run. The file records the shard in its time_range_start, time_range_end and time_steps_total attributes.
+#
+# merge() concatenates the shards of one run along time. The first shard is copied and extended. The other shards
+# are copied variable by variable: with h5py installed, a variable whose shard starts on a chunk boundary of the
+# output is copied as its compressed chunks, so its slices are never decompressed or recompressed. Everything else
+# is copied as raw stored values, packed variables included. The shards must come from the same run and cover
+# every time step exactly once. Swath summaries (see Swath) are combined: maxima keep the earliest time they were
+# reached. The shards hold their storm totals rounded to float32, so a swath with a total is read back from the
+# merged values instead, giving the total of an unsharded run.
+
+SHARD_ATTRIBUTES = ["time_range_start", "time_range_end", "time_steps_total"]
+
+
+# Time steps start to end - 1 of a run, parsed from "start:end" where either side may be left open
+class TimeRange:
+    def __init__(self, start=0, end=None):
+        if(start < 0 or (end is not None and end <= start)):
+            raise RuntimeError("Invalid time range " + str(start) + ":" + ("" if end is None else str(end)) + ", it must be non negative and not empty")
+        self.start = start
+        self.end = end
+
+    @staticmethod
+    def parse(text):
+        start, separator, end = text.partition(":")
+        try:
+            if(not separator):
+                raise ValueError()
+            return TimeRange(int(start) if start.strip() else 0, int(end) if end.strip() else None)
+        except ValueError:
+            raise RuntimeError("Invalid time range " + repr(text) + ", expected start:end time step indices")
+
+    # (start, end, total) of this range in a run of numTimes time steps, the shard of the writers
+    def shard(self, numTimes):
+        if(self.start >= numTimes):
+            raise RuntimeError("Time range starts at " + str(self.start) + ", past the " + str(numTimes) + " time steps of the run")
+        return (self.start, numTimes if self.end is None else min(self.end, numTimes), numTimes)
+
+
+# Records a (start, end, total) shard in the global attributes of a NetCDF dataset
+def writeShardAttributes(dataset, shard):
+    for name, value in zip(SHARD_ATTRIBUTES, shard):
+        dataset.setncattr(name, np.int64(value))
+
+
+# Shard attributes, time step variables (name -> index of the time dimension) and coordinates of a shard file
+def readShard(filename):
+    with netCDF4.Dataset(filename, "r") as dataset:
+        if(any(name not in dataset.ncattrs() for name in SHARD_ATTRIBUTES)):
+            raise RuntimeError(filename + " was not written with --time-range")
+        start, end, total = (int(dataset.getncattr(name)) for name in SHARD_ATTRIBUTES)
+        numTimes = len(dataset.dimensions["time"])
+        if(numTimes != end - start):
+            raise RuntimeError(filename + " holds " + str(numTimes) + " time steps, its time range " + str(start) + ":" + str(end) + " needs " + str(end - start))
+        variables = {name: variable.dimensions.index("time") for name, variable in dataset.variables.items() if "time" in variable.dimensions}
+        coordinates = {name: np.array(dataset[name][:]) for name in ["lat", "lon"] if name in dataset.variables}
+        types = {name: (variable.dtype, variable.dimensions) for name, variable in dataset.variables.items()}
+    return {"filename": filename, "start": start, "end": end, "total": total, "variables": variables, "coordinates": coordinates, "types": types}
+
+
+# Shards sorted by start, raises RuntimeError unless they come from the same run and cover it without gaps or overlap
+def validateShards(shards):
+    if(not shards):
+        raise RuntimeError("No shards to merge")
+    shards = sorted(shards, key=lambda shard: shard["start"])
+    first = shards[0]
+    for shard in shards[1:]:
+        if(shard["total"] != first["total"] or shard["types"] != first["types"]
+           or any(not np.array_equal(shard["coordinates"][name], values) for name, values in first["coordinates"].items())):
+            raise RuntimeError(shard["filename"] + " does not come from the same run as " + first["filename"])
+    end = 0
+    for shard in shards:
+        if(shard["start"] < end):
+            raise RuntimeError(shard["filename"] + " overlaps time steps " + str(shard["start"]) + " to " + str(end - 1))
+        if(shard["start"] > end):
+            raise RuntimeError("No shard covers time steps " + str(end) + " to " + str(shard["start"] - 1))
+        end = shard["end"]
+    if(end != first["total"]):
+        raise RuntimeError("No shard covers time steps " + str(end) + " to " + str(first["total"] - 1))
+    return shards
+
+
+# Copies the variables of shard into the extended output, returns the number of variables copied as compressed chunks
+def copyShardChunks(output, shard):
+    import h5py
+    directCopies = 0
+    with h5py.File(shard["filename"], "r") as source:
+        for name, axis in shard["variables"].items():
+            sourceVariable = source[name]
+            outputVariable = output[name]
+            timeSlice = tuple(slice(shard["start"], shard["end"]) if dimension == axis else slice(None) for dimension in range(outputVariable.ndim))
+            aligned = (sourceVariable.chunks is not None and sourceVariable.chunks == outputVariable.chunks
+                       and sourceVariable.compression == outputVariable.compression
+                       and sourceVariable.compression_opts == outputVariable.compression_opts
+                       and sourceVariable.shuffle == outputVariable.shuffle
+                       and shard["start"] % outputVariable.chunks[axis] == 0
+                       and ((shard["end"] - shard["start"]) % outputVariable.chunks[axis] == 0 or shard["end"] == shard["total"]))
+            if(not aligned):
+                outputVariable[timeSlice] = sourceVariable[...]
+                continue
+            for index in range(sourceVariable.id.get_num_chunks()):
+                offset = sourceVariable.id.get_chunk_info(index).chunk_offset
+                filterMask, chunk = sourceVariable.id.read_direct_chunk(offset)
+                outputOffset = tuple(position + shard["start"] if dimension == axis else position for dimension, position in enumerate(offset))
+                outputVariable.id.write_direct_chunk(outputOffset, chunk, filterMask)
+            directCopies = directCopies + 1
+    return directCopies
+
+
+# Without h5py every shard is copied through netCDF4 as raw stored values
+def copyShardValues(output, shard):
+    with netCDF4.Dataset(shard["filename"], "r") as source:
+        source.set_auto_maskandscale(False)
+        for name, axis in shard["variables"].items():
+            timeSlice = tuple(slice(shard["start"], shard["end"]) if dimension == axis else slice(None) for dimension in range(output[name].ndim))
+            output[name][timeSlice] = source[name][:]
+
+
+# Combines the swath variables (cell_methods "time: maximum" named <name>_max, with <name>_max_time and an
+# optional <name>_total) of every shard into merged
+def mergeSwaths(merged, shards):
+    for variableName, variable in merged.variables.items():
+        if("time" in variable.dimensions or getattr(variable, "cell_methods", None) != "time: maximum" or not variableName.endswith("_max")):
+            continue
+        name = variableName[:-len("_max")]
+        if(name + "_total" in merged.variables):
+            swath = Swath.read(merged, name, total=True)
+        else:
+            swath = Swath.Swath(variable.shape)
+            for shard in shards:
+                with netCDF4.Dataset(shard["filename"], "r") as source:
+                    swath.combine(np.ma.filled(source[name + "_max"][:], -np.inf).astype(np.float32),
+                                  np.ma.filled(source[name + "_max_time"][:], Swath.TIME_FILL))
+        for valueName, values in swath.values(name).items():
+            merged[valueName][:] = values
+
+
+# Writes the merged file, returns the number of time steps and the number of shard variables copied as compressed chunks
+def merge(filenames, output):
+    shards = validateShards([readShard(filename) for filename in filenames])
+    total = shards[0]["total"]
+    temporary = output + ".{:d}.tmp".format(os.getpid())
+    shutil.copyfile(shards[0]["filename"], temporary)
+    directCopies = 0
+    try:
+        try:
+            import h5py
+        except ImportError:
+            h5py = None
+        if(h5py is not None):
+            with h5py.File(temporary, "r+") as merged:
+                for name, axis in shards[0]["variables"].items():
+                    merged[name].resize(total, axis=axis)
+                for shard in shards[1:]:
+                    directCopies = directCopies + copyShardChunks(merged, shard)
+        else:
+            with netCDF4.Dataset(temporary, "a") as merged:
+                merged.set_auto_maskandscale(False)
+                for shard in shards[1:]:
+                    copyShardValues(merged, shard)
+        with netCDF4.Dataset(temporary, "a") as merged:
+            if(len(merged.dimensions["time"]) != total):
+                raise RuntimeError("Merged file holds " + str(len(merged.dimensions["time"])) + " time steps instead of " + str(total))
+            mergeSwaths(merged, shards)
+            writeShardAttributes(merged, (0, total, total))
+    except BaseException:
+        os.remove(temporary)
+        raise
+    os.replace(temporary, output)
+    return total, directCopies
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Merge NetCDF shards written with --time-range into one file")
+    parser.add_argument("shards", metavar="shard", type=str, nargs="+", help="Shard files of one run, in any order")
+    parser.add_argument("-o", "--output", type=str, required=True, help="Merged NetCDF file")
+    args = parser.parse_args()
+    try:
+        total, directCopies = merge(args.shards, args.output)
+    except Exception as e:
+        print(f"An error occurred: {e}", file=sys.stderr)
+        sys.exit(1)
+    print("Merged", len(args.shards), "shards,", total, "time steps, into", args.output + ",", directCopies, "shard variables copied as compressed chunks")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,12 +1,16 @@
 #!/usr/bin/env python3
 # Contact: Josh Port (joshua_port@uri.edu) (MODIFICATIONS FOR OWI)
-# Requirements: python3, numpy, netCDF4, scipy
+# Requirements: python3, numpy, netCDF4
 #
 # Converts OWI-NWS12 (ASCII) data to OWI-NWS13 (NetCDF) format
 # Based on the COAMPS-TC to OWI converter by Zach Cobell
 #
 import datetime
+import logging
 import numpy
+import Profiler
+import Swath
+LOGGER = logging.getLogger(__name__)
 class WindGrid:
     def __init__(self, lon, lat):
 #         print(lon, lat)
@@ -37,10 +41,10 @@ class WindGrid:
         return self.__lat
 
     def lon1d(self):
-        return self.__lon1d
+        return numpy.asarray(self.__lon)
 
     def lat1d(self):
-        return self.__lat1d
+        return numpy.asarray(self.__lat)
 
     def d_longitude(self):
         return self.__d_longitude
@@ -88,19 +92,97 @@ class WindGrid:
         y = np.arange(y1,y2,dy)
         return WindGrid(x,y)
 
+    @staticmethod
+    def from_axes(latitude_axis, longitude_axis, geometry_cache=None):
+        # Axes are GridGeometry axis descriptions; with a GeometryCache the coordinates are
+        # memory mapped from the shared cache instead of being rebuilt
+        from GridGeometry import buildAxis
+        if geometry_cache is None:
+            return WindGrid(buildAxis(longitude_axis), buildAxis(latitude_axis))
+        geometry = geometry_cache.get(latitude_axis, longitude_axis)
+        return WindGrid(geometry.longitudes, geometry.latitudes)
+
     @staticmethod
     def interpolate_to_grid(original_grid, original_data, new_grid):
-        from scipy import interpolate
-        func = interpolate.interp2d(original_grid.lon1d(),original_grid.lat1d(),original_data,kind='linear')
-        return func(new_grid.lon1d(),new_grid.lat1d())
+        return RegridWeights(original_grid, new_grid).apply(original_data)
+
+
+class RegridWeights:
+    # Bilinear weights from a rectilinear source grid to a target grid. Both grids are
+    # rectilinear, so the weights separate into one index/weight table per axis that is
+    # computed once and applied to any number of (..., lat, lon) fields with two gathers.
+    # Target points outside the source grid take the value of the nearest edge.
+    def __init__(self, source_grid, target_grid, cache_dir=None):
+        import os
+        self.__source_lon = source_grid.lon1d()
+        self.__source_lat = source_grid.lat1d()
+        cache_file = None
+        if cache_dir:
+            cache_file = os.path.join(cache_dir, "regrid_" + RegridWeights.__key(source_grid, target_grid) + ".npz")
+        if cache_file and os.path.exists(cache_file):
+            weights = numpy.load(cache_file)
+            self.__lon_idx = weights["lon_idx"]
+            self.__lon_wgt = weights["lon_wgt"]
+            self.__lat_idx = weights["lat_idx"]
+            self.__lat_wgt = weights["lat_wgt"]
+            return
+        self.__lon_idx, self.__lon_wgt = RegridWeights.__axis_weights(self.__source_lon, target_grid.lon1d())
+        self.__lat_idx, self.__lat_wgt = RegridWeights.__axis_weights(self.__source_lat, target_grid.lat1d())
+        if cache_file:
+            os.makedirs(cache_dir, exist_ok=True)
+            temp_file = cache_file + ".{:d}.tmp.npz".format(os.getpid())
+            numpy.savez(temp_file, lon_idx=self.__lon_idx, lon_wgt=self.__lon_wgt,
+                        lat_idx=self.__lat_idx, lat_wgt=self.__lat_wgt)
+            os.replace(temp_file, cache_file)
+
+    def matches(self, source_grid):
+        return numpy.array_equal(self.__source_lon, source_grid.lon1d()) and \
+            numpy.array_equal(self.__source_lat, source_grid.lat1d())
+
+    def apply(self, data):
+        data = numpy.asarray(data)
+        lon_wgt = self.__lon_wgt.astype(data.dtype)
+        lat_wgt = self.__lat_wgt.astype(data.dtype)[:, numpy.newaxis]
+        left = numpy.take(data, self.__lon_idx, axis=-1)
+        right = numpy.take(data, self.__lon_idx + 1, axis=-1)
+        along_lon = left + (right - left) * lon_wgt
+        lower = numpy.take(along_lon, self.__lat_idx, axis=-2)
+        upper = numpy.take(along_lon, self.__lat_idx + 1, axis=-2)
+        return lower + (upper - lower) * lat_wgt
+
+    @staticmethod
+    def __axis_weights(source, target):
+        # Index of the source cell holding each target point and the fractional position inside it
+        # A single point axis keeps its value with zero weight on the (repeated) neighbour
+        if len(source) < 2:
+            return numpy.zeros(len(target), dtype=numpy.intp), numpy.zeros(len(target))
+        ascending = source[-1] > source[0]
+        if not ascending:
+            source = source[::-1]
+        target = numpy.clip(target, source[0], source[-1])
+        idx = numpy.clip(numpy.searchsorted(source, target, side="right") - 1, 0, len(source) - 2)
+        weight = (target - source[idx]) / (source[idx + 1] - source[idx])
+        if not ascending:
+            idx = len(source) - 2 - idx
+            weight = 1.0 - weight
+        return idx, weight
+
+    @staticmethod
+    def __key(source_grid, target_grid):
+        import hashlib
+        digest = hashlib.sha1()
+        for axis in (source_grid.lon1d(), source_grid.lat1d(), target_grid.lon1d(), target_grid.lat1d()):
+            digest.update(numpy.ascontiguousarray(axis, dtype=numpy.float64).tobytes())
+            digest.update(b"|")
+        return digest.hexdigest()
 
 
 class WindData:
     def __init__(self, date, wind_grid, pressure, u_velocity, v_velocity):
         import numpy
         self.__pressure = pressure
-        self.__u_velocity = numpy.array(u_velocity)
-        self.__v_velocity = numpy.array(v_velocity)
+        self.__u_velocity = numpy.asarray(u_velocity)
+        self.__v_velocity = numpy.asarray(v_velocity)
         self.__date = date
         self.__wind_grid = wind_grid
 
@@ -121,23 +203,42 @@ class WindData:
 
 
 class OwiNetcdf:
-    def __init__(self, filename, wind_grid, bounds):
+    # Physical ranges covered by packed output (OutputOptions.packed), PSFC in mb and wind in m s-1
+    PRESSURE_RANGE = (800.0, 1100.0)
+    WIND_RANGE = (-150.0, 150.0)
+
+    # shard (start, end, total) writes only time slices start to end - 1 of total, see mergeShards.
+    # Indices passed to append stay those of the full run.
+    def __init__(self, filename, wind_grid, bounds, weights_cache=None, output_options=None, geometry_cache=None, shard=None):
         import netCDF4
+        from GridGeometry import arangeAxis
         from datetime import datetime
+        from OutputOptions import OutputOptions, WriteBuffer
+        from OutputStore import createStore
+        from mergeShards import writeShardAttributes
         self.__filename = filename
+        self.__index_offset = 0 if shard is None else shard[0]
+        self.__output_options = output_options or OutputOptions()
+        self.__buffer = WriteBuffer(self.__output_options.bufferSize, self.__write_block)
         self.__wind_grid = wind_grid
         self.__bounds = bounds
-        self.__nc = netCDF4.Dataset(self.__filename + ".nc", "w")
+        self.__weights_cache = weights_cache
+        self.__regrid = None
+        # With a directory store self.__nc is the template, see OutputStore
+        self.__store = createStore(self.__filename + ".nc", self.__output_options)
+        self.__nc = self.__store.dataset
         self.__conventions = "OWI-NWS13"
         self.__nc.source = "OWI ASCII to OWI NetCDF converter"
         self.__nc.author = "Josh Port"
         self.__nc.contact = "joshua_port@uri.edu"
+        if shard is not None:
+            writeShardAttributes(self.__nc, shard)
             
         if self.__bounds:
-            self.__equidistant_wind_grid = WindGrid.generate_equidistant_grid(
-                                        xll=self.__bounds[0],yll=self.__bounds[1],
-                                        xur=self.__bounds[2],yur=self.__bounds[3],
-                                        dx=self.__bounds[4],dy=self.__bounds[5])
+            self.__equidistant_wind_grid = WindGrid.from_axes(
+                                        arangeAxis(self.__bounds[1], self.__bounds[3], self.__bounds[5]),
+                                        arangeAxis(self.__bounds[0], self.__bounds[2], self.__bounds[4]),
+                                        geometry_cache)
 
         # Create dimensions
         self.__nc_dim_time = self.__nc.createDimension("time", None)
@@ -148,22 +249,24 @@ class OwiNetcdf:
             self.__nc_dim_longitude = self.__nc.createDimension("longitude", self.__wind_grid.n_longitude())
             self.__nc_dim_latitude = self.__nc.createDimension("latitude", self.__wind_grid.n_latitude())
 
+        coordinate_arguments = self.__output_options.coordinateArguments()
+        num_lats = len(self.__nc_dim_latitude)
+        num_lons = len(self.__nc_dim_longitude)
+        self.__write_pressure = self.__output_options.psfc == "full"
+
         # Create variables (with compression)
-        self.__nc_var_time = self.__nc.createVariable("time", "i4", "time", zlib=True, complevel=2,
+        self.__nc_var_time = self.__nc.createVariable("time", "i4", "time", **coordinate_arguments,
                                                                       fill_value=netCDF4.default_fillvals["i4"])
-        self.__nc_var_lon = self.__nc.createVariable("lon", "f8", ("longitude"), zlib=True, complevel=2,
+        self.__nc_var_lon = self.__nc.createVariable("lon", "f8", ("longitude"), **coordinate_arguments,
                                                                      fill_value=netCDF4.default_fillvals["f8"])
-        self.__nc_var_lat = self.__nc.createVariable("lat", "f8", ("latitude"), zlib=True, complevel=2,
+        self.__nc_var_lat = self.__nc.createVariable("lat", "f8", ("latitude"), **coordinate_arguments,
                                                                      fill_value=netCDF4.default_fillvals["f8"])
-        self.__nc_var_psfc = self.__nc.createVariable("PSFC", "f4", ("time", "latitude", "longitude"), zlib=True,
-                                                                      complevel=2,
-                                                                      fill_value=netCDF4.default_fillvals["f4"]) #This will be NaN throughout. Keeping to meet OWI-NWS13 format.
-        self.__nc_var_u10 = self.__nc.createVariable("wind_u", "f4", ("time", "latitude", "longitude"), zlib=True,
-                                                                     complevel=2,
-                                                                     fill_value=netCDF4.default_fillvals["f4"])
-        self.__nc_var_v10 = self.__nc.createVariable("wind_v", "f4", ("time", "latitude", "longitude"), zlib=True,
-                                                                     complevel=2,
-                                                                     fill_value=netCDF4.default_fillvals["f4"])
+        self.__nc_var_psfc = None
+        if self.__output_options.psfc != "skip":
+            self.__nc_var_psfc = self.__output_options.createGridVariable(self.__nc, "PSFC", num_lats, num_lons,
+                                                                          OwiNetcdf.PRESSURE_RANGE) #This will be NaN throughout. Keeping to meet OWI-NWS13 format.
+        self.__nc_var_u10 = self.__output_options.createGridVariable(self.__nc, "wind_u", num_lats, num_lons, OwiNetcdf.WIND_RANGE)
+        self.__nc_var_v10 = self.__output_options.createGridVariable(self.__nc, "wind_v", num_lats, num_lons, OwiNetcdf.WIND_RANGE)
 
         # Add attributes to variables
         self.__base_date = datetime(1990, 1, 1, 0, 0, 0)
@@ -181,8 +284,9 @@ class OwiNetcdf:
         self.__nc_var_lat.standard_name = "latitude"
         self.__nc_var_lat.axis = "y"
         
-        self.__nc_var_psfc.units = "mb"
-        self.__nc_var_psfc.coordinates = "time lat lon"        
+        if self.__nc_var_psfc is not None:
+            self.__nc_var_psfc.units = "mb"
+            self.__nc_var_psfc.coordinates = "time lat lon"
 
         self.__nc_var_u10.units = "m s-1"
         self.__nc_var_u10.coordinates = "time lat lon"
@@ -190,47 +294,176 @@ class OwiNetcdf:
         self.__nc_var_v10.units = "m s-1"
         self.__nc_var_v10.coordinates = "time lat lon"
 
+        # Maximum wind speed and its time, accumulated from the wind as stored as the slices are appended
+        Swath.createVariables(self.__nc, "wind_speed", "m s-1", coordinateArguments=coordinate_arguments)
+        self.__swath = Swath.Swath((num_lats, num_lons))
+
         if self.__bounds:
             self.__nc_var_lat[:] = self.__equidistant_wind_grid.lat()
             self.__nc_var_lon[:] = self.__equidistant_wind_grid.lon()
         else:
             self.__nc_var_lat[:] = wind_grid.lat()
             self.__nc_var_lon[:] = wind_grid.lon()
+        self.__store.commit()
 
     def append(self, idx, wind_data):
         delta = (wind_data.date() - self.__base_date)
         minutes = round((delta.days * 86400 + delta.seconds) / 60)
 
+        # Pressure is only carried along when it is written
+        fields = [wind_data.u_velocity(), wind_data.v_velocity()]
+        if self.__write_pressure:
+            fields.append(wind_data.pressure())
         if self.__bounds:
-            press = WindGrid.interpolate_to_grid(wind_data.wind_grid(),wind_data.pressure(),self.__equidistant_wind_grid)
-            u_vel = WindGrid.interpolate_to_grid(wind_data.wind_grid(),wind_data.u_velocity(),self.__equidistant_wind_grid)
-            v_vel = WindGrid.interpolate_to_grid(wind_data.wind_grid(),wind_data.v_velocity(),self.__equidistant_wind_grid)
-        else:
-            press = wind_data.pressure()
-            u_vel = wind_data.u_velocity()
-            v_vel = wind_data.v_velocity()
+            with Profiler.stage("regrid", idx):
+                if self.__regrid is None or not self.__regrid.matches(wind_data.wind_grid()):
+                    self.__regrid = RegridWeights(wind_data.wind_grid(), self.__equidistant_wind_grid, self.__weights_cache)
+                fields = list(self.__regrid.apply(numpy.stack(fields)))
+        with Profiler.stage("swath", idx):
+            u_vel, v_vel = (self.__output_options.storedValues(field, OwiNetcdf.WIND_RANGE) for field in fields[:2])
+            self.__swath.update([minutes], numpy.hypot(u_vel, v_vel)[numpy.newaxis])
+
+        self.__buffer.append(idx - self.__index_offset, tuple([minutes] + fields))
+
+    def __write_block(self, idx, columns):
+        minutes, u_vel, v_vel = columns[:3]
+        values = {"time": minutes, "wind_u": u_vel, "wind_v": v_vel}
+        if self.__write_pressure:
+            values["PSFC"] = columns[3]
+        with Profiler.stage("netcdf write", idx):
+            self.__store.write(idx, values)
 
-        self.__nc_var_time[idx] = minutes
-        self.__nc_var_psfc[idx, :, :] = press
-        self.__nc_var_u10[idx, :, :] = u_vel
-        self.__nc_var_v10[idx, :, :] = v_vel
+    def close(self):
+        self.__buffer.flush()
+        self.__store.writeSummary(self.__swath.values("wind_speed"))
+        with Profiler.stage("netcdf write"):
+            self.__store.close()
+        Profiler.addBytes("netcdf write", written=self.__store.size())
+
+
+class GrowingFile:
+    # Reads a file that another process is still writing, or a named pipe. Reads wait for more data
+    # until the producer is finished: a pipe reaches end of file, the producer exits, or a regular file
+    # stops growing for idle_timeout seconds. Data written right before the producer exits is still read.
+    # producer is a pid, or a subprocess.Popen when the producer is a child of this process.
+    def __init__(self, filename, poll_interval=0.5, idle_timeout=60.0, producer=None):
+        import os
+        import stat
+        import time
+        self.__filename = filename
+        self.__poll_interval = poll_interval
+        self.__idle_timeout = idle_timeout
+        self.__producer = producer
+        self.__finished = False
+        self.__last_data = time.monotonic()
+        while not os.path.exists(filename):
+            if not self.__producer_running():
+                raise RuntimeError("Wind file " + filename + " was never created")
+            time.sleep(poll_interval)
+        self.__is_pipe = stat.S_ISFIFO(os.stat(filename).st_mode)
+        self.__file = open(filename, 'rb', buffering=0)
+
+    def __producer_running(self):
+        import os
+        import time
+        if hasattr(self.__producer, "poll"):
+            if self.__producer.poll() is not None:
+                return False
+        elif self.__producer is not None:
+            try:
+                os.kill(self.__producer, 0)
+            except ProcessLookupError:
+                return False
+            except PermissionError:
+                pass
+        return self.__idle_timeout is None or time.monotonic() - self.__last_data < self.__idle_timeout
+
+    def finished(self):
+        return self.__finished
+
+    def read(self, size):
+        # Exactly size bytes, or fewer once the producer is finished
+        import time
+        chunks = []
+        remaining = size
+        while remaining > 0:
+            data = self.__file.read(remaining)
+            if data:
+                chunks.append(data)
+                remaining -= len(data)
+                self.__last_data = time.monotonic()
+                continue
+            if self.__is_pipe or self.__finished:
+                self.__finished = True
+                break
+            if not self.__producer_running():
+                # One more pass picks up anything written between the last read and the producer exiting
+                self.__finished = True
+                continue
+            time.sleep(self.__poll_interval)
+        return b"".join(chunks)
+
+    def readline(self):
+        line = b""
+        while not line.endswith(b"\n"):
+            data = self.read(1)
+            if not data:
+                break
+            line += data
+        return line
 
     def close(self):
-        self.__nc.close()
+        self.__file.close()
 
 
 class Owi306Wind:
-    def __init__(self, win_filename, win_inp_filename):
+    # NOTE: Time slices are read one at a time from the file, so memory use is bounded by a single slice.
+    # This relies on windgfdl writing fixed width records, so every line has the same length as the first.
+    # With follow (a dict of GrowingFile arguments) the file may still be written by windgfdl, or be a named
+    # pipe, and follow() yields each time slice as soon as it is complete.
+    # With slice_cache the decoded slices are kept in a SliceCache next to the file, and later
+    # conversions of the unchanged file read them from there instead of parsing the ASCII again.
+    # windgfdl writes the pressure in Pa, it is returned in mb like the OWI-NWS12 pressure and the PSFC variable.
+    PASCALS_PER_MB = 100.0
+
+    def __init__(self, win_filename, win_inp_filename, geometry_cache=None, follow=None, slice_cache=False):
+        import os
+        self.__geometry_cache = geometry_cache
         self.__input_file_lines = open(win_inp_filename, 'r').readlines()
         self.__start_time = None
         self.__time_delta = datetime.timedelta(seconds=3600)
-        win_file = open(win_filename, 'r')
-        self.__lines = win_file.readlines()
-        win_file.close()
         self.__win_filename = win_filename
         self.__num_lats = None
         self.__num_lons = None
         self.__grid = self.__get_grid()
+        self.__growing_file = None
+        self.__win_file = None
+        self.__slice_cache = None
+        self.__cached_records = None
+        if follow is not None:
+            self.__growing_file = GrowingFile(win_filename, **follow)
+            self.__pending = self.__growing_file.readline()
+            self.__record_length = len(self.__pending)
+            if self.__record_length == 0:
+                raise RuntimeError("Wind file " + win_filename + " is empty")
+            self.__slice_length = self.__record_length * self.__num_lats * self.__num_lons
+            return
+        if slice_cache:
+            self.__slice_cache = SliceCache(win_filename, self.__num_lats, self.__num_lons)
+            self.__cached_records = self.__slice_cache.load()
+            if self.__cached_records is not None:
+                LOGGER.info("Reading time slices from %s", self.__slice_cache.filename())
+                return
+        self.__win_file = open(win_filename, 'rb')
+        self.__record_length = len(self.__win_file.readline())
+        if self.__record_length == 0:
+            raise RuntimeError("Wind file " + win_filename + " is empty")
+        self.__slice_length = self.__record_length * self.__num_lats * self.__num_lons
+        self.__file_size = os.fstat(self.__win_file.fileno()).st_size
+        if self.__file_size % self.__slice_length != 0:
+            LOGGER.warning("%s ends with a partial time slice, it will be ignored", win_filename)
+        if self.__slice_cache is not None:
+            self.__slice_cache.create(self.num_times())
 
     def grid(self):
         return self.__grid
@@ -262,145 +495,255 @@ class Owi306Wind:
 #         sw_corner_lon = -98.6
         sw_corner_lat = s_lim
         sw_corner_lon = w_lim
-        lat = numpy.linspace(sw_corner_lat, sw_corner_lat + (self.__num_lats - 1) * lat_step, self.__num_lats)
-        lon = numpy.linspace(sw_corner_lon, sw_corner_lon + (self.__num_lons - 1) * lon_step, self.__num_lons)
-        print("lat lon 0 -1 len", lat[0], lat[-1], len(lat), lon[0], lon[-1], len(lon))
-        return WindGrid(lon, lat)
+        from GridGeometry import linspaceAxis
+        grid = WindGrid.from_axes(linspaceAxis(sw_corner_lat, lat_step, self.__num_lats),
+                                  linspaceAxis(sw_corner_lon, lon_step, self.__num_lons), self.__geometry_cache)
+        lat = grid.lat()
+        lon = grid.lon()
+        LOGGER.debug("lat lon 0 -1 len %s %s %d %s %s %d", lat[0], lat[-1], len(lat), lon[0], lon[-1], len(lon))
+        return grid
 
         
     def num_times(self):
-        timesteps = int(len(self.__lines)/(self.__num_lats * self.__num_lons))
+        if self.__cached_records is not None:
+            return len(self.__cached_records)
+        timesteps = self.__file_size // self.__slice_length
         return timesteps
 
+    def __read_slice(self, idx):
+        self.__win_file.seek(idx * self.__slice_length)
+        data = self.__win_file.read(self.__slice_length)
+        if len(data) != self.__slice_length:
+            raise RuntimeError("Time slice {:d} is incomplete in {:s}".format(idx, self.__win_filename))
+        return data
+
     def get(self, idx):
+        if self.__cached_records is not None:
+            # Views into the memory map, nothing is parsed
+            return self.__wind_data(idx, self.__cached_records[idx])
+        with Profiler.stage("slice parse", idx):
+            records = decode_306_records(self.__read_slice(idx), self.__num_lats, self.__num_lons)
+        Profiler.addBytes("slice parse", read=self.__slice_length)
+        if self.__slice_cache is not None:
+            self.__slice_cache.store(idx, records)
+        return self.__wind_data(idx, records)
+
+    def __wind_data(self, idx, records):
         idx_date = (self.__time_delta * idx) + self.__start_time
 #         print(idx_date)
         starting_row = idx * (self.__num_lats * self.__num_lons)
         ending_row = starting_row + (self.__num_lats * self.__num_lons)
-        print(starting_row, ending_row)
-        latitudeIndex = self.__num_lats - 1
-        longitudeIndex = 0
-        uvel = [[None for i in range(self.__num_lons)] for j in range(self.__num_lats)]
-        vvel = [[None for i in range(self.__num_lons)] for j in range(self.__num_lats)]
-        prmsl = [[None for i in range(self.__num_lons)] for j in range(self.__num_lats)]
-#         print(len(uvel), len(uvel[0]))
-        for index in range(starting_row, ending_row):
-            if(longitudeIndex >= self.__num_lons):
-                latitudeIndex = latitudeIndex - 1
-                longitudeIndex = 0
-#             print("index, latIndex, longIndex", index, latitudeIndex, longitudeIndex)
-            data = self.__lines[index].split()
-            uvel[latitudeIndex][longitudeIndex] = float(data[0])
-            vvel[latitudeIndex][longitudeIndex] = float(data[1])
-            prmsl[latitudeIndex][longitudeIndex] = float(data[2])
-            longitudeIndex = longitudeIndex + 1  
-        return WindData(idx_date, self.__grid, prmsl, uvel, vvel)
+        LOGGER.debug("Rows %d to %d", starting_row, ending_row)
+        return WindData(idx_date, self.__grid, records[:, :, 2] / numpy.float32(Owi306Wind.PASCALS_PER_MB), records[:, :, 0], records[:, :, 1])
+
+    def follow(self):
+        # Yields (idx, WindData) for each complete time slice until the producer is finished
+        idx = 0
+        while True:
+            data = self.__pending + self.__growing_file.read(self.__slice_length - len(self.__pending))
+            self.__pending = b""
+            if len(data) < self.__slice_length:
+                if data:
+                    LOGGER.warning("%s ends with a partial time slice, it will be ignored", self.__win_filename)
+                return
+            with Profiler.stage("slice parse", idx):
+                records = decode_306_records(data, self.__num_lats, self.__num_lons)
+            Profiler.addBytes("slice parse", read=len(data))
+            yield idx, self.__wind_data(idx, records)
+            idx += 1
+
+    def close(self):
+        if self.__growing_file is not None:
+            self.__growing_file.close()
+        if self.__win_file is not None:
+            self.__win_file.close()
+        if self.__slice_cache is not None:
+            self.__slice_cache.close()
+
+
+class SliceCache:
+    # Sidecar cache of the decoded time slices of a 306 file. <file>.slices.npy holds a float32
+    # (time, lat, lon, 3) array of the u, v, p records with rows running south to north, and
+    # <file>.slices.json its header. The header records the size and mtime of the 306 file, and the
+    # cache is only used while both still match. A new cache is written under a temporary name and
+    # published by renaming once every slice has been stored.
+    def __init__(self, win_filename, num_lats, num_lons):
+        import os
+        stat = os.stat(win_filename)
+        self.__win_filename = win_filename
+        self.__data_filename = win_filename + ".slices.npy"
+        self.__header_filename = win_filename + ".slices.json"
+        self.__header = {"size": stat.st_size, "mtime_ns": stat.st_mtime_ns, "num_lats": num_lats, "num_lons": num_lons}
+        self.__records = None
+        self.__filled = None
+        self.__temp_filename = None
+
+    def filename(self):
+        return self.__data_filename
+
+    def load(self):
+        # Read only memory map of the cached records, None when there is no valid cache
+        import json
+        try:
+            with open(self.__header_filename) as f:
+                header = json.load(f)
+            if any(header.get(key) != value for key, value in self.__header.items()):
+                return None
+            records = numpy.load(self.__data_filename, mmap_mode="r")
+        except (OSError, ValueError):
+            return None
+        if records.shape != (header["num_times"], self.__header["num_lats"], self.__header["num_lons"], 3):
+            return None
+        return records
+
+    def create(self, num_times):
+        import os
+        if num_times == 0:
+            return
+        self.__temp_filename = self.__data_filename + ".{:d}.tmp.npy".format(os.getpid())
+        self.__records = numpy.lib.format.open_memmap(self.__temp_filename, mode="w+", dtype=numpy.float32,
+                                                      shape=(num_times, self.__header["num_lats"], self.__header["num_lons"], 3))
+        self.__filled = numpy.zeros(num_times, dtype=bool)
+
+    def store(self, idx, records):
+        if self.__records is not None:
+            self.__records[idx] = records
+            self.__filled[idx] = True
+
+    def close(self):
+        import json
+        import os
+        if self.__records is None:
+            return
+        num_times = len(self.__records)
+        self.__records.flush()
+        self.__records = None
+        stat = os.stat(self.__win_filename)
+        unchanged = stat.st_size == self.__header["size"] and stat.st_mtime_ns == self.__header["mtime_ns"]
+        if not self.__filled.all() or not unchanged:
+            os.remove(self.__temp_filename)
+            return
+        os.replace(self.__temp_filename, self.__data_filename)
+        header = dict(self.__header, num_times=num_times)
+        temp_header = self.__header_filename + ".{:d}.tmp".format(os.getpid())
+        with open(temp_header, "w") as f:
+            json.dump(header, f)
+        os.replace(temp_header, self.__header_filename)
+        LOGGER.info("Cached time slices in %s", self.__data_filename)
+
+
+def decode_fixed_width(data, num_values, width=10):
+    # OWI blocks hold 8 values of 10 characters per line. Dropping the line breaks leaves a run of
+    # fixed width fields, even across the short last line of a block, that numpy parses in one call.
+    import numpy
+    data = data.replace(b"\r", b"").replace(b"\n", b"")
+    if len(data) < num_values * width:
+        raise RuntimeError("Expected {:d} values in OWI block, found {:d}".format(num_values, len(data) // width))
+    fields = numpy.frombuffer(data, dtype="S{:d}".format(width), count=num_values)
+    return fields.astype(numpy.float64).astype(numpy.float32)
+
+
+def decode_306_records(data, num_lats, num_lons):
+    # Records are "u v p" and rows run north to south, so flip to south to north with a view
+    import numpy
+    values = numpy.array(data.split(), dtype=numpy.float64).astype(numpy.float32)
+    if values.size != num_lats * num_lons * 3:
+        raise RuntimeError("Expected {:d} records in 306 time slice, found {:d}".format(num_lats * num_lons, values.size // 3))
+    return values.reshape(num_lats, num_lons, 3)[::-1]
 
 
 class OwiAscii:
     # NOTE: This class assumes the same number of grid points in each time slice.
     # The conversion will fail if this isn't the case.
-    def __init__(self, pre_filename, win_filename, idx):
+    # Each file is scanned once to index the byte offset of every iLat/iLong header, slices are then read by seeking.
+    def __init__(self, pre_filename, win_filename, geometry_cache=None):
+        self.__geometry_cache = geometry_cache
         self.__pre_filename = pre_filename
         self.__win_filename = win_filename
-        self.__idx = idx
-        self.__num_lats = self.__get_num_lats()
-        self.__num_lons = self.__get_num_lons()
-        self.__pre_idx_header_row = self.__get_pre_idx_header_row()
-        self.__win_idx_header_row = self.__get_win_idx_header_row()
-        self.__date = self.__get_date()
-        self.__grid = self.__get_grid()
+        self.__pre_file = open(self.__pre_filename, 'rb')
+        self.__win_file = open(self.__win_filename, 'rb')
+        self.__pre_offsets = OwiAscii.__index_headers(self.__pre_file)
+        self.__win_offsets = OwiAscii.__index_headers(self.__win_file)
+        if len(self.__pre_offsets) != len(self.__win_offsets):
+            raise RuntimeError("Pressure and wind files have a different number of time slices")
+        if len(self.__pre_offsets) == 0:
+            raise RuntimeError("No time slices found in " + self.__pre_filename)
+        header = self.__read_header(self.__pre_file, self.__pre_offsets[0])
+        self.__num_lats = int(header[5:9])
+        self.__num_lons = int(header[15:19])
 
-    def date(self):
-        return self.__date
+    def num_times(self):
+        return len(self.__pre_offsets)
 
-    def grid(self):
-        return self.__grid
-    
-    def __get_num_lats(self):
-        pre_file = open(self.__pre_filename, 'r')
-        lines = pre_file.readlines()
-        num_lats = lines[1][5:9]
-        pre_file.close()
-        return int(num_lats)
-    
-    def __get_num_lons(self):
-        pre_file = open(self.__pre_filename, 'r')
-        lines = pre_file.readlines()
-        num_lons = lines[1][15:19]
-        pre_file.close()
-        return int(num_lons)    
-            
-    def __get_pre_idx_header_row(self):
-        from math import ceil
-        return 1 + ceil((self.__num_lats * self.__num_lons) / 8) * self.__idx + self.__idx
-    
-    def __get_win_idx_header_row(self):
-        from math import ceil
-        return 1 + 2 * ceil((self.__num_lats * self.__num_lons) / 8) * self.__idx + self.__idx
+    def date(self, idx):
+        return self.__get_date(self.__read_header(self.__pre_file, self.__pre_offsets[idx]))
+
+    def grid(self, idx):
+        return self.__get_grid(self.__read_header(self.__pre_file, self.__pre_offsets[idx]))
+
+    @staticmethod
+    def __index_headers(owi_file):
+        offsets = []
+        position = 0
+        owi_file.seek(0)
+        for line in owi_file:
+            if line[:1] == b'i':
+                offsets.append(position)
+            position += len(line)
+        return offsets
+
+    @staticmethod
+    def __read_header(owi_file, offset):
+        owi_file.seek(offset)
+        return owi_file.readline().decode()
+
+    def __read_block(self, owi_file, offsets, idx, num_blocks):
+        owi_file.seek(offsets[idx])
+        header = owi_file.readline().decode()
+        if idx + 1 < len(offsets):
+            data = owi_file.read(offsets[idx + 1] - owi_file.tell())
+        else:
+            data = owi_file.read()
+        Profiler.addBytes("slice parse", read=len(header) + len(data))
+        values = decode_fixed_width(data, num_blocks * self.__num_lats * self.__num_lons)
+        return header, values.reshape(num_blocks, self.__num_lats, self.__num_lons)
 
-    def __get_date(self):
+    def __get_date(self, header):
         from datetime import datetime
-        pre_file = open(self.__pre_filename, 'r')
-        lines = pre_file.readlines()
-        date_str = lines[self.__pre_idx_header_row][68:80]
-        idx_date = datetime(int(date_str[0:4]), int(date_str[4:6]), int(date_str[6:8]), int(date_str[8:10]), int(date_str[10:12]))
-        pre_file.close()
-        return idx_date
-    
-    def __get_grid(self):
-        from numpy import linspace
-        pre_file = open(self.__pre_filename, 'r')
-        lines = pre_file.readlines()
-        lat_step = float(lines[self.__pre_idx_header_row][31:37])
-        lon_step = float(lines[self.__pre_idx_header_row][22:28])
-        sw_corner_lat = float(lines[self.__pre_idx_header_row][43:51])
-        sw_corner_lon = float(lines[self.__pre_idx_header_row][57:65])
-        lat = linspace(sw_corner_lat, sw_corner_lat + (self.__num_lats - 1) * lat_step, self.__num_lats)
-        lon = linspace(sw_corner_lon, sw_corner_lon + (self.__num_lons - 1) * lon_step, self.__num_lons)
-        pre_file.close()
-        return WindGrid(lon, lat)
+        date_str = header[68:80]
+        return datetime(int(date_str[0:4]), int(date_str[4:6]), int(date_str[6:8]), int(date_str[8:10]), int(date_str[10:12]))
+
+    def __get_grid(self, header):
+        from GridGeometry import linspaceAxis
+        lat_step = float(header[31:37])
+        lon_step = float(header[22:28])
+        sw_corner_lat = float(header[43:51])
+        sw_corner_lon = float(header[57:65])
+        return WindGrid.from_axes(linspaceAxis(sw_corner_lat, lat_step, self.__num_lats),
+                                  linspaceAxis(sw_corner_lon, lon_step, self.__num_lons), self.__geometry_cache)
 
     def get(self, idx):
-        from math import ceil, floor
-        pre_file = open(self.__pre_filename, 'r')
-        lines = pre_file.readlines()
-        prmsl = [[None for i in range(self.__num_lons)] for j in range(self.__num_lats)]
-        for i in range(self.__num_lats * self.__num_lons):
-            low_idx = 1 + 10 * (i % 8)
-            high_idx = 10 + 10 * (i % 8)
-            line_idx = self.__pre_idx_header_row + 1 + floor(i / 8)
-            lon_idx = i % self.__num_lons
-            lat_idx = floor(i / self.__num_lons)
-            prmsl[lat_idx][lon_idx] = float(lines[line_idx][low_idx:high_idx])
-        pre_file.close()
-        
-        win_file = open(self.__win_filename, 'r')
-        lines = win_file.readlines()
-        uvel = [[None for i in range(self.__num_lons)] for j in range(self.__num_lats)]
-        for i in range(self.__num_lats * self.__num_lons):
-            low_idx = 1 + 10 * (i % 8)
-            high_idx = 10 + 10 * (i % 8)
-            line_idx = self.__win_idx_header_row + 1 + floor(i / 8)
-            lon_idx = i % self.__num_lons
-            lat_idx = floor(i / self.__num_lons)
-            uvel[lat_idx][lon_idx] = float(lines[line_idx][low_idx:high_idx])
-        vvel = [[None for i in range(self.__num_lons)] for j in range(self.__num_lats)]
-        for i in range(self.__num_lats * self.__num_lons):
-            low_idx = 1 + 10 * (i % 8)
-            high_idx = 10 + 10 * (i % 8)
-            line_idx = self.__win_idx_header_row + 1 + floor(i / 8) + ceil((self.__num_lats * self.__num_lons) / 8) 
-            lon_idx = i % self.__num_lons
-            lat_idx = floor(i / self.__num_lons)
-            vvel[lat_idx][lon_idx] = float(lines[line_idx][low_idx:high_idx])            
-        win_file.close()        
-                
-        print(self.__date)
-        return WindData(self.__date, self.__grid, prmsl, uvel, vvel)
+        with Profiler.stage("slice parse", idx):
+            header, values = self.__read_block(self.__pre_file, self.__pre_offsets, idx, 1)
+            prmsl = values[0]
+            date = self.__get_date(header)
+            grid = self.__get_grid(header)
+
+            header, values = self.__read_block(self.__win_file, self.__win_offsets, idx, 2)
+            uvel = values[0]
+            vvel = values[1]
+
+        LOGGER.debug("%s", date)
+        return WindData(date, grid, prmsl, uvel, vvel)
+
+    def close(self):
+        self.__pre_file.close()
+        self.__win_file.close()
 
 
 def main():
     import argparse
+    from OutputOptions import OutputOptions
     parser = argparse.ArgumentParser(description="Convert OWI output to alternate formats")
 
     # Arguments
@@ -412,16 +755,37 @@ def main():
                         help="Name of output file to be created. Default: [fort].nc|[fort].221,.222|[fort].amu,amv,amp",
                         required=True, default="fort")
     parser.add_argument("-b", metavar="x1,y1,x2,y2,dx,dy", type=str, help="Bounding box. Default: None",default=None,nargs=6)
+    parser.add_argument("-w", metavar="dir", type=str, help="Directory caching regridding weights for bounding box output. Default: None",
+                        default=None)
+    parser.add_argument("-g", metavar="dir", type=str, help="Directory caching memory mapped grid coordinates across runs. Default: None",
+                        default=None)
+    parser.add_argument("--profile", metavar="report", type=str, default=None,
+                        help="Write a JSON report of time, bytes and memory per stage and per time slice. Default: None")
+    parser.add_argument("--log-level", type=str, default="WARNING", choices=["DEBUG", "INFO", "WARNING", "ERROR"],
+                        help="Level of the per time slice log messages. Default: WARNING")
+    parser.add_argument("-s", action="store_true",
+                        help="Keep the parsed time slices of a 306 file in a sidecar cache and reuse them in later conversions")
+    parser.add_argument("--follow", action="store_true",
+                        help="Convert a 306 file (or named pipe) while windgfdl is still writing it, one time slice at a time")
+    parser.add_argument("--follow-pid", metavar="pid", type=int, default=None,
+                        help="With --follow, finish once this producer process has exited. Default: None")
+    parser.add_argument("--follow-timeout", metavar="seconds", type=float, default=60.0,
+                        help="With --follow, finish once the file has not grown for this long. Default: 60")
+    parser.add_argument("--poll-interval", metavar="seconds", type=float, default=0.5,
+                        help="With --follow, time between checks for new data. Default: 0.5")
+    parser.add_argument("--time-range", metavar="start:end", type=str, default=None,
+                        help="Only convert time slices start to end - 1 into a shard file for mergeShards.py. Default: every slice")
+    OutputOptions.addArguments(parser)
 
     # Read the command line arguments
     args = parser.parse_args()
-    is306 = False
+    logging.basicConfig(level=args.log_level, format="%(levelname)s: %(message)s")
+    if args.profile:
+        Profiler.enable()
     file_list = args.files
     num_files = len(file_list)
     if num_files == 0:
         raise RuntimeError("No files found for conversion")
-    if ["Inp" in file_list[1]]:
-        is306 = True
     if num_files - 2 > 0:
         raise RuntimeError("Must specify exactly one 306 type file or two files with the ""pre"" file listed first")
 
@@ -433,39 +797,69 @@ def main():
     else:
         bounds = None
 
-    output_format = args.f
+    geometry_cache = None
+    if args.g:
+        from GridGeometry import GeometryCache
+        geometry_cache = GeometryCache(args.g)
 
-    
+    follow = None
+    if args.follow:
+        # With a producer pid the file is followed until the producer exits, however long it pauses
+        follow = {"poll_interval": args.poll_interval, "producer": args.follow_pid,
+                  "idle_timeout": None if args.follow_pid is not None else args.follow_timeout}
+
+    time_range = None
+    if args.time_range:
+        from mergeShards import TimeRange
+        time_range = TimeRange.parse(args.time_range)
+
+    convert(file_list, args.o, bounds, args.f, args.w, OutputOptions.fromArguments(args), geometry_cache, follow, args.s, time_range)
+    if args.profile:
+        import sys
+        Profiler.write(args.profile, " ".join(sys.argv))
+
+
+# follow (a dict of GrowingFile arguments) converts a 306 file slice by slice while it is still being written
+# slice_cache reads and keeps the parsed slices of a 306 file in a SliceCache sidecar
+# time_range (mergeShards.TimeRange) only converts those time slices, into a shard file for mergeShards
+def convert(file_list, output_filename, bounds=None, output_format="netcdf", weights_cache=None, output_options=None, geometry_cache=None, follow=None, slice_cache=False, time_range=None):
     wind = None
-#     If converting 306 type wind, comment out below block
-    if(is306):
-        owi_ascii = Owi306Wind(file_list[0], file_list[1])
-        num_times = owi_ascii.num_times()
+    if time_range is not None and follow is not None:
+        raise RuntimeError("A time range shard needs the whole wind file, it cannot be used with --follow")
+    if len(file_list) > 1 and "Inp" in file_list[1]:
+        owi_ascii = Owi306Wind(file_list[0], file_list[1], geometry_cache, follow, slice_cache)
+    elif follow is not None:
+        raise RuntimeError("Following a file that is still being written is only supported for 306 type files")
     else:
-        pre_file = open(file_list[0], 'r')
-        lines = pre_file.readlines()
-        num_times = 0
-        for line in lines:
-            if line[0] == 'i':
-                num_times += 1   
-        pre_file.close()
-    
+        owi_ascii = OwiAscii(file_list[0], file_list[1], geometry_cache)
 
-    time_index = 0
-    while time_index < num_times: #This, plus making OwiAscii time-slice specific, lets us maintain the old OwiNetcdf class granularity and diverge less from the original code
-#        If running 306 wind, comment below line
-        if(not is306):
-            owi_ascii = OwiAscii(file_list[0], file_list[1], time_index)
-        print("INFO: Processing time slice {:d} of {:d}".format(time_index + 1, num_times), flush=True)
-        wind_data = owi_ascii.get(time_index)
+    shard = None
+    if follow is not None:
+        num_times = None
+        time_slices = owi_ascii.follow()
+    else:
+        num_times = owi_ascii.num_times()
+        indices = range(num_times)
+        if time_range is not None:
+            shard = time_range.shard(num_times)
+            indices = range(shard[0], shard[1])
+        time_slices = ((time_index, owi_ascii.get(time_index)) for time_index in indices)
+
+    for time_index, wind_data in time_slices:
+        if num_times is None:
+            LOGGER.info("Processing time slice %d", time_index + 1)
+        else:
+            LOGGER.info("Processing time slice %d of %d", time_index + 1, num_times)
         if not wind:
             if output_format == "netcdf":
-                wind = OwiNetcdf(args.o, wind_data.wind_grid(), bounds)
+                wind = OwiNetcdf(output_filename, wind_data.wind_grid(), bounds, weights_cache, output_options, geometry_cache, shard)
             else:
                 raise RuntimeError("Invalid output format selected")
         wind.append(time_index, wind_data)
-        time_index += 1   
-    
+
+    owi_ascii.close()
+    if not wind:
+        raise RuntimeError("No complete time slices found in " + file_list[0])
     wind.close()
 
 if __name__ == '__main__':
@@ -0,0 +1,227 @@
+import logging
+import multiprocessing
+import os
+import shutil
+import subprocess
+import time
+
+import generateParametricInput
+import generateParametricWind
+import owi2wind
+import Profiler
+import Track
+
+# End to end run of one storm. The windgfdl inputs are written first, then windgfdl, the rain and the
+# conversion of richamp.wnd run at the same time:
+#     windgfdl      subprocess in the output directory, its console output goes to windgfdl.log
+#     rain          process writing RICHAMP_rain.nc
+#     conversion    process running owi2wind in follow mode, each time slice is converted as soon as windgfdl
+#                   has written it and the conversion finishes when windgfdl exits
+# The stages are polled every pollInterval seconds. A stage that fails or runs past its timeout stops the
+# others, and a summary of when each stage started and how long it ran is printed at the end.
+# With profile (the report filename of the parent) the rain and conversion processes profile themselves into
+# <profile>.<stage>.json, which are merged into the parent report as "<stage>: <Profiler stage>". windgfdl is
+# an external program, only its wall time is recorded.
+
+WINDGFDL_OUTPUT = "richamp.wnd"
+WINDGFDL_LOG = "windgfdl.log"
+WIND_FILENAME = "storm_parametric_wind"
+STAGE_NAMES = ["windgfdl", "rain", "conversion"]
+
+LOGGER = logging.getLogger(__name__)
+
+
+# A subprocess.Popen or multiprocessing.Process run with a timeout in seconds (None for no limit)
+class Stage:
+    def __init__(self, name, timeout=None):
+        self.name = name
+        self.timeout = timeout
+        self.process = None
+        self.started = None
+        self.offset = None
+        self.seconds = None
+        self.status = "not started"
+
+    def start(self, process, pipelineStart):
+        self.process = process
+        self.started = time.perf_counter()
+        self.offset = self.started - pipelineStart
+        self.status = "running"
+
+    def running(self):
+        return self.status == "running"
+
+    # Exit code once the process has finished, None while it runs
+    def exitCode(self):
+        if isinstance(self.process, subprocess.Popen):
+            return self.process.poll()
+        if self.process.is_alive():
+            return None
+        return self.process.exitcode
+
+    # Updates the status, returns False once the stage has failed or timed out
+    def check(self):
+        if not self.running():
+            return self.status in ["ok", "not started"]
+        exitCode = self.exitCode()
+        if exitCode is not None:
+            self.finish("ok" if exitCode == 0 else "failed, exit code " + str(exitCode))
+        elif self.timeout is not None and time.perf_counter() - self.started > self.timeout:
+            self.stop("timed out after " + str(self.timeout) + " s")
+        return self.status == "ok" or self.running()
+
+    def finish(self, status):
+        self.seconds = time.perf_counter() - self.started
+        self.status = status
+        LOGGER.info("Stage %s %s after %.2f s", self.name, status, self.seconds)
+        if Profiler.enabled():
+            record = Profiler.stageRecord("pipeline " + self.name)
+            record["wallSeconds"] += self.seconds
+            record["calls"] += 1
+
+    def stop(self, status):
+        self.process.terminate()
+        if isinstance(self.process, subprocess.Popen):
+            try:
+                self.process.wait(timeout=5)
+            except subprocess.TimeoutExpired:
+                self.process.kill()
+                self.process.wait()
+        else:
+            self.process.join(5)
+            if self.process.is_alive():
+                self.process.kill()
+                self.process.join()
+        self.finish(status)
+
+
+# Report filename of a profiled stage process
+def stageProfile(profile, name):
+    return profile + "." + name + ".json"
+
+
+# Runs work in a stage process, profiled into stageProfile(profile, name) when profile is set
+def runProfiled(name, profile, work):
+    if profile is None:
+        work()
+        return
+    Profiler.enable()
+    try:
+        work()
+    finally:
+        Profiler.write(stageProfile(profile, name), "pipeline " + name)
+
+
+def runRain(track, outputDirectory, options, profile=None):
+    parsedTrack = Track.readTrack(track)
+    runProfiled("rain", profile, lambda: generateParametricInput.generateRain(parsedTrack, outputDirectory, **options))
+
+
+def runConversion(outputDirectory, windFilename, outputOptions, geometryCache, producer, pollInterval, profile=None):
+    follow = {"producer": producer, "idle_timeout": None, "poll_interval": pollInterval}
+    runProfiled("conversion", profile,
+                lambda: owi2wind.convert([os.path.join(outputDirectory, WINDGFDL_OUTPUT), os.path.join(outputDirectory, "Wind_Inp.txt")],
+                                         os.path.join(outputDirectory, windFilename), None, "netcdf", None, outputOptions, geometryCache, follow))
+
+
+# Adds the reports of the profiled stage processes to the report of this process
+def mergeProfiles(profile):
+    for name in ["rain", "conversion"]:
+        filename = stageProfile(profile, name)
+        if os.path.exists(filename):
+            Profiler.merge(filename, name + ": ")
+        else:
+            LOGGER.warning("Stage %s wrote no profile %s, it did not finish", name, filename)
+
+
+# windgfdl reads diag_parm.nml from its working directory, and a richamp.wnd left by an earlier run would be
+# followed before windgfdl replaces it
+def prepareWindgfdl(outputDirectory, diagParm):
+    target = os.path.join(outputDirectory, os.path.basename(generateParametricWind.DIAG_PARM_FILENAME))
+    if not os.path.exists(target) or not os.path.samefile(diagParm, target):
+        shutil.copyfile(diagParm, target)
+    windOutput = os.path.join(outputDirectory, WINDGFDL_OUTPUT)
+    if os.path.lexists(windOutput):
+        os.remove(windOutput)
+
+
+# timeouts maps the stage names to seconds, rainOptions are the rain arguments of generateParametricInput.main
+# Returns the stage records, raises RuntimeError when a stage failed
+def main(track, windgfdl, outputDirectory=".", diagParm=generateParametricWind.DIAG_PARM_FILENAME, rainOptions=None,
+         outputOptions=None, geometryCache=None, timeouts=None, windFilename=WIND_FILENAME, pollInterval=0.5, profile=None):
+    timeouts = timeouts or {}
+    rainOptions = dict(rainOptions or {})
+    rainOptions["outputOptions"] = outputOptions
+    rainOptions["geometryCache"] = geometryCache
+    windgfdl = os.path.abspath(windgfdl)
+#     Checked before any output is written
+    if not os.access(windgfdl, os.X_OK):
+        raise RuntimeError("windgfdl program " + windgfdl + " is not executable")
+    if not os.path.isfile(diagParm):
+        raise RuntimeError("windgfdl namelist " + diagParm + " not found")
+    if profile is not None:
+        profile = os.path.abspath(profile)
+        for name in ["rain", "conversion"]:
+            if os.path.exists(stageProfile(profile, name)):
+                os.remove(stageProfile(profile, name))
+
+    pipelineStart = time.perf_counter()
+    parsedTrack = generateParametricInput.parseTrack(track)
+    os.makedirs(outputDirectory, exist_ok=True)
+    generateParametricInput.writeTrackFiles(parsedTrack, outputDirectory)
+    prepareWindgfdl(outputDirectory, diagParm)
+    inputSeconds = time.perf_counter() - pipelineStart
+
+    stages = {name: Stage(name, timeouts.get(name)) for name in STAGE_NAMES}
+    log = open(os.path.join(outputDirectory, WINDGFDL_LOG), "w")
+    try:
+        stages["windgfdl"].start(subprocess.Popen([windgfdl], cwd=outputDirectory, stdout=log, stderr=subprocess.STDOUT), pipelineStart)
+        rain = multiprocessing.Process(target=runRain, args=(track, outputDirectory, rainOptions, profile), name="rain")
+        rain.start()
+        stages["rain"].start(rain, pipelineStart)
+#         The conversion waits for richamp.wnd to appear and follows it until windgfdl exits. Polling windgfdl
+#         below reaps it, so the conversion sees it exit.
+        conversion = multiprocessing.Process(target=runConversion, name="conversion",
+                                             args=(outputDirectory, windFilename, outputOptions, geometryCache,
+                                                   stages["windgfdl"].process.pid, pollInterval, profile))
+        conversion.start()
+        stages["conversion"].start(conversion, pipelineStart)
+        supervise(stages, pollInterval)
+    finally:
+        for stage in stages.values():
+            if stage.running():
+                stage.stop("stopped")
+        log.close()
+
+    if profile is not None:
+        mergeProfiles(profile)
+    printSummary(inputSeconds, stages, time.perf_counter() - pipelineStart)
+    failed = [stage.name for stage in stages.values() if stage.status != "ok"]
+    if failed:
+        raise RuntimeError("Pipeline stage " + ", ".join(failed) + " did not finish, see the summary above")
+    return stages
+
+
+# Polls the stages until all have finished, stopping the rest once one fails
+def supervise(stages, pollInterval):
+    while any(stage.running() for stage in stages.values()):
+        for stage in stages.values():
+            if not stage.check():
+                LOGGER.warning("Stage %s %s, stopping the pipeline", stage.name, stage.status)
+                for other in stages.values():
+                    if other.running():
+                        other.stop("stopped after " + stage.name + " failed")
+                return
+        time.sleep(pollInterval)
+
+
+def printSummary(inputSeconds, stages, wallSeconds):
+    print()
+    print("Stage".ljust(12), "Start".rjust(9), "Seconds".rjust(9), " Status")
+    print("inputs".ljust(12), format(0.0, "9.2f"), format(inputSeconds, "9.2f"), "", "ok")
+    for stage in stages.values():
+        offset = "-".rjust(9) if stage.started is None else format(stage.offset, "9.2f")
+        seconds = "-".rjust(9) if stage.seconds is None else format(stage.seconds, "9.2f")
+        print(stage.name.ljust(12), offset, seconds, "", stage.status)
+    stageSeconds = inputSeconds + sum(stage.seconds for stage in stages.values() if stage.seconds is not None)
+    print("Wall", format(wallSeconds, ".2f"), "s, stages", format(stageSeconds, ".2f"), "s run one after another")
@@ -0,0 +1,47 @@
+import logging
+import os
+
+import netCDF4
+import numpy as np
+
+import benchmark
+import owi2wind
+from OutputOptions import OutputOptions
+
+
+def convertSynthetic306(directory, name, outputOptions):
+    windFilename = os.path.join(directory, "richamp.wnd")
+    inputFilename = os.path.join(directory, "Wind_Inp.txt")
+    if(not os.path.exists(windFilename)):
+        benchmark.writeSynthetic306(windFilename, inputFilename, 4, 2, 10)
+    output = os.path.join(directory, name)
+    owi2wind.convert([windFilename, inputFilename], output, output_options=outputOptions)
+    return output + ".nc"
+
+
+# Packed wind and PSFC read back within one quantization step of the f4 output, windgfdl pressure included
+def test_packed_wind_round_trips(tmp_path, caplog):
+    unpacked = convertSynthetic306(str(tmp_path), "unpacked", OutputOptions())
+    with caplog.at_level(logging.WARNING):
+        packed = convertSynthetic306(str(tmp_path), "packed", OutputOptions(packed=True))
+    assert not [record for record in caplog.records if "packed range" in record.getMessage()]
+    with netCDF4.Dataset(unpacked) as reference, netCDF4.Dataset(packed) as dataset:
+        assert reference["PSFC"].units == "mb"
+        for name in ["PSFC", "wind_u", "wind_v"]:
+            assert dataset[name].dtype == np.int16
+            difference = np.abs(dataset[name][:] - reference[name][:])
+            assert difference.max() <= float(dataset[name].scale_factor), name
+
+
+def test_values_outside_packed_range_are_reported(tmp_path, caplog):
+    with netCDF4.Dataset(str(tmp_path / "range.nc"), "w") as dataset:
+        dataset.createDimension("time", None)
+        dataset.createDimension("latitude", 2)
+        dataset.createDimension("longitude", 2)
+        variable = OutputOptions(packed=True).createGridVariable(dataset, "PSFC", 2, 2, (800.0, 1100.0))
+        with caplog.at_level(logging.WARNING):
+            values = OutputOptions.packValues(variable, np.array([[[1000.0, 100000.0], [np.nan, 900.0]]]))
+        maximum = OutputOptions.packedRange(variable)[1]
+    assert "1 values of PSFC outside its packed range" in caplog.text
+    assert values.max() <= maximum
+    assert np.ma.is_masked(values[0, 1, 0])
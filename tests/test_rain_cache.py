@@ -0,0 +1,28 @@
+import os
+
+import numpy as np
+
+import generateParametricRain
+
+
+def cacheBytes(directory):
+    return sum(os.path.getsize(os.path.join(directory, name)) for name in os.listdir(directory))
+
+
+# Reopening a full cache with a smaller cap trims it to the cap, least recently used entries first
+def test_reopening_with_a_smaller_cap_evicts(tmp_path):
+    directory = str(tmp_path / "rain_cache")
+    random = np.random.default_rng(1)
+    cache = generateParametricRain.RainCache(directory, 10)
+    for index in range(20):
+        cache.put("key" + str(index), random.random((100, 100)))
+    assert cache.evictions == 0
+    fullBytes = cacheBytes(directory)
+    recent = cache.get("key0")
+
+    smaller = generateParametricRain.RainCache(directory, fullBytes / 4 / (1024 * 1024))
+    assert smaller.evictions > 0
+    assert cacheBytes(directory) <= smaller.maxBytes < fullBytes
+    assert smaller.totalBytes == cacheBytes(directory)
+    assert np.array_equal(smaller.get("key0"), recent)
+    assert smaller.get("key1") is None
@@ -0,0 +1,97 @@
+import netCDF4
+import numpy as np
+
+import benchmark
+import generateParametricRain
+import mergeShards
+import OutputStore
+import Swath
+import Track
+from OutputOptions import OutputOptions
+
+SWATH_VARIABLES = ["precipitation_max", "precipitation_max_time", "precipitation_total"]
+
+
+def runRain(track, filename, outputOptions, latitudes=None, **options):
+    generateParametricRain.main(10.0, -80.0, 55.0, -40.0, 0.5, track.startTime(), track["deltaHours"], track["maxWindSpeedKnots"],
+                                track["latitude"] if latitudes is None else latitudes, track["longitude"],
+                                outputOptions=outputOptions, filename=filename, **options)
+
+
+def readSwath(filename):
+    with netCDF4.Dataset(filename) as dataset:
+        return {name: np.ma.filled(dataset[name][:], np.nan) for name in SWATH_VARIABLES}, np.ma.filled(dataset["precipitation"][:], np.nan), dataset["time"][:]
+
+
+# The swath written while the rain is computed, the swath an incremental update rebuilds from the file and the
+# swath of the stored rain agree, packed or not
+def test_incremental_and_full_runs_give_the_same_swath(tmp_path):
+    trackFilename = str(tmp_path / "synthetic.trk")
+    benchmark.writeSyntheticTrack(trackFilename, 48)
+    track = Track.readTrack(trackFilename)
+    moved = track["latitude"].copy()
+    moved[-3:] = moved[-3:] + 0.5
+    for outputOptions in [OutputOptions(), OutputOptions(packed=True)]:
+        incremental = str(tmp_path / "incremental.nc")
+        full = str(tmp_path / "full.nc")
+        runRain(track, incremental, outputOptions)
+        runRain(track, incremental, outputOptions, moved, incremental=True)
+        runRain(track, full, outputOptions, moved)
+        updated, updatedRain, times = readSwath(incremental)
+        swath, rain, times = readSwath(full)
+        assert np.array_equal(updatedRain, rain, equal_nan=True)
+        assert np.array_equal(updated["precipitation_max"], swath["precipitation_max"], equal_nan=True)
+        assert np.array_equal(updated["precipitation_max_time"], swath["precipitation_max_time"], equal_nan=True)
+        assert np.allclose(updated["precipitation_total"], swath["precipitation_total"], rtol=1e-5, equal_nan=True)
+        assert np.array_equal(swath["precipitation_max"], np.nanmax(rain, axis=0))
+        assert np.array_equal(swath["precipitation_max_time"], times[np.nanargmax(rain, axis=0)])
+        assert np.allclose(swath["precipitation_total"], np.nansum(rain, axis=0), rtol=1e-5)
+
+
+# The storm total does not depend on how the slices are split into blocks, workers' swaths or shards
+def test_total_does_not_depend_on_blocks():
+    random = np.random.default_rng(2)
+    rain = (random.random((48, 20, 30)) ** 8 * 200.0).astype(np.float32)
+    minutes = np.arange(48) * 60
+    slices = Swath.Swath(rain.shape[1:], total=True)
+    for index in range(len(rain)):
+        slices.update(minutes[index:index + 1], rain[index:index + 1])
+    block = Swath.Swath(rain.shape[1:], total=True)
+    block.update(minutes, rain)
+    merged = Swath.Swath(rain.shape[1:], total=True)
+    for start, end in [(30, 48), (0, 7), (7, 30)]:
+        part = Swath.Swath(rain.shape[1:], total=True)
+        part.update(minutes[start:end], rain[start:end])
+        merged.merge(part)
+    expected = slices.values("precipitation")
+    for swath in [block, merged]:
+        for name, values in swath.values("precipitation").items():
+            assert np.array_equal(values, expected[name]), name
+    assert np.allclose(expected["precipitation_total"], np.sum(rain.astype(np.float64), axis=0))
+
+
+# Batched, worker and sharded runs write the same file as a serial run, storm total included
+def test_batched_worker_and_sharded_runs_match_serial(tmp_path):
+    trackFilename = str(tmp_path / "synthetic.trk")
+    benchmark.writeSyntheticTrack(trackFilename, 48)
+    track = Track.readTrack(trackFilename)
+    serial = str(tmp_path / "serial.nc")
+    runRain(track, serial, OutputOptions())
+    runs = {str(tmp_path / "batched.nc"): {"batchMemory": 1}, str(tmp_path / "workers.nc"): {"batchMemory": 1, "workers": 3}}
+    for filename, options in runs.items():
+        runRain(track, filename, OutputOptions(), **options)
+    stored = str(tmp_path / "stored.nc")
+    runRain(track, stored, OutputOptions(store="directory"), batchMemory=1, workers=3)
+    OutputStore.consolidate(OutputStore.DirectoryStore.directoryFor(stored))
+    runs[stored] = {}
+    shards = []
+    for index, timeRange in enumerate(["20:", "0:7", "7:20"]):
+        shards.append(str(tmp_path / ("shard_" + str(index) + ".nc")))
+        runRain(track, shards[-1], OutputOptions(), timeRange=mergeShards.TimeRange.parse(timeRange))
+    sharded = str(tmp_path / "sharded.nc")
+    mergeShards.merge(shards, sharded)
+    with netCDF4.Dataset(serial) as reference:
+        for filename in list(runs) + [sharded]:
+            with netCDF4.Dataset(filename) as dataset:
+                for name in reference.variables:
+                    assert np.array_equal(np.ma.filled(dataset[name][:], np.nan), np.ma.filled(reference[name][:], np.nan), equal_nan=True), (filename, name)